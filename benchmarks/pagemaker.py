@@ -0,0 +1,55 @@
+#!/usr/bin/python3
+"""Benchmarks the per-request construction cost of a PageMaker.
+
+Usage:
+  python3 benchmarks/pagemaker.py [number]
+"""
+
+# Standard modules
+import io
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+# Package modules
+from uweb3 import pagemaker, request
+
+
+class Pages(pagemaker.PageMaker):
+  """A PageMaker as an application would define it."""
+
+  def Index(self):
+    return 'Hello world'
+
+
+def Environ():
+  """Returns a minimal WSGI environment for a GET request."""
+  return {'REQUEST_METHOD': 'GET',
+          'PATH_INFO': '/',
+          'QUERY_STRING': '',
+          'HTTP_HOST': 'localhost',
+          'wsgi.input': io.BytesIO()}
+
+
+def Benchmark(number):
+  """Prints the number of PageMaker constructions per second."""
+  executing_path = os.path.dirname(os.path.abspath(__file__))
+  env = Environ()
+
+  def Construct():
+    Pages(request.Request(env, None), executing_path=executing_path)
+
+  def RequestOnly():
+    request.Request(env, None)
+
+  Construct()  # The first construction does the one-time class setup.
+  for name, function in (('request', RequestOnly), ('pagemaker', Construct)):
+    best = min(timeit.repeat(function, number=number, repeat=5))
+    print('%-10s %8.2f us/construction  %10.0f/s' % (
+        name, best / number * 1e6, number / best))
+
+
+if __name__ == '__main__':
+  Benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+"""Benchmarks the compiled DispatchTable against a linear route scan.
+
+The DispatchTable is measured both without and with its route cache.
+
+Usage:
+  python3 benchmarks/routing.py [repeat]
+"""
+
+# Standard modules
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+# Package modules
+from uweb3 import routing
+
+
+def Routes(count):
+  """Returns `count` routes resembling those of a typical application."""
+  routes = [routing.Route('/', 'Index', 'ALL', '*', None)]
+  for num in range(count - 2):
+    kind = num % 4
+    if kind == 0:
+      pattern = '/section%d' % num
+    elif kind == 1:
+      pattern = '/section%d/(\\d+)' % num
+    elif kind == 2:
+      pattern = '/api/v1/resource%d/(\\w+)/?' % num
+    else:
+      pattern = '/user/(\\d+)/page%d' % num
+    routes.append(routing.Route(pattern, 'Handler%d' % num, 'ALL', '*', None))
+  routes.append(routing.Route('/static/(.*?)', 'Static', 'ALL', '*', None))
+  return routes
+
+
+def Urls(count):
+  """Returns a mix of urls that hit early, late and no routes at all."""
+  urls = ['/', '/static/css/main.css', '/static/js/app.js', '/nonexistant']
+  for num in range(count - 2):
+    kind = num % 4
+    if kind == 0:
+      urls.append('/section%d' % num)
+    elif kind == 1:
+      urls.append('/section%d/42' % num)
+    elif kind == 2:
+      urls.append('/api/v1/resource%d/item/' % num)
+    else:
+      urls.append('/user/42/page%d' % num)
+  random.seed(count)
+  return random.sample(urls, min(len(urls), 50))
+
+
+def LinearResolve(routes, url, method):
+  """The route scan that the DispatchTable replaces."""
+  for route in routes:
+    if route.method != 'ALL' and route.method != method:
+      continue
+    match = route.regex.match(url)
+    if match:
+      return route.handler, tuple(group for group in match.groups() if group)
+  return None
+
+
+def Benchmark(count, repeat):
+  """Prints lookups per second for each resolver with `count` routes."""
+  routes = Routes(count)
+  urls = Urls(count)
+  table = routing.DispatchTable(routes, cache_size=0)
+  cached = routing.DispatchTable(routes)
+  for url in urls:
+    expected = LinearResolve(routes, url, 'GET')
+    result = table.Resolve(url, 'GET', 'localhost')
+    assert (result and result[:2]) == expected, url
+
+  def RunLinear():
+    for url in urls:
+      LinearResolve(routes, url, 'GET')
+
+  def RunTable():
+    for url in urls:
+      table.Resolve(url, 'GET', 'localhost')
+
+  def RunCached():
+    for url in urls:
+      cached.Resolve(url, 'GET', 'localhost')
+
+  for name, function in (('linear', RunLinear), ('dispatch', RunTable),
+                         ('cached', RunCached)):
+    best = min(timeit.repeat(function, number=repeat, repeat=3))
+    print('%5d routes %-9s %10.0f lookups/s' % (
+        count, name, repeat * len(urls) / best))
+
+
+if __name__ == '__main__':
+  REPEAT = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+  for ROUTECOUNT in (10, 100, 1000):
+    Benchmark(ROUTECOUNT, REPEAT)
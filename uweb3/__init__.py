@@ -5,23 +5,32 @@
 __version__ = '3.0'
 
 # Standard modules
+import atexit
 import configparser
+import functools
+import hashlib
 import logging
 import os
 import re
 import sys
+import time
 from wsgiref.simple_server import make_server
-import datetime
 
 # Package modules
-from . import pagemaker, request
+from . import accesslog, pagemaker, request, routing, static
+from .libs import compression, metrics
 
 # Package classes
-from .response import Response, Redirect
+from .response import Response, Redirect, FileResponse, StreamingBody
 from .pagemaker import PageMaker, decorators, WebsocketPageMaker, DebuggingPageMaker, LoginMixin
 from .model import SettingsManager
 from .libs.safestring import HTMLsafestring, JSONsafestring, JsonEncoder, Basesafestring
 
+# Content types that are compressed when compression is enabled.
+COMPRESSIBLE_TYPES = ('text/html, text/plain, text/css, text/csv, '
+                      'application/javascript, application/json, '
+                      'application/xml, image/svg+xml')
+
 class Error(Exception):
   """Superclass used for inheritance and external exception handling."""
 
@@ -46,18 +55,21 @@ class Router(object):
     self.pagemakers = page_class.LoadModules()
     self.pagemakers.append(page_class)
 
-  def router(self, routes):
+  def router(self, routes, cache_size=1024):
     """Returns the first request handler that matches the request URL.
 
     The `routes` argument is an iterable of 2-tuples, each of which contain a
     pattern (regex) and the name of the handler to use for matching requests.
 
-    Before returning the closure, all regexp are compiled, and handler methods
-    are retrieved from the provided `page_class`.
+    Before returning the closure, all regexp (url and host patterns) are
+    compiled, and handler methods are retrieved from the provided `page_class`.
 
     Arguments:
       @ routes: iterable of 2-tuples.
         Each tuple is a pair of `pattern` and `handler`, both are strings.
+      % cache_size: int ~~ 1024
+        The number of resolved routes to keep in the LRU route cache. The cache
+        and its hit/miss counters are available as `request_router.cache`.
 
     Returns:
       request_router: Configured closure that processes urls.
@@ -83,19 +95,21 @@ class Router(object):
         continue
       if not page_maker:
         raise NoRouteError(f"µWeb3 could not find a route handler called '{details[0]}' in any of the PageMakers, your application will not start.")
-      req_routes.append((re.compile(pattern + '$', re.UNICODE),
-                        details[0], #handler,
-                        details[1].upper() if len(details) > 1 else 'ALL', #request types
-                        details[2].lower() if len(details) > 2 else '*', #host
-                        page_maker #pagemaker class
-                        ))
+      req_routes.append(routing.Route(
+          pattern,
+          details[0], #handler,
+          details[1].upper() if len(details) > 1 else 'ALL', #request types
+          details[2].lower() if len(details) > 2 else '*', #host
+          page_maker #pagemaker class
+          ))
+    dispatch = routing.DispatchTable(req_routes, cache_size=cache_size)
 
     def request_router(url, method, host):
       """Returns the appropriate handler and arguments for the given `url`.
 
-      The`url` is matched against the compiled patterns in the `req_routes`
-      provided by the outer scope. Upon finding a pattern that matches, the
-      match groups from the regex and the unbound handler method are returned.
+      The`url` is matched against the compiled `dispatch` table provided by the
+      outer scope. Upon finding a pattern that matches, the match groups from
+      the regex and the unbound handler method are returned.
 
       N.B. The rules are such that the first matching route will be used. There
       is no further concept of specificity. Routes should be written with this in
@@ -113,33 +127,14 @@ class Router(object):
         NoRouteError: None of the patterns match the requested `url`.
 
       Returns:
-        2-tuple: handler method (unbound), and tuple of pattern matches.
+        4-tuple: handler method (unbound), tuple of pattern matches, tuple of
+                 host pattern matches and the pagemaker class.
       """
-
-      for pattern, handler, routemethod, hostpattern, page_maker in req_routes:
-        if routemethod != 'ALL':
-          # clearly not the route we where looking for
-          if isinstance(routemethod, tuple):
-            if method not in routemethod:
-              continue
-          if method != routemethod:
-            continue
-
-        hostmatch = None
-        if hostpattern != '*':
-          # see if we can match this host and extact any info from it.
-          hostmatch = re.compile(f"^{host}$").match(hostpattern)
-          if not hostmatch:
-            # clearly not the host we where looking for
-            continue
-          hostmatch = hostmatch.groups()
-        match = pattern.match(url)
-        if match:
-          # strip out optional groups, as they return '', which would override
-          # the handlers default argument values later on in the page_maker
-          groups = (group for group in match.groups() if group)
-          return handler, groups, hostmatch, page_maker
-      raise NoRouteError(url +' cannot be handled')
+      result = dispatch.Resolve(url, method, host)
+      if result is None:
+        raise NoRouteError(url +' cannot be handled')
+      return result
+    request_router.cache = dispatch.cache
     return request_router
 
 
@@ -173,8 +168,15 @@ class uWeb(object):
     self.inital_pagemaker = page_class
     self.registry = Registry()
     self.registry.logger = logging.getLogger('root')
-    self.router = Router(page_class).router(routes)
+    self.router = Router(page_class).router(
+        routes, cache_size=int(self.config.options.get('routing', {}).get(
+            'cache_size', 1024)))
     self.setup_routing()
+    self.setup_request()
+    self.setup_static()
+    self.setup_compression()
+    self.setup_etags()
+    self.setup_metrics()
     self.encoders = {
         'text/html': lambda x: HTMLsafestring(x, unsafe=True),
         'text/plain': str,
@@ -185,11 +187,15 @@ class uWeb(object):
     Accepts the WSGI `environment` dictionary and a function to start the
     response and returns a response iterator.
     """
+    start_time = time.perf_counter()
+    timer = metrics.RequestTimer() if self.metrics else metrics.NULL_TIMER
+    metrics.Activate(timer)
     req = request.Request(env, self.registry)
+    req.MAX_BODY_SIZE = self.max_body_size
     req.env['REAL_REMOTE_ADDR'] = request.return_real_remote_addr(req.env)
     response = None
     method = '_NotFound'
-    args = None
+    args = (req.path,)
     rollback = False
     try:
       method, args, hostargs, page_maker = self.router(req.path,
@@ -200,14 +206,17 @@ class uWeb(object):
       # If this happens we default to the initial pagemaker because we don't know what the target pagemaker should be.
       # Then we set an internalservererror and move on
       page_maker = self.inital_pagemaker
+    timer.Mark('routing')
     try:
       # instantiate the pagemaker for this request
       pagemaker_instance = page_maker(req,
                             config=self.config,
                             executing_path=self.executing_path)
+      timer.Mark('pagemaker')
       # specifically call _PreRequest as promised in documentation
       if hasattr(pagemaker_instance, '_PreRequest'):
         pagemaker_instance = pagemaker_instance._PreRequest()
+        timer.Mark('prerequest')
 
       response = self.get_response(pagemaker_instance, method, args)
     except Exception:
@@ -222,20 +231,31 @@ class uWeb(object):
                             executing_path=self.executing_path)
       response = pagemaker_instance.InternalServerError(*sys.exc_info())
 
+    streaming_body = None
     if method != 'Static':
       if not isinstance(response, Response):
         # print('Upgrade response to Response class: %s' % type(response))
         req.response.text = response
         response = req.response
 
-      if not isinstance(response.text, Basesafestring):
-        # make sure we always output Safe HTML if our content type is something we should encode
-        encoder = self.encoders.get(response.clean_content_type(), None)
-        if encoder:
+      encoder = self.encoders.get(response.clean_content_type(), None)
+      if response.streaming:
+        # Chunks are made safe as they are sent, and the request is cleaned up
+        # once the server closes the body after sending the last of them.
+        on_close = []
+        if hasattr(pagemaker_instance, '_PostRequest'):
+          on_close.append(pagemaker_instance._PostRequest)
+        response.text = streaming_body = StreamingBody(
+            response.text, response.charset, escape=encoder, on_close=on_close)
+      else:
+        if encoder and not isinstance(response.text, (Basesafestring, bytes)):
+          # make sure we always output Safe HTML if our content type is something we should encode
           response.text = encoder(response.text)
+        timer.Mark('encoding')
 
-      if hasattr(pagemaker_instance, '_PostRequest'):
-        pagemaker_instance._PostRequest()
+        if hasattr(pagemaker_instance, '_PostRequest'):
+          pagemaker_instance._PostRequest()
+          timer.Mark('postrequest')
 
     # CSP might be unneeded for some static content,
     # https://github.com/w3c/webappsec/issues/520
@@ -250,38 +270,163 @@ class uWeb(object):
     if not response.text:
       response.text = ''
 
-    self._logging(req, response)
+    if self.etags and method != 'Static':
+      response = self._ETag(req, response)
+
+    if self.compression is not None:
+      response = self._Compress(req, response)
+      timer.Mark('compression')
+
+    self._logging(req, response, start_time)
+    if self.metrics is not None:
+      if streaming_body is not None and isinstance(
+          response.text, (StreamingBody, compression.CompressedBody)):
+        # The template phase and sending of a streamed body happen after this,
+        # the request is recorded once the server closes the body.
+        streaming_body.on_close.append(functools.partial(
+            self._RecordStreamed, method, response.httpcode, timer))
+      else:
+        self.metrics.Record(method, response.httpcode, timer.Elapsed(),
+                            timer.phases)
+    metrics.Activate(metrics.NULL_TIMER)
     start_response(response.status, response.headerlist)
+    if isinstance(response, FileResponse):
+      return response.Body(req.env)
+    if isinstance(response.text, (StreamingBody, compression.CompressedBody)):
+      return response.text
     try:
-      yield response.text.encode(response.charset)
+      return [response.text.encode(response.charset)]
     except AttributeError:
-      yield response.text
+      return [response.text]
 
   def setup_logger(self):
+    """Sets up the access log, configured in the [accesslog] section.
+
+    Any access log handler of a previously constructed uWeb is closed first,
+    so requests are never logged twice.
+    """
     logger = logging.getLogger('uweb3_logger')
     logger.setLevel(logging.INFO)
-    fh = logging.FileHandler(os.path.join(self.executing_path, 'access_logging.log'))
-    fh.setLevel(logging.INFO)
-    logger.addHandler(fh)
+    for handler in list(logger.handlers):
+      if isinstance(handler, accesslog.AccessLogHandler):
+        logger.removeHandler(handler)
+        handler.close()
+    self.access_logging = self.config.options.get('development', {}).get(
+        'access_logging', True) != 'False'
+    if not self.access_logging:
+      return logger
+    options = self.config.options.get('accesslog', {})
+    writer = accesslog.AccessLogWriter(
+        os.path.join(self.executing_path,
+                     options.get('filename', 'access_logging.log')),
+        log_format=options.get('format', 'text'),
+        batch_size=int(options.get('batch_size', 256)),
+        max_bytes=int(options.get('max_bytes', 0)),
+        backup_count=int(options.get('backup_count', 5)))
+    writer.start()
+    handler = accesslog.AccessLogHandler(writer)
+    handler.setLevel(logging.INFO)
+    logger.addHandler(handler)
+    atexit.register(handler.close)
     return logger
 
-  def _logging(self, req, response):
+  def _logging(self, req, response, start_time):
     """Logs incoming requests to a logfile.
     This is enabled by default, even if its missing in the config file.
+
+    The record is only queued here, it is formatted and written by the
+    access log writer thread.
     """
-    if self.config.options.get('development', None):
-      if self.config.options['development'].get('access_logging', True) == 'False':
-        return
-
-    host = req.env['HTTP_HOST'].split(':')[0]
-    date = datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')
-    method = req.method
-    path = req.path
-    status = response.httpcode
-    protocol = req.env.get('SERVER_PROTOCOL')
-    self.logger.info(f"""{host} - - [{date}] \"{method} {path} {status} {protocol}\"""")
+    if not self.access_logging:
+      return
+    size = response.headers.get('content-length')
+    if size is None and isinstance(response.text, (bytes, str)):
+      size = len(response.text)
+    self.logger.info('access', extra={'access': {
+        'host': req.env.get('HTTP_HOST', '').split(':')[0],
+        'remote_addr': req.env.get('REAL_REMOTE_ADDR'),
+        'method': req.method,
+        'path': req.path,
+        'status': response.httpcode,
+        'protocol': req.env.get('SERVER_PROTOCOL'),
+        'size': size,
+        'latency': round(time.perf_counter() - start_time, 6),
+        'user_agent': req.env.get('HTTP_USER_AGENT')}})
+
+  def _Compress(self, req, response):
+    """Compresses the response body if the client accepts a content coding.
+
+    Responses that are small, of a content type that is not configured for
+    compression, or that already have a Content-Encoding are left untouched.
+    Streamed file responses are never compressed, so servers can send them
+    using sendfile().
+    """
+    options = self.compression
+    if (isinstance(response, FileResponse) or response.httpcode in (204, 206, 304)
+        or 'Content-Encoding' in response.headers
+        or response.clean_content_type() not in options['types']):
+      return response
+    vary = response.headers.get('Vary')
+    if not vary:
+      response.headers['Vary'] = 'Accept-Encoding'
+    elif 'accept-encoding' not in vary.lower():
+      response.headers['Vary'] = vary + ', Accept-Encoding'
+    encoding = compression.ChooseEncoding(req.env.get('HTTP_ACCEPT_ENCODING'))
+    if encoding is None:
+      return response
+    if isinstance(response.text, StreamingBody):
+      response.text = compression.CompressedBody(
+          response.text, encoding, options['level'])
+    else:
+      body = response.text
+      if isinstance(body, str):
+        body = body.encode(response.charset)
+      if len(body) < options['min_size']:
+        return response
+      response.text = compression.Compress(body, encoding, options['level'])
+      if 'content-length' in response.headers:
+        response.headers['content-length'] = len(response.text)
+    response.headers['Content-Encoding'] = encoding
+    etag = response.headers.get('ETag')
+    if etag and etag.endswith('"'):
+      response.headers['ETag'] = '%s-%s"' % (etag[:-1], encoding)
+    return response
+
+  def _ETag(self, req, response):
+    """Adds an ETag to the response, or answers with 304 if the client has it.
+
+    The ETag is the `content_hash` of the body, so it is only added to
+    complete (not streamed) successful responses to GET and HEAD requests,
+    which did not set an ETag of their own. The client's If-None-Match may
+    name the ETag with the suffix of any content coding added by compression.
+    """
+    if (response.httpcode != 200 or response.streaming
+        or isinstance(response, FileResponse) or 'ETag' in response.headers
+        or req.env.get('REQUEST_METHOD') not in ('GET', 'HEAD')):
+      return response
+    body = response.text
+    if isinstance(body, Basesafestring):
+      content_hash = body.content_hash
+    else:
+      if isinstance(body, str):
+        body = body.encode(response.charset)
+      content_hash = hashlib.md5(body).hexdigest()
+    etag = '"%s"' % content_hash
+    response.headers['ETag'] = etag
+    if_none_match = req.env.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+      tags = {tag.strip() for tag in if_none_match.split(',')}
+      tags.update(tag[2:] for tag in list(tags) if tag.startswith('W/'))
+      matches = {etag, '*'}
+      matches.update('"%s-%s"' % (content_hash, encoding)
+                     for encoding in compression.ENCODINGS)
+      if tags & matches:
+        response.httpcode = 304
+        response.text = ''
+    return response
 
   def get_response(self, page_maker, method, args):
+    timer = metrics.Current()
     try:
       if method != 'Static':
         # We're specifically calling _PostInit here as promised in documentation.
@@ -290,14 +435,19 @@ class uWeb(object):
       elif hasattr(page_maker, '_StaticPostInit'):
         # We're specifically calling _StaticPostInit here as promised in documentation, seperate from the regular PostInit to keep things fast for static pages
         page_maker._StaticPostInit()
+      timer.Mark('postinit')
 
       # pylint: enable=W0212
-      return getattr(page_maker, method)(*args)
+      result = getattr(page_maker, method)(*args)
+      timer.Mark('handler')
+      return result
     except pagemaker.ReloadModules as message:
       reload_message = reload(sys.modules[self.inital_pagemaker.__module__])
       return Response(content='%s\n%s' % (message, reload_message))
     except ImmediateResponse as err:
       return err[0]
+    except request.RequestBodyTooLargeError:
+      return page_maker._RequestBodyTooLarge()
     except Exception:
       if self.config.options.get('development', False):
         if self.config.options['development'].get('error_logging', True) == 'True':
@@ -347,6 +497,86 @@ class uWeb(object):
       self.inital_pagemaker.LoadModules(routes=default_route)
 
 
+  def setup_request(self):
+    """Reads the request body limits from the [request] config section."""
+    options = self.config.options.get('request', {})
+    self.max_body_size = None
+    if options.get('max_body_size'):
+      self.max_body_size = int(options['max_body_size'])
+    if options.get('spool_size'):
+      request.IndexedFieldStorage.SPOOL_SIZE = int(options['spool_size'])
+
+
+  def setup_static(self):
+    """Sets up the in-memory static file cache from the [static] section.
+
+    The cache is disabled unless `cache_size` (in bytes) is configured.
+    """
+    options = self.config.options.get('static', {})
+    self.registry.static_cache = None
+    cache_size = int(options.get('cache_size', 0))
+    if cache_size > 0:
+      self.registry.static_cache = static.StaticCache(
+          max_size=cache_size,
+          max_file_size=int(options.get('max_file_size', 256 * 1024)),
+          check_interval=float(options.get('check_interval', 2)),
+          compress_level=int(options.get('compress_level', 6)))
+
+
+  def setup_compression(self):
+    """Reads the response compression settings from the [compression] section.
+
+    Compression is disabled unless `enabled` is set to True. The `types` option
+    is a comma separated list of content types to compress.
+    """
+    options = self.config.options.get('compression', {})
+    self.compression = None
+    if options.get('enabled', 'False') == 'True':
+      types = options.get('types', COMPRESSIBLE_TYPES)
+      self.compression = {
+          'level': int(options.get('level', 6)),
+          'min_size': int(options.get('min_size', 1024)),
+          'types': frozenset(
+              content_type.strip() for content_type in types.split(','))}
+
+
+  def setup_etags(self):
+    """Reads the ETag setting for dynamic responses from the [etag] section.
+
+    ETags are added (and conditional requests answered) when `enabled` is set
+    to True. Static files always have ETags.
+    """
+    options = self.config.options.get('etag', {})
+    self.etags = options.get('enabled', 'False') == 'True'
+
+
+  def setup_metrics(self):
+    """Sets up request instrumentation from the [metrics] config section.
+
+    Metrics are collected when `enabled` is True, and are available on the
+    registry as `metrics`. If a `statsd_host` is configured, the metrics of
+    every request are also sent to that statsd server.
+    """
+    options = self.config.options.get('metrics', {})
+    self.metrics = None
+    if options.get('enabled', 'False') == 'True':
+      sinks = []
+      if options.get('statsd_host'):
+        sinks.append(metrics.StatsdSink(
+            options['statsd_host'], int(options.get('statsd_port', 8125)),
+            options.get('statsd_prefix', 'uweb3')))
+      buckets = metrics.DEFAULT_BUCKETS
+      if options.get('buckets'):
+        buckets = sorted(float(bound) for bound in options['buckets'].split(','))
+      self.metrics = metrics.Metrics(buckets=buckets, sinks=sinks)
+    self.registry.metrics = self.metrics
+
+  def _RecordStreamed(self, method, status, timer):
+    """Records the metrics of a request once its streamed body is closed."""
+    timer.Mark('body')
+    self.metrics.Record(method, status, timer.Elapsed(), timer.phases)
+
+
 class HotReload(object):
     """This class handles the thread which scans for file changes in the
     execution path and restarts the server if needed"""
@@ -0,0 +1,181 @@
+#!/usr/bin/python3
+"""uWeb3 access logging, written to disk off the request thread.
+
+Request threads only create a log record and put it on a queue. A background
+thread formats the queued records and writes them to the log file in batches,
+rotating the file when it grows beyond its maximum size.
+
+Classes:
+  AccessLogWriter: Background thread that writes access log records to a file.
+  AccessLogHandler: QueueHandler that passes records to an AccessLogWriter.
+"""
+
+# Standard modules
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+
+# Sentinel that tells the writer thread to stop.
+STOP = object()
+
+
+def FormatText(record):
+  """Returns the access log line for a record, in uWeb's classic format."""
+  fields = record.access
+  date = time.strftime('%d/%m/%Y %H:%M:%S', time.localtime(record.created))
+  return '%s - - [%s] "%s %s %s %s"' % (
+      fields['host'], date, fields['method'], fields['path'],
+      fields['status'], fields['protocol'])
+
+
+def FormatJson(record):
+  """Returns the access log line for a record as a JSON object."""
+  fields = dict(record.access)
+  fields['time'] = time.strftime(
+      '%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + (
+          '.%03dZ' % record.msecs)
+  return json.dumps(fields, separators=(',', ':'))
+
+
+FORMATS = {'text': FormatText, 'json': FormatJson}
+
+
+class AccessLogWriter(threading.Thread):
+  """Writes queued access log records to a file, in batches.
+
+  All records that are waiting in the queue are written at once (up to
+  `batch_size`), followed by a single flush. When the traffic is low records
+  are thus written right away, under load they are grouped.
+
+  A batch that cannot be written is reported and dropped, after which the
+  writer reopens its file and carries on; the queue is never left to grow
+  without a writer. The number of dropped records is kept in `dropped`.
+  """
+  def __init__(self, path, log_format='text', batch_size=256,
+               flush_interval=1.0, max_bytes=0, backup_count=5):
+    """Initializes the AccessLogWriter, call `start` to begin writing.
+
+    Arguments:
+      @ path: str
+        The file to write the access log to.
+      % log_format: str ~~ 'text'
+        The format of the log lines, one of FORMATS.
+      % batch_size: int ~~ 256
+        The maximum number of records written at once.
+      % flush_interval: float ~~ 1.0
+        The maximum number of seconds the writer waits for records, before
+        checking whether it should stop.
+      % max_bytes: int ~~ 0
+        The file is rotated when it would grow beyond this size, 0 disables
+        rotation.
+      % backup_count: int ~~ 5
+        The number of rotated files to keep.
+    """
+    super(AccessLogWriter, self).__init__(name='uweb3-accesslog', daemon=True)
+    self.path = path
+    self.formatter = FORMATS[log_format]
+    self.batch_size = batch_size
+    self.flush_interval = flush_interval
+    self.max_bytes = max_bytes
+    self.backup_count = backup_count
+    self.queue = queue.SimpleQueue()
+    self.stream = None
+    self.dropped = 0
+
+  def run(self):
+    try:
+      stopping = False
+      while not stopping:
+        try:
+          record = self.queue.get(timeout=self.flush_interval)
+        except queue.Empty:
+          continue
+        batch = []
+        while True:
+          if record is STOP:
+            stopping = True
+            break
+          batch.append(record)
+          if len(batch) >= self.batch_size:
+            break
+          try:
+            record = self.queue.get_nowait()
+          except queue.Empty:
+            break
+        if batch:
+          try:
+            self._Write(batch)
+          except Exception:
+            self.dropped += len(batch)
+            logging.getLogger(__name__).exception(
+                'Dropped %d access log records for %r.', len(batch), self.path)
+            self._Close()
+    finally:
+      self._Close()
+
+  def _Close(self):
+    """Closes the log file, it is opened again on the next write."""
+    if self.stream is not None:
+      try:
+        self.stream.close()
+      except OSError:
+        pass
+      self.stream = None
+
+  def _Write(self, batch):
+    """Formats and writes the batch of records, rotating the file if needed."""
+    lines = []
+    for record in batch:
+      try:
+        lines.append(self.formatter(record))
+      except Exception:  # A broken record should not stop the access log.
+        continue
+    data = '\n'.join(lines) + '\n'
+    if self.stream is None:
+      self.stream = open(self.path, 'a', encoding='utf-8')
+    if self.max_bytes and self.stream.tell() + len(data) > self.max_bytes:
+      self._Rotate()
+    self.stream.write(data)
+    self.stream.flush()
+
+  def _Rotate(self):
+    """Moves the current file to `path`.1, shifting older files up by one."""
+    self._Close()
+    if self.backup_count > 0:
+      for number in range(self.backup_count - 1, 0, -1):
+        source = '%s.%d' % (self.path, number)
+        if os.path.exists(source):
+          os.replace(source, '%s.%d' % (self.path, number + 1))
+      os.replace(self.path, self.path + '.1')
+    else:
+      os.remove(self.path)
+    self.stream = open(self.path, 'a', encoding='utf-8')
+
+  def Stop(self):
+    """Writes all queued records and stops the writer thread."""
+    if self.is_alive():
+      self.queue.put(STOP)
+      self.join()
+
+
+class AccessLogHandler(logging.handlers.QueueHandler):
+  """Hands access log records to an AccessLogWriter.
+
+  Unlike the regular QueueHandler, records are not formatted before they are
+  queued; that is left to the writer thread.
+  """
+  def __init__(self, writer):
+    super(AccessLogHandler, self).__init__(writer.queue)
+    self.writer = writer
+
+  def prepare(self, record):
+    return record
+
+  def close(self):
+    """Stops the writer once all queued records are written."""
+    self.writer.Stop()
+    super(AccessLogHandler, self).close()
@@ -4,18 +4,116 @@ databases, restfull apis, secure cookies, config files etc."""
 __author__ = 'Jan Klopper (janunderdark.nl)'
 __version__ = 0.1
 
+import functools
 import os
 import sys
+import threading
+import warnings
 from base64 import b64encode
 
+from .libs import cache
+
 class ConnectionError(Exception):
   """Error class thrown when the underlying connectors thrown an error on
   connecting."""
 
+def NormalizeKey(key):
+  """Returns a primary key in the form that records are kept by.
+
+  Keys come in as the database returns them (like 5), but also as given in
+  URLs and forms ('5'). MySQL takes both for the same key, so the record
+  stores do as well: keys are kept as strings, or tuples of them.
+  """
+  if isinstance(key, tuple):
+    return tuple(map(NormalizeKey, key))
+  if isinstance(key, (bytes, bytearray)):
+    return key.decode('utf8', 'replace')
+  return str(key)
+
+
+class IdentityMap(object):
+  """Keeps the records that were loaded during a request, by table and key.
+
+  Loading a record that is already in the map returns the same instance
+  instead of querying the database again. Hits and misses are counted, so the
+  effect can be profiled.
+  """
+  def __init__(self):
+    self.records = {}
+    self.hits = 0
+    self.misses = 0
+
+  def Get(self, table, key):
+    """Returns the record with the given primary key, or None."""
+    record = self.records.get((table, NormalizeKey(key)))
+    if record is None:
+      self.misses += 1
+    else:
+      self.hits += 1
+    return record
+
+  def Add(self, record):
+    """Adds a record to the map, by its table name and primary key."""
+    self.records[record.TableName(), NormalizeKey(record.key)] = record
+
+  def Discard(self, table, key):
+    """Removes the record with the given primary key from the map, if present."""
+    self.records.pop((table, NormalizeKey(key)), None)
+
+  def Stats(self):
+    """Returns the number of hits, misses and records in the map."""
+    return {'hits': self.hits, 'misses': self.misses,
+            'size': len(self.records)}
+
+
+class ModelCache(object):
+  """Keeps the rows of records between requests, by table and primary key.
+
+  The rows are stored in a cache backend (see `uweb3.libs.cache`), which is
+  either in-process (TTLCache) or shared between processes (FileCache).
+  Besides the counters of the backend, the number of database queries that
+  the cache saved is counted.
+  """
+  def __init__(self, backend):
+    self.backend = backend
+    self.queries_saved = 0
+    self._lock = threading.Lock()
+
+  @staticmethod
+  def _Key(table, key):
+    """Returns the cache key for the record with the given primary key."""
+    return '%s:%r' % (table, NormalizeKey(key))
+
+  def Get(self, table, key):
+    """Returns the cached row of the record with the given primary key, or None.
+    """
+    return self.backend.Get(self._Key(table, key))
+
+  def Add(self, record):
+    """Stores the database values of a record."""
+    self.backend.Set(self._Key(record.TableName(), record.key),
+                     dict(record._record))
+
+  def Discard(self, table, key):
+    """Removes the record with the given primary key from the cache."""
+    self.backend.Del(self._Key(table, key))
+
+  def QuerySaved(self):
+    """Counts a database query that was answered from the cache."""
+    with self._lock:
+      self.queries_saved += 1
+
+  def Stats(self):
+    """Returns the counters of the backend and the number of queries saved."""
+    return dict(self.backend.Stats(), queries_saved=self.queries_saved)
+
+
 class ConnectionManager(object):
   """This is the connection manager object that is handled by all Model Objects.
-  It finds out which connection was requested by looking at the call stack, and
-  figuring out what database type the model class calling it belongs to.
+  Model classes retrieve their connection through `For(cls)`, which picks the
+  connector by the `_CONNECTOR` of the class. Using the manager itself as a
+  connection is deprecated; it finds out which connection was requested by
+  looking at the call stack instead.
 
   Connected databases are stored and reused.
   On delete, the databases are closed and any lingering transactions are
@@ -30,6 +128,9 @@ class ConnectionManager(object):
     self.config = config
     self.options = options
     self.debug = debug
+    self._local = threading.local()
+    self._lock = threading.Lock()
+    self._model_cache = None
     self.LoadDefaultConnectors()
 
   def LoadDefaultConnectors(self):
@@ -45,6 +146,75 @@ class ConnectionManager(object):
       self.DEFAULTCONNECTIONMANAGER = classname.Name()
     self.__connectors[classname.Name()] = classname
 
+  def BindRequest(self, request):
+    """Sets the request that connectors are set up with on this thread."""
+    self._local.request = request
+
+  def IdentityMap(self):
+    """Returns the IdentityMap of the request on the current thread."""
+    identity_map = getattr(self._local, 'identity_map', None)
+    if identity_map is None:
+      identity_map = self._local.identity_map = IdentityMap()
+    return identity_map
+
+  def ModelCache(self):
+    """Returns the ModelCache that is shared by all requests.
+
+    The cache is configured in the [modelcache] section of the config:
+      backend: 'memory' for an in-process cache, or 'file' for one that is
+          shared by all processes (memory)
+      size: the maximum number of records in a memory cache (1024)
+      ttl: seconds that records are kept (60)
+      path: the directory of a file cache (a directory private to the user
+          and the application, see `cache.DefaultPath`)
+    """
+    if self._model_cache is None:
+      with self._lock:
+        if self._model_cache is None:
+          options = self.options.get('modelcache', {})
+          ttl = float(options.get('ttl', 60))
+          if options.get('backend', 'memory') == 'file':
+            path = options.get('path') or cache.DefaultPath(
+                self._ApplicationPath(), 'models')
+            backend = cache.FileCache(path, ttl=ttl)
+          else:
+            backend = cache.TTLCache(int(options.get('size', 1024)), ttl=ttl)
+          self._model_cache = ModelCache(backend)
+    return self._model_cache
+
+  def _ApplicationPath(self):
+    """Returns the directory of the application, that holds its config."""
+    location = getattr(self.config, 'FILE_LOCATION', None)
+    return os.path.dirname(location) if location else None
+
+  def For(self, record_class):
+    """Returns the connection to use for the given model class.
+
+    The connection is that of the connector named by the `_CONNECTOR` of the
+    class, or of the default connector if the class does not name one.
+    """
+    con_type = getattr(record_class, '_CONNECTOR', self.DEFAULTCONNECTIONMANAGER)
+    connector = self.__connections.get(con_type)
+    if connector is None or not hasattr(connector, 'connection'):
+      connector = self._Connector(con_type)
+    return connector.connection
+
+  def _Connector(self, con_type, request=None):
+    """Sets up the connector of the given type, or returns the existing one."""
+    with self._lock:
+      connector = self.__connections.get(con_type)
+      if connector is not None and hasattr(connector, 'connection'):
+        return connector
+      if request is None:
+        request = getattr(self._local, 'request', None)
+      try:
+        connector_class = self.__connectors[con_type]
+      except KeyError:
+        raise TypeError('No connector for: %r, available: %r' % (con_type, self.__connectors))
+      connector = self.__connections[con_type] = connector_class(
+          self.config, self.options, request, self.debug)
+      return connector
+
   def RelevantConnection(self, level=2):
     """Returns the relevant database connection dependant on the caller model
     class.
@@ -53,10 +223,14 @@ class ConnectionManager(object):
     connection is returned as a fallback method.
 
     Level indicates how many stack layers we should go up. Defaults to two.
+
+    N.B. This is deprecated, model classes should use `For(cls)`.
     """
+    warnings.warn('Using the ConnectionManager as a connection is deprecated, '
+                  'use ConnectionManager.For(cls) instead.',
+                  DeprecationWarning, stacklevel=level + 1)
     # Figure out caller type or instance
     # pylint: disable=W0212
-    #TODO use inspect module instead, and iterate over frames
     caller_locals = sys._getframe(level).f_locals
     # pylint: enable=W0212
     if 'self' in caller_locals:
@@ -70,15 +244,10 @@ class ConnectionManager(object):
     if (con_type in self.__connections and
         hasattr(self.__connections[con_type], 'connection')):
       return self.__connections[con_type].connection
-    else:
+    request = getattr(self._local, 'request', None)
+    if request is None:
       request = sys._getframe(3).f_locals['self'].req
-      try:
-        # instantiate a connection
-        self.__connections[con_type] = self.__connectors[con_type](
-            self.config, self.options, request, self.debug)
-        return self.__connections[con_type].connection
-      except KeyError:
-        raise TypeError('No connector for: %r, available: %r' % (con_type, self.__connectors))
+    return self._Connector(con_type, request).connection
 
   def __enter__(self):
     """Proxies the transaction to the underlying relevant connection."""
@@ -102,9 +271,21 @@ class ConnectionManager(object):
         pass
 
   def PostRequest(self):
-    """This cleans up any non persistent connections."""
+    """This cleans up any non persistent connections.
+
+    Persistent connectors release the connection the request used, so pooled
+    connections go back to their pool. The request's IdentityMap is cleared.
+    """
+    self._local.request = None
+    identity_map = getattr(self._local, 'identity_map', None)
+    if identity_map is not None:
+      if self.debug:
+        print('Identity map: %(hits)d hits, %(misses)d misses, '
+              '%(size)d records.' % identity_map.Stats())
+      self._local.identity_map = None
     cleanups = []
     for classname in self.__connections:
+      self.__connections[classname].Release()
       if (hasattr(self.__connections[classname], 'PERSISTENT') and
           not self.__connections[classname].PERSISTENT):
         cleanups.append(classname)
@@ -115,6 +296,18 @@ class ConnectionManager(object):
         pass
       del(self.__connections[classname])
 
+  def PoolStats(self):
+    """Returns the pool statistics of all connectors that use a pool."""
+    return {classname: connector.pool.Stats()
+            for classname, connector in self.__connections.items()
+            if getattr(connector, 'pool', None) is not None}
+
+  def CacheStats(self):
+    """Returns the statistics of the ModelCache, or None if it isn't used."""
+    if self._model_cache is None:
+      return None
+    return self._model_cache.Stats()
+
   def __iter__(self):
     """Pass tru to the Relevant connection as an Iterable, so variable unpacking
     can be used by the consuming class. This is used in the SecureCookie Model
@@ -124,9 +317,7 @@ class ConnectionManager(object):
   def __del__(self):
     """Cleans up all references, and closes all connectors"""
     print('Deleting model connections.')
-    for classname in self.__connectors:
-      if not hasattr(self.__connectors[classname], 'connection'):
-        continue
+    for classname in self.__connections:
       try:
         self.__connections[classname].Disconnect()
       except (NotImplementedError, TypeError, ConnectionError):
@@ -165,6 +356,12 @@ class Connector(object):
     """Standard interface to rollback any pending commits"""
     raise NotImplementedError
 
+  def Release(self):
+    """Standard interface to release the connection at the end of a request.
+
+    Connectors that keep a single connection have nothing to release.
+    """
+
 
 class SignedCookie(Connector):
   """Adds a signed cookie connection to the connection manager object.
@@ -195,41 +392,82 @@ class SignedCookie(Connector):
 
 
 class Mysql(Connector):
-  """Adds MySQL support to connection manager object."""
+  """Adds MySQL support to connection manager object.
+
+  Connections are taken from a pool. Each thread checks out its own connection
+  on first use, and returns it to the pool when the request is done.
+
+  The pool is configured in the [mysql] section of the config:
+    pool_min_size: connections that are kept open, even when idle (1)
+    pool_max_size: maximum number of connections (10)
+    pool_idle_timeout: seconds before idle connections are closed (300)
+    pool_max_lifetime: seconds before connections are recycled (3600)
+    pool_health_check: seconds of idling before a connection is pinged (30)
+    pool_timeout: seconds to wait when all connections are in use (10)
+    ping_interval: seconds of idling before a transaction checks the
+        connection for liveness (30)
+    statement_cache_size: parameterized queries kept parsed per connection (0)
+  """
 
   def __init__(self, config, options, request, debug=False):
-    """Returns a MySQL database connection."""
+    """Sets up a MySQL connection pool."""
     self.debug = debug
     self.options = {'host': 'localhost',
                    'user': None,
                    'password': None,
                    'database': ''}
+    self._local = threading.local()
     try:
       from .libs.sqltalk import mysql
       try:
         self.options = options[self.Name()]
       except KeyError:
         pass
-      self.connection = mysql.Connect(
-        host=self.options.get('host', 'localhost'),
-        user=self.options.get('user'),
-        passwd=self.options.get('password'),
-        db=self.options.get('database'),
-        charset=self.options.get('charset', 'utf8'),
-        debug=self.debug)
+      self.pool = mysql.ConnectionPool(
+          functools.partial(
+              mysql.Connect,
+              host=self.options.get('host', 'localhost'),
+              user=self.options.get('user'),
+              passwd=self.options.get('password'),
+              db=self.options.get('database'),
+              charset=self.options.get('charset', 'utf8'),
+              ping_interval=float(self.options.get('ping_interval', 30)),
+              statement_cache_size=int(
+                  self.options.get('statement_cache_size', 0)),
+              debug=self.debug),
+          min_size=int(self.options.get('pool_min_size', 1)),
+          max_size=int(self.options.get('pool_max_size', 10)),
+          idle_timeout=float(self.options.get('pool_idle_timeout', 300)),
+          max_lifetime=float(self.options.get('pool_max_lifetime', 3600)),
+          health_check=float(self.options.get('pool_health_check', 30)),
+          timeout=float(self.options.get('pool_timeout', 10)))
     except Exception as e:
       raise ConnectionError('Connection to "%s" of type "%s" resulted in: %r' % (self.Name(), type(self), e))
 
+  @property
+  def connection(self):
+    """Returns the connection of the current thread, checking one out if needed."""
+    connection = getattr(self._local, 'connection', None)
+    if connection is None:
+      connection = self._local.connection = self.pool.Acquire()
+    return connection
+
+  def Release(self):
+    """Returns the connection of the current thread to the pool."""
+    connection = self._local.__dict__.pop('connection', None)
+    if connection is not None:
+      self.pool.Release(connection)
+
   def Rollback(self):
     with self.connection as cursor:
       return cursor.Execute("ROLLBACK")
 
   def Disconnect(self):
-    """Closes the MySQL connection."""
+    """Closes the MySQL connection pool."""
     if self.debug:
       print('%s closed connection to: %r' % (self.Name(), self.options.get('database')))
-    self.connection.close()
-    del(self.connection)
+    self.Release()
+    self.pool.Close()
 
 
 class Mongo(Connector):
@@ -0,0 +1,354 @@
+#!/usr/bin/python3
+"""Bounded in-process caches.
+
+Classes:
+  LRUCache: Thread-safe mapping that evicts the least recently used entries.
+  TTLCache: LRUCache whose entries expire after a number of seconds.
+  FileCache: Cache shared between processes, with an expiring file per entry.
+
+Functions:
+  DefaultPath: The private cache directory for an application.
+"""
+
+# Standard modules
+import collections
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+
+
+class LRUCache(object):
+  """A bounded, thread-safe cache with least-recently-used eviction.
+
+  The cache keeps counters for hits, misses and evictions, which are available
+  through the `Stats` method.
+
+  Every entry costs 1 towards the size of the cache, unless it is given another
+  cost when it is stored. This allows the cache to be bounded in bytes, rather
+  than in number of entries.
+  """
+  def __init__(self, maxsize=1024):
+    """Initializes an LRUCache.
+
+    Arguments:
+      % maxsize: int ~~ 1024
+        The maximum total cost of the entries held by the cache. A size of zero
+        (or less) disables caching altogether.
+    """
+    self.maxsize = maxsize
+    self.currsize = 0
+    self._dict = collections.OrderedDict()
+    self._costs = {}
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def __contains__(self, key):
+    return key in self._dict
+
+  def __len__(self):
+    return len(self._dict)
+
+  def Clear(self):
+    """Removes all entries from the cache, counters are left unchanged."""
+    with self._lock:
+      self._dict.clear()
+      self._costs.clear()
+      self.currsize = 0
+
+  def Del(self, key):
+    """Removes the given key from the cache.
+
+    N.B. if the key was not in the cache, no error is raised.
+    """
+    with self._lock:
+      if key in self._dict:
+        del self._dict[key]
+        self.currsize -= self._costs.pop(key)
+
+  def Get(self, key, default=None):
+    """Returns the cached value for `key`, or `default` if it isn't cached."""
+    with self._lock:
+      try:
+        value = self._dict[key]
+      except KeyError:
+        self.misses += 1
+        return default
+      self._dict.move_to_end(key)
+      self.hits += 1
+      return value
+
+  def Set(self, key, value, cost=1):
+    """Stores `value` for `key`, evicting the least recently used entries.
+
+    Arguments:
+      @ key: hashable
+        The key to store the value under.
+      @ value: obj
+        The value to cache.
+      % cost: int ~~ 1
+        The amount this entry adds to the size of the cache. Entries that
+        cost more than the cache's maximum size are not stored, and remove
+        the value that was stored for the key before.
+    """
+    if cost > self.maxsize:
+      self.Del(key)
+      return
+    with self._lock:
+      self.currsize += cost - self._costs.get(key, 0)
+      self._dict[key] = value
+      self._costs[key] = cost
+      self._dict.move_to_end(key)
+      while self.currsize > self.maxsize:
+        oldest, _value = self._dict.popitem(last=False)
+        self.currsize -= self._costs.pop(oldest)
+        self.evictions += 1
+
+  def Stats(self):
+    """Returns a dictionary with the cache size and its usage counters."""
+    return {'size': len(self._dict),
+            'currsize': self.currsize,
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions}
+
+
+class TTLCache(LRUCache):
+  """An LRUCache whose entries expire a number of seconds after they're stored.
+
+  Expired entries count as misses, and are removed when they are looked up.
+  """
+  def __init__(self, maxsize=1024, ttl=60):
+    """Initializes a TTLCache.
+
+    Arguments:
+      % maxsize: int ~~ 1024
+        The maximum total cost of the entries held by the cache.
+      % ttl: float ~~ 60
+        The number of seconds entries are kept, unless given otherwise.
+    """
+    super(TTLCache, self).__init__(maxsize)
+    self.ttl = ttl
+    self.expirations = 0
+
+  def Get(self, key, default=None):
+    """Returns the cached value for `key`, or `default` if it isn't cached."""
+    with self._lock:
+      try:
+        expires, value = self._dict[key]
+      except KeyError:
+        self.misses += 1
+        return default
+      if expires < time.monotonic():
+        del self._dict[key]
+        self.currsize -= self._costs.pop(key)
+        self.expirations += 1
+        self.misses += 1
+        return default
+      self._dict.move_to_end(key)
+      self.hits += 1
+      return value
+
+  def Set(self, key, value, cost=1, ttl=None):
+    """Stores `value` for `key`, expiring after `ttl` (or the default) seconds."""
+    expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+    super(TTLCache, self).Set(key, (expires, value), cost=cost)
+
+  def Stats(self):
+    """Returns a dictionary with the cache size and its usage counters."""
+    stats = super(TTLCache, self).Stats()
+    stats.update(ttl=self.ttl, expirations=self.expirations)
+    return stats
+
+
+def DefaultPath(application=None, name='cache'):
+  """Returns the default directory for a FileCache of the given application.
+
+  The directory is placed in shared memory (/dev/shm) where that is available,
+  or in the temporary directory otherwise. Its name holds the id of the user
+  and a digest of the application directory, so applications and users never
+  share their caches.
+
+  Arguments:
+    % application: str ~~ None
+      The directory of the application, defaults to the working directory.
+    % name: str ~~ 'cache'
+      The name of the cache within the directory of the application.
+  """
+  root = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+  application = os.path.abspath(application or os.getcwd())
+  digest = hashlib.sha1(application.encode('utf8')).hexdigest()[:16]
+  return os.path.join(root, 'uweb3-%d-%s' % (os.getuid(), digest), name)
+
+
+class FileCache(object):
+  """A cache that stores each entry in its own file, with an expiry time.
+
+  All processes that use the same directory share the cache, which makes it
+  suitable for applications that run several worker processes. By default the
+  directory is private to the user and application, see `DefaultPath`.
+
+  Entries are unpickled, so the directory must be owned by the user that runs
+  the application and may not be writable for others. Entry files that are
+  owned by another user are ignored.
+
+  Keys must be strings, values anything that can be pickled. The counters
+  (hits, misses and evictions) are kept per process.
+  """
+  def __init__(self, path=None, ttl=60, maxsize=None, prune_interval=100):
+    """Initializes a FileCache, creating its directory if needed.
+
+    Arguments:
+      % path: str ~~ None
+        The directory to keep the entries in, defaults to `DefaultPath()`.
+      % ttl: float ~~ 60
+        The number of seconds entries are kept, unless given otherwise.
+      % maxsize: int ~~ None
+        The maximum number of entries that pruning leaves, unbounded if None.
+      % prune_interval: int ~~ 100
+        The cache is pruned after this many entries are stored, 0 disables
+        the automatic pruning.
+
+    Raises:
+      PermissionError: the directory is not private to the current user.
+    """
+    if path is None:
+      path = DefaultPath()
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    status = os.lstat(path)
+    if (os.path.islink(path) or not os.path.isdir(path)
+        or status.st_uid != os.getuid() or status.st_mode & 0o022):
+      raise PermissionError(
+          'Cache directory %r must be owned by the current user and may not '
+          'be writable for others.' % path)
+    self.path = path
+    self.ttl = ttl
+    self.maxsize = maxsize
+    self.prune_interval = prune_interval
+    self.stores = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def _Filename(self, key):
+    """Returns the name of the file that holds the entry for `key`."""
+    return os.path.join(
+        self.path, hashlib.sha1(key.encode('utf8')).hexdigest())
+
+  @staticmethod
+  def _Load(filename):
+    """Returns the unpickled (key, expires, value) entry from `filename`.
+
+    Files that are not owned by the current user raise a PermissionError
+    before anything is unpickled.
+    """
+    with open(filename, 'rb') as entry:
+      if os.fstat(entry.fileno()).st_uid != os.getuid():
+        raise PermissionError('Cache entry %r has another owner.' % filename)
+      return pickle.load(entry)
+
+  def Clear(self):
+    """Removes all entries from the cache, counters are left unchanged."""
+    for name in os.listdir(self.path):
+      try:
+        os.unlink(os.path.join(self.path, name))
+      except FileNotFoundError:
+        pass
+
+  def Del(self, key):
+    """Removes the given key from the cache.
+
+    N.B. if the key was not in the cache, no error is raised.
+    """
+    try:
+      os.unlink(self._Filename(key))
+    except FileNotFoundError:
+      pass
+
+  def Get(self, key, default=None):
+    """Returns the cached value for `key`, or `default` if it isn't cached."""
+    filename = self._Filename(key)
+    try:
+      stored_key, expires, value = self._Load(filename)
+    except (OSError, EOFError, pickle.UnpicklingError):
+      self.misses += 1
+      return default
+    if expires < time.time():
+      self.evictions += 1
+      self.Del(key)
+      self.misses += 1
+      return default
+    if stored_key != key:  # Hash collision, treat as a miss.
+      self.misses += 1
+      return default
+    self.hits += 1
+    return value
+
+  def Set(self, key, value, cost=1, ttl=None):
+    """Stores `value` for `key`, expiring after `ttl` (or the default) seconds.
+
+    The entry is written to a temporary file first, so that other processes
+    never read a partially written entry. Every `prune_interval` stores, the
+    cache is pruned.
+    """
+    expires = time.time() + (self.ttl if ttl is None else ttl)
+    descriptor, temporary = tempfile.mkstemp(dir=self.path, prefix='.')
+    try:
+      with os.fdopen(descriptor, 'wb') as entry:
+        pickle.dump((key, expires, value), entry, pickle.HIGHEST_PROTOCOL)
+      os.replace(temporary, self._Filename(key))
+    except Exception:
+      try:
+        os.unlink(temporary)
+      except FileNotFoundError:
+        pass
+      raise
+    self.stores += 1
+    if self.prune_interval and not self.stores % self.prune_interval:
+      self.Prune()
+
+  def Prune(self):
+    """Removes expired entries, and the oldest entries beyond `maxsize`.
+
+    Returns the number of removed entries.
+    """
+    removed = 0
+    now = time.time()
+    entries = []
+    for name in os.listdir(self.path):
+      if name.startswith('.'):  # Entries that are still being written.
+        continue
+      filename = os.path.join(self.path, name)
+      try:
+        expires = self._Load(filename)[1]
+        if expires < now:
+          os.unlink(filename)
+          removed += 1
+        else:
+          entries.append((os.stat(filename).st_mtime, filename))
+      except (OSError, EOFError, pickle.UnpicklingError, IndexError):
+        continue
+    if self.maxsize is not None and len(entries) > self.maxsize:
+      entries.sort()
+      for _mtime, filename in entries[:len(entries) - self.maxsize]:
+        try:
+          os.unlink(filename)
+          removed += 1
+        except FileNotFoundError:
+          pass
+    self.evictions += removed
+    return removed
+
+  def Stats(self):
+    """Returns a dictionary with the cache location and its usage counters."""
+    return {'path': self.path,
+            'ttl': self.ttl,
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions}
@@ -0,0 +1,139 @@
+#!/usr/bin/python3
+"""Content-Encoding negotiation and compression helpers.
+
+Brotli support is optional; it is available when the `brotli` module is
+installed, otherwise only gzip is offered.
+"""
+
+# Standard modules
+import gzip
+import zlib
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+# Supported encodings, in order of preference.
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def AcceptedEncodings(accept_encoding):
+  """Returns the set of content codings the client accepts.
+
+  Codings with a quality value of zero are excluded, as is everything when the
+  header is missing.
+
+  Arguments:
+    @ accept_encoding: str
+      The value of the Accept-Encoding request header, or None.
+  """
+  accepted = set()
+  for coding in (accept_encoding or '').split(','):
+    coding, _sep, params = coding.partition(';')
+    coding = coding.strip().lower()
+    quality = params.strip()
+    if quality.startswith('q='):
+      try:
+        if float(quality[2:]) <= 0:
+          continue
+      except ValueError:
+        continue
+    if coding:
+      accepted.add(coding)
+  return accepted
+
+
+def ChooseEncoding(accept_encoding, available=ENCODINGS):
+  """Returns the preferred encoding out of `available`, or None.
+
+  Arguments:
+    @ accept_encoding: str
+      The value of the Accept-Encoding request header, or None.
+    % available: iterable of str ~~ ENCODINGS
+      The encodings that can be offered, in order of preference.
+  """
+  accepted = AcceptedEncodings(accept_encoding)
+  for encoding in available:
+    if encoding in accepted or '*' in accepted:
+      return encoding
+  return None
+
+
+def Compress(data, encoding, level=6):
+  """Returns `data` compressed with the given content coding.
+
+  Arguments:
+    @ data: bytes
+      The content to compress.
+    @ encoding: str
+      The content coding, one of ENCODINGS.
+    % level: int ~~ 6
+      The gzip compression level (1-9), brotli uses a quality of level + 2.
+  """
+  if encoding == 'gzip':
+    return gzip.compress(data, compresslevel=level, mtime=0)
+  if encoding == 'br' and brotli is not None:
+    return brotli.compress(data, quality=min(level + 2, 11))
+  raise ValueError('Unsupported content encoding %r' % encoding)
+
+
+class StreamCompressor(object):
+  """Compresses a stream of chunks with the given content coding.
+
+  Every chunk is flushed from the compressor, so that the client can decode
+  each chunk as soon as it arrives.
+  """
+  def __init__(self, encoding, level=6):
+    """Initializes a StreamCompressor.
+
+    Arguments:
+      @ encoding: str
+        The content coding, one of ENCODINGS.
+      % level: int ~~ 6
+        The gzip compression level (1-9), brotli uses a quality of level + 2.
+    """
+    self.encoding = encoding
+    if encoding == 'gzip':
+      self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    elif encoding == 'br' and brotli is not None:
+      self._compressor = brotli.Compressor(quality=min(level + 2, 11))
+    else:
+      raise ValueError('Unsupported content encoding %r' % encoding)
+
+  def Compress(self, data):
+    """Returns the compressed data for the chunk, ready to be sent."""
+    if self.encoding == 'gzip':
+      return (self._compressor.compress(data) +
+              self._compressor.flush(zlib.Z_SYNC_FLUSH))
+    return self._compressor.process(data) + self._compressor.flush()
+
+  def Finish(self):
+    """Returns the final compressed data that ends the stream."""
+    if self.encoding == 'gzip':
+      return self._compressor.flush(zlib.Z_FINISH)
+    return self._compressor.finish()
+
+
+class CompressedBody(object):
+  """WSGI iterable that compresses the chunks of another WSGI iterable.
+
+  Closing the CompressedBody closes the wrapped iterable.
+  """
+  def __init__(self, body, encoding, level=6):
+    self.body = body
+    self.encoding = encoding
+    self.level = level
+
+  def __iter__(self):
+    compressor = StreamCompressor(self.encoding, self.level)
+    for chunk in self.body:
+      data = compressor.Compress(chunk)
+      if data:
+        yield data
+    yield compressor.Finish()
+
+  def close(self):
+    """Closes the wrapped body."""
+    if hasattr(self.body, 'close'):
+      self.body.close()
@@ -0,0 +1,292 @@
+#!/usr/bin/python3
+"""Request latency and throughput instrumentation.
+
+Each request gets a RequestTimer that records how long the request spent in
+each of its phases (routing, the handler, template parsing etc.). When the
+request is done, its timings are recorded in the application's Metrics, which
+keeps latency histograms per route and per phase, and counters per status code.
+
+The collected metrics can be read as a snapshot (a dictionary), in Prometheus
+text format, or pushed to sinks such as the StatsdSink as requests complete.
+
+Classes:
+  Histogram: Counts observations in cumulative buckets.
+  RequestTimer: Measures the phases of a single request.
+  Metrics: Aggregated request metrics for an application.
+  StatsdSink: Sends request metrics to a statsd server over UDP.
+"""
+
+# Standard modules
+import bisect
+import socket
+import threading
+import time
+
+# Upper bounds (in seconds) of the latency histogram buckets.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+_local = threading.local()
+
+
+class Histogram(object):
+  """Counts observed values in buckets, keeping their sum and total count."""
+  __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+  def __init__(self, buckets=DEFAULT_BUCKETS):
+    self.buckets = buckets
+    self.counts = [0] * (len(buckets) + 1)
+    self.sum = 0.0
+    self.count = 0
+
+  def Observe(self, value):
+    """Adds a value to the histogram."""
+    self.counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.sum += value
+    self.count += 1
+
+  def Cumulative(self):
+    """Returns a list of (upper bound, cumulative count) for all buckets."""
+    total = 0
+    cumulative = []
+    for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+      total += count
+      cumulative.append((bound, total))
+    return cumulative
+
+  def Snapshot(self):
+    """Returns the state of the histogram as a dictionary."""
+    return {'buckets': self.Cumulative(), 'sum': self.sum, 'count': self.count}
+
+
+class _PhaseTimer(object):
+  """Context manager that adds the time spent in its block to a phase."""
+  __slots__ = ('timer', 'phase', 'start')
+
+  def __init__(self, timer, phase):
+    self.timer = timer
+    self.phase = phase
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc_info):
+    phases = self.timer.phases
+    phases[self.phase] = (
+        phases.get(self.phase, 0) + time.perf_counter() - self.start)
+
+
+class RequestTimer(object):
+  """Measures the time spent in the consecutive phases of a request.
+
+  `Mark` ends the current phase and starts the next one. Phases that are nested
+  inside others (like template parsing inside the handler) are measured with
+  the `Phase` context manager instead.
+  """
+  __slots__ = ('start', 'last', 'phases')
+
+  def __init__(self):
+    self.start = self.last = time.perf_counter()
+    self.phases = {}
+
+  def Elapsed(self):
+    """Returns the number of seconds since the timer was started."""
+    return time.perf_counter() - self.start
+
+  def Mark(self, phase):
+    """Assigns the time since the previous mark to the given phase."""
+    now = time.perf_counter()
+    self.phases[phase] = self.phases.get(phase, 0) + now - self.last
+    self.last = now
+
+  def Phase(self, phase):
+    """Returns a context manager that measures its block as `phase`."""
+    return _PhaseTimer(self, phase)
+
+
+class _NullPhase(object):
+  """Context manager that does nothing, used when no timer is active."""
+  __slots__ = ()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    pass
+
+
+class NullTimer(object):
+  """A RequestTimer stand-in that records nothing."""
+  __slots__ = ()
+  phases = {}
+  NULL_PHASE = _NullPhase()
+
+  def Elapsed(self):
+    return 0.0
+
+  def Mark(self, phase):
+    pass
+
+  def Phase(self, phase):
+    return self.NULL_PHASE
+
+
+NULL_TIMER = NullTimer()
+
+
+def Activate(timer):
+  """Makes `timer` the timer of the request on the current thread."""
+  _local.timer = timer
+
+
+def Current():
+  """Returns the timer of the request on the current thread."""
+  return getattr(_local, 'timer', NULL_TIMER)
+
+
+def Phase(phase):
+  """Returns a context manager that times its block as a phase of the request.
+
+  This does nothing if there's no timer active on the current thread.
+  """
+  return Current().Phase(phase)
+
+
+def Timed(iterable, phase, timer=None):
+  """Yields from `iterable`, timing the production of each item as `phase`.
+
+  A streamed body is produced after the handler returned, while the server
+  sends it. The timer of the request (the current one by default) is therefore
+  made active while each item is produced, and the time the server spends
+  between items is not counted.
+  """
+  return _Timed(iter(iterable), phase, Current() if timer is None else timer)
+
+
+def _Timed(iterator, phase, timer):
+  """Generator for `Timed`, which picks the timer before iteration starts."""
+  try:
+    while True:
+      previous = Current()
+      Activate(timer)
+      try:
+        with timer.Phase(phase):
+          item = next(iterator)
+      except StopIteration:
+        return
+      finally:
+        Activate(previous)
+      yield item
+  finally:
+    if hasattr(iterator, 'close'):
+      iterator.close()
+
+
+class Metrics(object):
+  """Aggregates the timings and status codes of all requests."""
+  def __init__(self, buckets=DEFAULT_BUCKETS, sinks=()):
+    """Initializes a Metrics collection.
+
+    Arguments:
+      % buckets: tuple of float ~~ DEFAULT_BUCKETS
+        Upper bounds (in seconds) of the histogram buckets.
+      % sinks: iterable ~~ ()
+        Objects with a `Record(route, status, duration, phases)` method, that
+        are given every request as it is recorded.
+    """
+    self.buckets = tuple(buckets)
+    self.sinks = list(sinks)
+    self.routes = {}
+    self.phases = {}
+    self.statuses = {}
+    self.started = time.time()
+    self._lock = threading.Lock()
+
+  def Record(self, route, status, duration, phases):
+    """Records a completed request.
+
+    Arguments:
+      @ route: str
+        The name of the handler that served the request.
+      @ status: int
+        The HTTP status code of the response.
+      @ duration: float
+        The time in seconds it took to handle the request.
+      @ phases: dict
+        The time in seconds spent in each phase of the request.
+    """
+    with self._lock:
+      histogram = self.routes.get(route)
+      if histogram is None:
+        histogram = self.routes[route] = Histogram(self.buckets)
+      histogram.Observe(duration)
+      for phase, seconds in phases.items():
+        histogram = self.phases.get(phase)
+        if histogram is None:
+          histogram = self.phases[phase] = Histogram(self.buckets)
+        histogram.Observe(seconds)
+      self.statuses[status] = self.statuses.get(status, 0) + 1
+    for sink in self.sinks:
+      sink.Record(route, status, duration, phases)
+
+  def Snapshot(self):
+    """Returns all metrics as a dictionary."""
+    with self._lock:
+      return {
+          'uptime': time.time() - self.started,
+          'requests': sum(self.statuses.values()),
+          'statuses': dict(self.statuses),
+          'routes': {route: histogram.Snapshot()
+                     for route, histogram in self.routes.items()},
+          'phases': {phase: histogram.Snapshot()
+                     for phase, histogram in self.phases.items()}}
+
+  def Prometheus(self):
+    """Returns all metrics in the Prometheus text exposition format."""
+    lines = ['# TYPE uweb3_requests_total counter']
+    with self._lock:
+      for status, count in sorted(self.statuses.items()):
+        lines.append('uweb3_requests_total{status="%d"} %d' % (status, count))
+      for name, label, histograms in (
+          ('uweb3_request_duration_seconds', 'route', self.routes),
+          ('uweb3_phase_duration_seconds', 'phase', self.phases)):
+        lines.append('# TYPE %s histogram' % name)
+        for key, histogram in sorted(histograms.items()):
+          key = _EscapeLabel(key)
+          for bound, count in histogram.Cumulative():
+            lines.append('%s_bucket{%s="%s",le="%s"} %d' % (
+                name, label, key, '+Inf' if bound == float('inf') else bound,
+                count))
+          lines.append('%s_sum{%s="%s"} %f' % (name, label, key, histogram.sum))
+          lines.append('%s_count{%s="%s"} %d' % (
+              name, label, key, histogram.count))
+    return '\n'.join(lines) + '\n'
+
+
+class StatsdSink(object):
+  """Sends the timings and status of each request to statsd, over UDP.
+
+  All metrics of a request are sent in a single datagram. Sending never blocks
+  the request and errors (like an unreachable server) are ignored.
+  """
+  def __init__(self, host='localhost', port=8125, prefix='uweb3'):
+    self.address = host, int(port)
+    self.prefix = prefix
+    self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.socket.setblocking(False)
+
+  def Record(self, route, status, duration, phases):
+    lines = ['%s.route.%s:%.3f|ms' % (self.prefix, route, duration * 1000),
+             '%s.status.%d:1|c' % (self.prefix, status)]
+    for phase, seconds in phases.items():
+      lines.append('%s.phase.%s:%.3f|ms' % (self.prefix, phase, seconds * 1000))
+    try:
+      self.socket.sendto('\n'.join(lines).encode('utf8'), self.address)
+    except OSError:
+      pass
+
+
+def _EscapeLabel(value):
+  """Escapes a Prometheus label value."""
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -26,6 +26,8 @@ type. Handy escape() functions are present to do manual escaping if required.
 __author__ = 'Jan Klopper (jan@underdark.nl)'
 __version__ = 0.1
 
+import functools
+import hashlib
 import html
 from json import JSONEncoder
 import json
@@ -51,6 +53,14 @@ class Basesafestring(str):
         self.__upgrade__(other)))
     return self.__class__(data)
 
+  @functools.cached_property
+  def content_hash(self):
+    """The MD5 hex digest of the (UTF-8 encoded) string.
+
+    This is computed when it is first used, and then kept on the instance.
+    """
+    return hashlib.md5(self.encode()).hexdigest()
+
   def __upgrade__(self, other):
     """Upgrade a given object to be as safe, and in the same safety context as
     the current object"""
@@ -5,12 +5,16 @@ Functions:
   Connect: Connects to a MySQL server and returns a connection object.
            Refer to the documentation enclosed in the connections module for
            argument information.
+
+Classes:
+  ConnectionPool: A thread-safe pool of connections, see the pool module.
 """
 __author__ = 'Jan Klopper <jan@underdark.nl>'
 __version__ = '0.10'
 
 # Application specific modules
 from . import connection
+from .pool import ConnectionPool, PoolError, PoolTimeoutError
 
 def Connect(*args, **kwargs):
   """Factory function for connection.Connection."""
@@ -8,17 +8,77 @@ __author__ = ('Elmer de Looff <elmer@underdark.nl>',
 __version__ = '0.17'
 
 # Standard modules
+import collections
 import pymysql
 import logging
+import re
 import threading
+import time
 import weakref
 
 # Application specific modules
 from pymysql import constants
 from pymysql import converters
+from pymysql.constants import CR
 from . import cursor
 from .. import sqlresult
 
+# Client errors after which the connection to the server is gone.
+CONNECTION_LOST_ERRORS = frozenset((
+    CR.CR_SERVER_GONE_ERROR, CR.CR_SERVER_LOST, CR.CR_CONN_HOST_ERROR))
+
+# Statements that can be repeated on a new connection without side effects.
+IDEMPOTENT_STATEMENTS = (b'SELECT', b'SHOW', b'DESCRIBE', b'DESC', b'EXPLAIN')
+
+# Quoted literals, parameter placeholders and escaped percent signs in
+# parameterized queries.
+PLACEHOLDER = re.compile(
+    r"""('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|`[^`]*`|%s|%%)""", re.S)
+
+
+class Statement(object):
+  """A parameterized query, split around its placeholders and encoded.
+
+  Placeholders are written as `%s`, a literal percent sign as `%%`, also
+  within quoted literals. Binding parameters only escapes and encodes the
+  parameters, the query text itself is parsed and encoded once.
+  """
+  __slots__ = 'query', 'parts', 'params'
+
+  def __init__(self, query, charset):
+    self.query = query
+    parts = ['']
+    for token in PLACEHOLDER.split(query):
+      if token == '%s':
+        parts.append('')
+      elif token == '%%':
+        parts[-1] += '%'
+      elif token[:1] in ('\'', '"', '`'):
+        literal = token.split('%%')
+        if any('%s' in piece for piece in literal):
+          raise pymysql.ProgrammingError(
+              'Placeholder in quoted literal %s; placeholders may not be quoted, '
+              'and a literal percent sign must be doubled (%%%%).' % token)
+        parts[-1] += '%'.join(literal)
+      else:
+        parts[-1] += token
+    self.parts = [part.encode(charset) for part in parts]
+    self.params = len(parts) - 1
+
+  def Bind(self, connection, params):
+    """Returns the query with the escaped parameters in its placeholders."""
+    if len(params) != self.params:
+      raise connection.ProgrammingError(
+          'Query has %d placeholders, but %d parameters were given.' % (
+              self.params, len(params)))
+    query = [self.parts[0]]
+    for param, part in zip(params, self.parts[1:]):
+      query.append(
+          connection.escape(param, connection.encoders).encode(
+              connection.charset))
+      query.append(part)
+    return b''.join(query)
+
 
 class Connection(pymysql.connections.Connection):
   """MySQL Database Connection Object"""
@@ -65,6 +125,12 @@ class Connection(pymysql.connections.Connection):
                           be raised.
       local_infile:       bool, True enables LOAD LOCAL INFILE, False disables.
                           Default False
+      ping_interval:      number of seconds the connection can be idle before
+                          it is checked for liveness (and reconnected) at the
+                          start of the next transaction. Default 30.
+      statement_cache_size:
+                          integer, number of parsed parameterized queries
+                          kept for reuse. Default 0, which disables the cache.
 
     There are a number of undocumented, non-standard arguments. See the
     documentation for the MySQL C API for some hints on what they do.
@@ -76,6 +142,11 @@ class Connection(pymysql.connections.Connection):
     self.transaction_timer = None
     self.lock = threading.Lock()
     self._charset = None
+    self.ping_interval = kwargs.pop('ping_interval', 30)
+    self.last_used = time.monotonic()
+    self.check_connection = False
+    self.statement_cache_size = kwargs.pop('statement_cache_size', 0)
+    self.statements = collections.OrderedDict()
 
     # PyMySQL connect args mapping
     kwargs['user'] = user
@@ -170,7 +241,8 @@ class Connection(pymysql.connections.Connection):
     if self.lock.acquire():  # This will block when the lock is in use. In normal situations this should never happen.
       self.counter_transactions += 1
       del self.queries[:]
-      self._SetAutocommitState(self.autocommit)
+      self._EnsureConnected()
+      self._SetAutocommitState(self.autocommit_mode)
       self.StartTransactionTimer()
       return cursor.Cursor(self)
     raise self.OperationalError(
@@ -229,12 +301,27 @@ class Connection(pymysql.connections.Connection):
             'server': self.ServerInfo()}
 
   def Query(self, query_string, cur=None):
+    """Executes the query and returns its result as a ResultSet.
+
+    Should the connection turn out to be lost, idempotent reads are retried
+    once on a new connection, provided that no earlier statements of the
+    transaction would be lost by reconnecting.
+    """
     self.counter_queries += 1
     if isinstance(query_string, str):
       query_string = query_string.encode(self.charset)
     if not cur:
       cur = cursor.Cursor(self)
-    cur.execute(query_string)
+    try:
+      cur.execute(query_string)
+    except (self.OperationalError, self.InterfaceError) as error:
+      self.check_connection = True
+      if not (self._ConnectionLost(error) and self._Retryable(query_string)):
+        raise
+      self.logger.warning('Connection lost, retrying query on a new connection.')
+      self._Reconnect()
+      cur.execute(query_string)
+    self.last_used = time.monotonic()
     stored_result = cur.fetchall()
     if stored_result:
       fields = list(stored_result[0])
@@ -248,6 +335,23 @@ class Connection(pymysql.connections.Connection):
         query=query_string.decode(self.charset, 'ignore'),
         result=stored_result)
 
+  def Prepare(self, query):
+    """Returns the Statement for a parameterized query.
+
+    With a statement cache, Statements are kept (by query text) for reuse,
+    discarding the least recently used one when the cache is full.
+    """
+    if not self.statement_cache_size:
+      return Statement(query, self.charset)
+    statement = self.statements.get(query)
+    if statement is None:
+      statement = self.statements[query] = Statement(query, self.charset)
+      if len(self.statements) > self.statement_cache_size:
+        self.statements.popitem(last=False)
+    else:
+      self.statements.move_to_end(query)
+    return statement
+
   def ServerInfo(self):
     """Returns a mysql specific set of server information"""
     return self.get_server_info()
@@ -280,6 +384,51 @@ class Connection(pymysql.connections.Connection):
     if self.transaction_timer:
       self.transaction_timer.cancel()
 
+  def ping(self, reconnect=False):
+    """Checks whether the server is alive, see pymysql's ping."""
+    super(Connection, self).ping(reconnect=False)
+    self.last_used = time.monotonic()
+    self.check_connection = False
+
+  def _EnsureConnected(self):
+    """Makes sure the connection is usable before a transaction starts.
+
+    The server is only pinged when the connection has been idle for longer
+    than `ping_interval`, or when a previous query failed on a connection
+    error. A connection that is found to be dead is reconnected.
+    """
+    if (self._sock is not None and not self.check_connection and
+        time.monotonic() - self.last_used < self.ping_interval):
+      return
+    try:
+      self.ping()
+    except (self.Error, OSError):
+      self._Reconnect()
+
+  def _Reconnect(self):
+    """Opens a new connection to the server, replacing the current one."""
+    if self._sock is not None:
+      self._force_close()
+    self.connect()
+    self.last_used = time.monotonic()
+    self.check_connection = False
+
+  def _ConnectionLost(self, error):
+    """Returns whether the error means the connection to the server is gone."""
+    if isinstance(error, self.InterfaceError):
+      return True
+    return bool(error.args) and error.args[0] in CONNECTION_LOST_ERRORS
+
+  def _Retryable(self, query_string):
+    """Returns whether the query can safely be repeated on a new connection.
+
+    This is the case for reads, when they are the first statement of the
+    transaction or when the connection is in autocommit mode.
+    """
+    if not query_string.lstrip().upper().startswith(IDEMPOTENT_STATEMENTS):
+      return False
+    return self.autocommit_mode or len(self.queries) <= 1
+
   def _GetAutocommitState(self):
     """This returns the current setting for autocommiting transactions."""
     return self.autocommit_mode
@@ -294,13 +443,13 @@ class Connection(pymysql.connections.Connection):
   def _SetAutocommitState(self, state):
     """This sets the autocommit mode on the connection.
 
-    This is False by default if the database supports transactions."""
-    try:
-      self.ping(reconnect=True)
-    except:
-      self.connect(sock=None)
-    super(Connection, self).autocommit(state)
-    self.autocommit_mode = state
+    This is False by default if the database supports transactions.
+
+    The server's status, which is sent along with every reply, tells the
+    current mode, so the mode is only sent when it actually changes."""
+    self.autocommit_mode = bool(state)
+    if self.autocommit_mode != self.get_autocommit():
+      self._send_autocommit_mode()
 
   def _SetCharacterSet(self, charset):
     """This sets the character set, refer to _GetCharacterSet for doc."""
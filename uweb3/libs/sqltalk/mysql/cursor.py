@@ -8,6 +8,13 @@ import warnings
 import weakref
 import pymysql
 
+# Application specific modules
+from .. import sqlresult
+
+# Multi-row inserts are split in statements of at most this many bytes. This
+# stays well below the max_allowed_packet of any MySQL server configuration.
+MAX_INSERT_SIZE = 1 << 20
+
 class ReturnObject(tuple):
   """An object that functions as a tuple but has more required attributes."""
 
@@ -37,7 +44,7 @@ class Cursor(pymysql.cursors.DictCursor):
     self._warnings_handled = False
     self._connection = weakref.ref(connection)
 
-  def _Execute(self, query):
+  def _Execute(self, query, params=None):
     """Actually executes the query and returns the result of it.
 
     Arguments:
@@ -45,14 +52,17 @@ class Cursor(pymysql.cursors.DictCursor):
         Fully formatted sql statement to execute. In case of unicode, the
         string is encoded to the local character set before it is passed on
         to the server.
+      % params: sequence ~~ None
+        Values for the `%s` placeholders in the query. These are escaped and
+        bound to the placeholders, see `Connection.Prepare`. Without params,
+        the query is executed as is.
 
     Returns:
       sqlresult.ResultSet instance holding all query result data.
     """
-    # TODO(Elmer): Fix this so that arguments can be given independent of the
-    # query they belong to. This enables proper SelectTables and enables a host
-    # of other escaping things to start working properly.
-    #   Refer to MySQLdb.cursor code (~line 151) to see how this works.
+    if params is not None:
+      connection = self.connection
+      query = connection.Prepare(query.strip()).Bind(connection, params)
     self._LogQuery(query)
     return self.connection.Query(query.strip(), self)
 
@@ -116,7 +126,7 @@ class Cursor(pymysql.cursors.DictCursor):
       return ', '.join(field_escape(table))
 
   def Delete(self, table, conditions, order=None,
-             limit=None, offset=0, escape=True):
+             limit=None, offset=0, escape=True, params=None):
     """Remove row(s) from table that match conditions, up to limit.
 
     Arguments:
@@ -135,6 +145,8 @@ class Cursor(pymysql.cursors.DictCursor):
       escape:     boolean. Defines whether table and field names should be
                   escaped. Set this to False if you want to make use of MySQL
                   functions on this query. Default True.
+      params:     list/tuple (optional). Values for the %s placeholders in the
+                  conditions, these are escaped for you.
 
     Returns:
       sqlresult.ResultSet object.
@@ -144,7 +156,7 @@ class Cursor(pymysql.cursors.DictCursor):
         self._StringTable(table, field_escape),
         self._StringConditions(conditions, field_escape),
         self._StringOrder(order, field_escape),
-        self._StringLimit(limit, offset)))
+        self._StringLimit(limit, offset)), params)
 
   def Describe(self, table, field=''):
     """Describe table in database or field in table.
@@ -160,9 +172,9 @@ class Cursor(pymysql.cursors.DictCursor):
         self._StringTable(table, self.connection.EscapeField),
         self._StringFields(field, self.connection.EscapeField)))
 
-  def Execute(self, query):
-    """Executes a raw query."""
-    return self._Execute(query)
+  def Execute(self, query, params=None):
+    """Executes a raw query, binding `params` to its `%s` placeholders."""
+    return self._Execute(query, params)
 
   def Insert(self, table, values, escape=True):
     """Insert new row into table.
@@ -185,26 +197,77 @@ class Cursor(pymysql.cursors.DictCursor):
                MySQL functions on this query. Default True.
 
     Returns:
-      sqlresult.ResultSet object.
+      sqlresult.ResultSet object. For multi-row inserts, `affected` holds the
+      total number of inserted rows, and `insertid` that of the first one.
     """
     if not values:
       raise ValueError('Must insert 1 or more value')
+    if not isinstance(values, dict):
+      # Multi-row insert
+      results = self.InsertMany(table, values, escape=escape)
+      return sqlresult.ResultSet(
+          query=results[0].query, charset=results[0].charset,
+          affected=sum(result.affected for result in results),
+          insertid=results[0].insertid)
     values = self.connection.EscapeValues(values) if escape else values
     table = self.connection.EscapeField(table) if escape else table
-    try:
-      # Single insert
-      values = ', '.join('`%s`=%s' % value for value in values.items())
-      query = 'INSERT INTO %s SET %s' % (table, values)
-    except AttributeError:
-      # Multi-row insert
-      fields = ', '.join(map(self.connection.EscapeField, values[0]))
-      values = ', '.join('(%s)' % ', '.join(row.itervalues()) for row in values)
-      query = 'INSERT INTO %s (%s) VALUES %s' % (table, fields, values)
-    return self._Execute(query)
+    values = ', '.join('`%s`=%s' % value for value in values.items())
+    return self._Execute('INSERT INTO %s SET %s' % (table, values))
+
+  def InsertMany(self, table, rows, escape=True, max_size=MAX_INSERT_SIZE):
+    """Inserts rows into table, using as few multi-row inserts as possible.
+
+    The rows are split over multiple INSERT statements when a single statement
+    would grow beyond `max_size` bytes.
+
+    Arguments:
+      table:    string. Name of the table to insert into.
+      rows:     list/tuple of dictionaries. Each record as a dictionary, all
+                with the same keys (fields).
+      escape:   boolean. Defines whether table names, fields and values should
+                be escaped. Default True.
+      max_size: integer. Maximum size of a single statement in bytes. This
+                should not exceed the server's max_allowed_packet.
+
+    Returns:
+      list of sqlresult.ResultSet objects, one per statement. For each, the
+      `insertid` is that of the first row in the statement, which MySQL assigns
+      consecutive values for the statement's rows.
+    """
+    if not rows:
+      raise ValueError('Must insert 1 or more value')
+    connection = self.connection
+    fields = list(rows[0])
+    if escape:
+      table = connection.EscapeField(table)
+      escape_values = connection.EscapeValues
+    else:
+      escape_values = lambda values: values
+    prefix = 'INSERT INTO %s (%s) VALUES ' % (
+        table, ', '.join(map(connection.EscapeField, fields)))
+    results = []
+    chunk = []
+    size = len(prefix.encode(connection.charset))
+    for row in rows:
+      if len(row) != len(fields):
+        raise ValueError('All rows should have the same fields as the first.')
+      try:
+        values = '(%s)' % ', '.join(escape_values([row[field] for field in fields]))
+      except KeyError as error:
+        raise ValueError('Row is missing field %s.' % error)
+      values_size = len(values.encode(connection.charset)) + 2
+      if chunk and size + values_size > max_size:
+        results.append(self._Execute(prefix + ', '.join(chunk)))
+        chunk = []
+        size = len(prefix.encode(connection.charset))
+      chunk.append(values)
+      size += values_size
+    results.append(self._Execute(prefix + ', '.join(chunk)))
+    return results
 
   def Select(self, table, fields=None, conditions=None, order=None,
              group=None, limit=None, offset=0, escape=True, totalcount=False,
-             distinct=False):
+             distinct=False, params=None):
     """Select fields from table that match the conditions, ordered and limited.
 
     Arguments:
@@ -231,6 +294,8 @@ class Cursor(pymysql.cursors.DictCursor):
                   will have the full number of matching rows on
                   the affected_rows attribute of the resultset.
       distinct:   bool (optional). Performs a DISTINCT query if set to True.
+      params:     list/tuple (optional). Values for the %s placeholders in the
+                  conditions, these are escaped for you.
 
     Returns:
       sqlresult.ResultSet object.
@@ -244,7 +309,7 @@ class Cursor(pymysql.cursors.DictCursor):
         self._StringConditions(conditions, field_escape),
         self._StringGroup(group, field_escape),
         self._StringOrder(order, field_escape),
-        self._StringLimit(limit, offset)))
+        self._StringLimit(limit, offset)), params)
     if totalcount and limit is not None:
       result.affected = self._Execute('SELECT FOUND_ROWS()')[0][0]
     return result
@@ -286,7 +351,7 @@ class Cursor(pymysql.cursors.DictCursor):
         self._StringTable(table, self.connection.EscapeField)))
 
   def Update(self, table, values, conditions, order=None,
-             limit=None, offset=None, escape=True):
+             limit=None, offset=None, escape=True, params=None):
     """Updates table records to the new values where conditions are met.
 
     Arguments:
@@ -307,22 +372,32 @@ class Cursor(pymysql.cursors.DictCursor):
       escape:     boolean. Defines whether table names, fields and values should
                   be escaped. Set this to False if you want to make use of
                   MySQL functions on this query. Default True.
+      params:     list/tuple (optional). Values for the %s placeholders in the
+                  conditions. When given, escaped values are also bound to
+                  placeholders instead of being inlined in the query.
 
     Returns:
       sqlresult.ResultSet object.
     """
-    if escape:
+    if params is not None and escape:
+      field_escape = self.connection.EscapeField
+      assignments = ', '.join(
+          '%s=%%s' % field_escape(field) for field in values)
+      params = tuple(values.values()) + tuple(params)
+    elif escape:
       field_escape = self.connection.EscapeField
       values = self.connection.EscapeValues(values)
+      assignments = ', '.join('`%s`=%s' % value for value in values.items())
     else:
       field_escape = lambda x: x
+      assignments = ', '.join('`%s`=%s' % value for value in values.items())
 
     return self._Execute('UPDATE %s SET %s WHERE %s %s %s' % (
         self._StringTable(table, field_escape),
-        ', '.join('`%s`=%s' % value for value in values.items()),
+        assignments,
         self._StringConditions(conditions, field_escape),
         self._StringOrder(order, field_escape),
-        self._StringLimit(limit, offset)))
+        self._StringLimit(limit, offset)), params)
 
   def _ProcessWarnings(self, resultset):
     """Updates messages attribute with warnings given by the MySQL server."""
@@ -0,0 +1,237 @@
+#!/usr/bin/python3
+"""This module implements a thread-safe pool of MySQL connections.
+
+Connections are checked out of the pool for the duration of a request (or any
+other unit of work) and returned to it afterwards, so that concurrent threads
+each use their own connection instead of waiting for a single shared one.
+"""
+__author__ = 'Jan Klopper <jan@underdark.nl>'
+__version__ = '0.1'
+
+# Standard modules
+import collections
+import threading
+import time
+
+
+class PoolError(Exception):
+  """Base class for connection pool errors."""
+
+
+class PoolTimeoutError(PoolError):
+  """No connection became available within the configured timeout."""
+
+
+class PooledConnection(object):
+  """Bookkeeping for a connection that belongs to the pool."""
+  __slots__ = ('connection', 'created', 'last_used')
+
+  def __init__(self, connection):
+    self.connection = connection
+    self.created = self.last_used = time.monotonic()
+
+
+class ConnectionPool(object):
+  """A bounded pool of database connections.
+
+  Idle connections are handed out most recently used first, so that the number
+  of warm connections stays close to what the load requires, and surplus
+  connections hit their idle timeout.
+  """
+  def __init__(self, connect, min_size=0, max_size=10, idle_timeout=300,
+               max_lifetime=3600, health_check=30, timeout=10):
+    """Initializes the ConnectionPool.
+
+    Arguments:
+      @ connect: callable
+        Returns a new connection when called without arguments.
+      % min_size: int ~~ 0
+        The number of connections that is opened upfront, and that is kept
+        open regardless of the idle timeout.
+      % max_size: int ~~ 10
+        The maximum number of connections, idle and in use.
+      % idle_timeout: float ~~ 300
+        Seconds after which an idle connection is closed.
+      % max_lifetime: float ~~ 3600
+        Seconds after which a connection is closed (recycled) when it returns
+        to the pool, regardless of its use.
+      % health_check: float ~~ 30
+        Connections that have been idle for more than this many seconds are
+        pinged before they are handed out. 0 checks every checkout.
+      % timeout: float ~~ 10
+        Seconds to wait for a connection when all of them are in use.
+    """
+    self.connect = connect
+    self.min_size = min_size
+    self.max_size = max_size
+    self.idle_timeout = idle_timeout
+    self.max_lifetime = max_lifetime
+    self.health_check = health_check
+    self.timeout = timeout
+    self._idle = collections.deque()
+    self._pooled = {}  # id(connection) -> PooledConnection, for all connections
+    self._size = 0  # Open connections plus connections being opened.
+    self._condition = threading.Condition(threading.Lock())
+    self.counters = {'created': 0, 'recycled': 0, 'closed': 0, 'failed': 0,
+                     'checkouts': 0, 'waits': 0, 'timeouts': 0}
+    self.wait_time = 0.0
+    self.max_wait_time = 0.0
+    for connection in [self.Acquire() for _count in range(min_size)]:
+      self.Release(connection)
+
+  def Acquire(self, timeout=None):
+    """Returns a connection from the pool, opening a new one if needed.
+
+    Arguments:
+      % timeout: float ~~ None
+        Seconds to wait for a connection, defaults to the pool's timeout.
+
+    Raises:
+      PoolTimeoutError: no connection became available in time.
+    """
+    timeout = self.timeout if timeout is None else timeout
+    started = None
+    expired = []
+    with self._condition:
+      while True:
+        pooled = self._TakeIdle(expired)
+        if pooled is not None:
+          break
+        if self._size < self.max_size:
+          self._size += 1
+          break
+        if started is None:
+          started = time.monotonic()
+          self.counters['waits'] += 1
+        remaining = started + timeout - time.monotonic()
+        if remaining <= 0:
+          self.counters['timeouts'] += 1
+          self._CloseAll(expired)
+          raise PoolTimeoutError(
+              'No connection available within %s seconds' % timeout)
+        self._condition.wait(remaining)
+      self.counters['checkouts'] += 1
+      if started is not None:
+        waited = time.monotonic() - started
+        self.wait_time += waited
+        self.max_wait_time = max(self.max_wait_time, waited)
+    self._CloseAll(expired)
+    if pooled is not None:
+      if self._Healthy(pooled):
+        return pooled.connection
+      self._Discard(pooled)
+      with self._condition:
+        self._size += 1  # Open a replacement in the slot of the broken one.
+    return self._Open()
+
+  def Release(self, connection, broken=False):
+    """Returns a connection to the pool.
+
+    Connections that are broken, past their lifetime or still inside a
+    transaction are closed instead.
+
+    Arguments:
+      @ connection: Connection
+        A connection previously returned by Acquire.
+      % broken: bool ~~ False
+        Marks the connection as unusable, so it is closed.
+    """
+    pooled = self._pooled.get(id(connection))
+    if pooled is None:
+      return
+    lock = getattr(connection, 'lock', None)
+    if broken or (lock is not None and lock.locked()):
+      self._Discard(pooled)
+      return
+    now = time.monotonic()
+    if self.max_lifetime and now - pooled.created > self.max_lifetime:
+      self.counters['recycled'] += 1
+      self._Discard(pooled)
+      return
+    pooled.last_used = now
+    with self._condition:
+      self._idle.append(pooled)
+      self._condition.notify()
+
+  def Close(self):
+    """Closes all idle connections. Connections in use close when released."""
+    with self._condition:
+      idle = list(self._idle)
+      self._idle.clear()
+      self.max_lifetime = -1
+    for pooled in idle:
+      self._Discard(pooled)
+
+  def Stats(self):
+    """Returns a dictionary with the pool size and its usage counters."""
+    with self._condition:
+      stats = dict(self.counters,
+                   size=self._size,
+                   idle=len(self._idle),
+                   in_use=self._size - len(self._idle),
+                   max_size=self.max_size,
+                   wait_time=self.wait_time,
+                   max_wait_time=self.max_wait_time)
+    return stats
+
+  def _TakeIdle(self, expired):
+    """Returns the most recently used idle connection, or None.
+
+    Connections that have been idle for too long are moved to `expired`, and
+    their slots are freed; the caller closes them once the lock is released.
+
+    N.B. This must be called with the pool's condition held.
+    """
+    now = time.monotonic()
+    while self._idle and self._size > self.min_size:
+      if now - self._idle[0].last_used <= self.idle_timeout:
+        break
+      expired.append(self._idle.popleft())
+      self._size -= 1
+    return self._idle.pop() if self._idle else None
+
+  def _CloseAll(self, expired):
+    """Closes the given connections, whose slots were already freed."""
+    for pooled in expired:
+      self._Close(pooled)
+
+  def _Healthy(self, pooled):
+    """Returns whether the connection is still usable, pinging it if needed."""
+    if time.monotonic() - pooled.last_used < self.health_check:
+      return True
+    try:
+      pooled.connection.ping(reconnect=False)
+      return True
+    except Exception:
+      self.counters['failed'] += 1
+      return False
+
+  def _Open(self):
+    """Opens a new connection in a slot that was already reserved."""
+    try:
+      connection = self.connect()
+    except Exception:
+      with self._condition:
+        self._size -= 1
+        self._condition.notify()
+      raise
+    pooled = PooledConnection(connection)
+    self._pooled[id(connection)] = pooled
+    self.counters['created'] += 1
+    return connection
+
+  def _Discard(self, pooled):
+    """Closes a connection and frees its slot in the pool."""
+    self._Close(pooled)
+    with self._condition:
+      self._size -= 1
+      self._condition.notify()
+
+  def _Close(self, pooled):
+    """Closes the connection, ignoring errors from already broken ones."""
+    self._pooled.pop(id(pooled.connection), None)
+    self.counters['closed'] += 1
+    try:
+      pooled.connection.close()
+    except Exception:
+      pass
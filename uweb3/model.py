@@ -2,6 +2,7 @@
 """uWeb3 model base classes."""
 
 # Standard modules
+import base64
 import os
 import datetime
 import simplejson
@@ -36,6 +37,32 @@ class PermissionError(Error):
   """The entity has insufficient rights to access the resource."""
 
 
+class Page(list):
+  """A page of records, as returned by `Record.Paginate`.
+
+  Members:
+    % cursor: str
+      Opaque token that continues the listing after the last record of this
+      page, to be passed to `Paginate`. None on the last page.
+    % total: int
+      The estimated number of records on all pages, if it was requested.
+  """
+  def __init__(self, records, cursor=None, total=None):
+    super(Page, self).__init__(records)
+    self.cursor = cursor
+    self.total = total
+
+
+def _ConnectionFor(connection, model_class):
+  """Returns the database connection for `model_class` out of `connection`.
+
+  For a ConnectionManager this is the connection of the connector the class is
+  bound to (see `_CONNECTOR`), other connections are returned as is.
+  """
+  bind = getattr(type(connection), 'For', None)
+  return connection if bind is None else bind(connection, model_class)
+
+
 class SettingsManager(object):
   def __init__(self, filename=None, executing_path=None):
     """Creates a ini file with the child class name
@@ -157,7 +184,8 @@ class SecureCookie(object):
   def __init__(self, connection):
     """Create a new SecureCookie instance."""
     self.connection = connection
-    self.req, self.cookies, self.cookie_salt = self.connection
+    self.req, self.cookies, self.cookie_salt = _ConnectionFor(connection,
+                                                              type(self))
     self.rawcookie = self.__GetCookie()
     self.debug = self.connection.debug
     if self.debug:
@@ -234,7 +262,7 @@ class SecureCookie(object):
       ValueError: When cookie with name already exists
     """
     cls.connection = connection
-    cls.req, cls.cookies, cls.cookie_salt = connection
+    cls.req, cls.cookies, cls.cookie_salt = _ConnectionFor(connection, cls)
     name = cls.TableName()
     cls.rawcookie = data
 
@@ -522,6 +550,11 @@ class BaseRecord(dict):
   def _PostDelete(self):
     """Hook that runs after deleting a Record in the database."""
 
+  @classmethod
+  def _Bound(cls, connection):
+    """Returns the connection of the connector this class is bound to."""
+    return _ConnectionFor(connection, cls)
+
   # ############################################################################
   # Base record functionality methods, to be implemented by subclasses.
   # Some methods have a generic implementation, but may need customization,
@@ -707,6 +740,12 @@ class Record(BaseRecord):
   """Extensions to the Record abstraction for relational database use."""
   _FOREIGN_RELATIONS = {}
   _CONNECTOR = 'mysql'
+  # When True, records loaded during a request are kept in the request's
+  # IdentityMap, and loading the same record again returns the same instance.
+  _IDENTITY_MAP = False
+  # When True, the rows of loaded records are kept in the ModelCache, which is
+  # shared between requests, and FromPrimary looks there before querying.
+  _CACHE = False
   SEARCHABLE_COLUMNS = []
 
   # ############################################################################
@@ -822,6 +861,151 @@ class Record(BaseRecord):
       return cls._LoadAsForeign(self.connection, value, method=loader)
     return GetRecordClass(foreign_cls)._LoadAsForeign(self.connection, value)
 
+  @classmethod
+  def _IdentityMap(cls, connection):
+    """Returns the IdentityMap to use for this class, or None."""
+    if not cls._IDENTITY_MAP:
+      return None
+    identity_map = getattr(type(connection), 'IdentityMap', None)
+    return None if identity_map is None else identity_map(connection)
+
+  @classmethod
+  def _ModelCache(cls, connection):
+    """Returns the ModelCache to use for this class, or None."""
+    if not cls._CACHE:
+      return None
+    model_cache = getattr(type(connection), 'ModelCache', None)
+    return None if model_cache is None else model_cache(connection)
+
+  @classmethod
+  def _Cached(cls, connection, key):
+    """Returns the record for the given primary key if it is cached, or None.
+
+    The IdentityMap of the request is looked at first, then the ModelCache.
+    Records that come from the ModelCache are added to the IdentityMap.
+    """
+    identity_map = cls._IdentityMap(connection)
+    if identity_map is not None:
+      record = identity_map.Get(cls.TableName(), key)
+      if record is not None:
+        return record
+    model_cache = cls._ModelCache(connection)
+    if model_cache is not None:
+      row = model_cache.Get(cls.TableName(), key)
+      if row is not None:
+        record = cls(connection, row)
+        if identity_map is not None:
+          identity_map.Add(record)
+        return record
+    return None
+
+  @classmethod
+  def _Invalidate(cls, connection, key):
+    """Removes the record with the given primary key from all caches."""
+    for store in (cls._IdentityMap(connection), cls._ModelCache(connection)):
+      if store is not None:
+        store.Discard(cls.TableName(), key)
+
+  @classmethod
+  def _ForeignClass(cls, field):
+    """Returns the class and load method of the records that `field` refers to.
+
+    This follows the rules of `_LoadForeign`. If the field does not refer to
+    other records, (None, None) is returned.
+    """
+    if field in cls._FOREIGN_RELATIONS:
+      foreign_cls = cls._FOREIGN_RELATIONS[field]
+      loader = None
+      if type(foreign_cls) is dict:
+        loader = foreign_cls.get('loader')
+        foreign_cls = foreign_cls['class']
+      if isinstance(foreign_cls, str):
+        foreign_cls = getattr(sys.modules[cls.__module__], foreign_cls, None)
+      if not (isinstance(foreign_cls, type) and issubclass(foreign_cls, Record)):
+        return None, None
+      return foreign_cls, loader
+    if field != cls.TableName() and field in cls._SUBTYPES:
+      return cls._SUBTYPES[field], None
+    return None, None
+
+  @classmethod
+  def _Preload(cls, connection, records, preload):
+    """Loads the foreign records of the given records in batches.
+
+    For each field to preload, the foreign key values of all records are
+    collected and the referenced records are loaded with a single query. The
+    loaded records then replace the keys in the records. Nested fields are
+    preloaded on the loaded records in the same way.
+
+    Arguments:
+      @ connection: object
+        Database connection to use.
+      @ records: list of Record
+        The records whose foreign relations should be loaded.
+      @ preload: iterable of str
+        The fields to load. Foreign relations of those are loaded by giving
+        a dotted path, e.g. 'customer.address'.
+    """
+    if isinstance(preload, str):
+      preload = [preload]
+    nested = {}
+    for path in preload:
+      field, _sep, rest = path.partition('.')
+      nested.setdefault(field, [])
+      if rest:
+        nested[field].append(rest)
+    for field, subpaths in nested.items():
+      foreign_cls, loader = cls._ForeignClass(field)
+      if foreign_cls is None:
+        continue
+      keys = set()
+      for record in records:
+        value = dict.get(record, field)
+        if value is not None and not isinstance(value, BaseRecord):
+          keys.add(value)
+      loaded = foreign_cls._LoadManyAsForeign(connection, keys, method=loader)
+      related = {}
+      for record in records:
+        value = dict.get(record, field)
+        if value is None or isinstance(value, BaseRecord):
+          pass
+        elif loaded is None:
+          # Relations that can't be loaded in a batch are loaded one by one.
+          value = record[field]
+        elif value in loaded:
+          value = record[field] = loaded[value]
+        if isinstance(value, Record):
+          related[id(value)] = value
+      if subpaths and related:
+        foreign_cls._Preload(connection, list(related.values()), subpaths)
+
+  @classmethod
+  def _LoadManyAsForeign(cls, connection, values, method=None):
+    """Loads the records for the given foreign key values with a single query.
+
+    Returns a dictionary of the loaded records by key value, or None if the
+    load method does not allow loading in a batch.
+    """
+    method = method or cls._LOAD_METHOD
+    if method != 'FromPrimary' or isinstance(cls._PRIMARY_KEY, tuple):
+      return None
+    loaded = {}
+    if cls._IDENTITY_MAP or cls._CACHE:
+      for value in values:
+        record = cls._Cached(connection, value)
+        if record is not None:
+          loaded[value] = record
+      values = set(values).difference(loaded)
+      if loaded and not values and cls._ModelCache(connection) is not None:
+        cls._ModelCache(connection).QuerySaved()
+    if values:
+      records = cls.List(
+          connection, conditions='`%s`.`%s` IN %%s' % (
+              cls.TableName(), cls._PRIMARY_KEY),
+          params=(tuple(values),))
+      loaded.update((record.key, record) for record in records)
+    return loaded
+
   # ############################################################################
   # Override basic dict methods so that autoload mechanisms function on them.
   #
@@ -875,7 +1059,7 @@ class Record(BaseRecord):
   @classmethod
   def _FromParent(cls, parent, relation_field=None, conditions=None,
                  limit=None, offset=None, order=None,
-                 yield_unlimited_total_first=False):
+                 yield_unlimited_total_first=False, preload=None):
     """Returns all `cls` objects that are a child of the given parent.
 
     This utilized the parent's _Children method, with either this class'
@@ -903,31 +1087,36 @@ class Record(BaseRecord):
       % yield_unlimited_total_first: bool ~~ False
         Instead of yielding only Record objects, the first item returned is the
         number of results from the query if it had been executed without limit.
+      % preload: iterable of str ~~ None
+        Foreign relations to load for all records at once, see `List`.
     """
     if not isinstance(parent, Record):
       raise TypeError('parent argument should be a Record type.')
     relation_field = relation_field or parent.TableName()
-    relation_value = parent.connection.EscapeValues(cls._ValueOrPrimary(parent))
-    qry_conditions = ['`%s` = %s' % (relation_field, relation_value)]
+    qry_conditions = ['`%s` = %%s' % relation_field]
     if conditions:
+      # The conditions are literal SQL, percent signs should not be mistaken
+      # for placeholders.
       if isinstance(conditions, str):
-        qry_conditions.append(conditions)
-      else:
-        qry_conditions.extend(conditions)
+        conditions = [conditions]
+      qry_conditions.extend(
+          condition.replace('%', '%%') for condition in conditions)
 
     firstrow = yield_unlimited_total_first # set a flag to skip the linking of
     # the first row to our parent, as that will be the full record cound instead
     # of a record
     for record in cls.List(parent.connection, conditions=qry_conditions,
         limit=limit, offset=offset, order=order,
-        yield_unlimited_total_first=yield_unlimited_total_first):
+        yield_unlimited_total_first=yield_unlimited_total_first,
+        params=(cls._ValueOrPrimary(parent),), preload=preload):
       if not firstrow:
         record[relation_field] = parent.copy()
       firstrow = False
       yield record
 
   def _Children(self, child_class, relation_field=None, conditions=None,
-    limit=None, offset=None, order=None, yield_unlimited_total_first=False):
+    limit=None, offset=None, order=None, yield_unlimited_total_first=False,
+    preload=None):
     """Returns all `child_class` objects related to this record.
 
     The table for the given `child_class` will be queried for all fields where
@@ -956,6 +1145,8 @@ class Record(BaseRecord):
       % yield_unlimited_total_first: bool ~~ False
         Instead of yielding only Record objects, the first item returned is the
         number of results from the query if it had been executed without limit.
+      % preload: iterable of str ~~ None
+        Foreign relations to load for all children at once, see `List`.
     """
     # Delegating to let child class handle its own querying. These are methods
     # for development, and are private only to prevent name collisions.
@@ -963,7 +1154,8 @@ class Record(BaseRecord):
     return child_class._FromParent(
         self, relation_field=relation_field, conditions=conditions,
         limit=limit, offset=offset, order=order,
-        yield_unlimited_total_first=yield_unlimited_total_first)
+        yield_unlimited_total_first=yield_unlimited_total_first,
+        preload=preload)
 
   def _DeleteChildren(self, child_class, relation_field=None):
     """Deletes all `child_class` objects related to this record.
@@ -979,11 +1171,129 @@ class Record(BaseRecord):
         table for this record.
     """
     relation_field = relation_field or self.TableName()
-    with self.connection as cursor:
-      safe_key = self.connection.EscapeValues(self.key)
+    with self._Bound(self.connection) as cursor:
+      safe_key = self._Bound(self.connection).EscapeValues(self.key)
       cursor.Delete(table=child_class.TableName(),
                     conditions='`%s`=%s' % (relation_field, safe_key))
 
+  @classmethod
+  def _PrimaryKeyPlaceholders(cls, value):
+    """Returns the primary key condition with placeholders, and its values."""
+    if isinstance(cls._PRIMARY_KEY, tuple):
+      if not isinstance(value, tuple):
+        raise TypeError(
+            'Compound keys should be loaded using a tuple of key values.')
+      if len(value) != len(cls._PRIMARY_KEY):
+        raise ValueError('Not enough values (%d) for compound key.', len(value))
+      return (' AND '.join('`%s` = %%s' % field for field in cls._PRIMARY_KEY),
+              tuple(map(cls._ValueOrPrimary, value)))
+    return ('`%s`.`%s` = %%s' % (cls.TableName(), cls._PRIMARY_KEY),
+            (cls._ValueOrPrimary(value),))
+
+  @classmethod
+  def _KeysetOrder(cls, order):
+    """Returns the order as (field, descending) pairs, ending in the primary key.
+
+    The primary key makes the order unique, so every record has a definite
+    position for keyset pagination to continue after.
+    """
+    rules = []
+    for rule in order or ():
+      if isinstance(rule, str):
+        rules.append((rule, False))
+      else:
+        rules.append((rule[0], bool(rule[1])))
+    ordered = {field.rsplit('.', 1)[-1] for field, _descending in rules}
+    keys = (cls._PRIMARY_KEY if isinstance(cls._PRIMARY_KEY, tuple) else
+            (cls._PRIMARY_KEY,))
+    for key in keys:
+      if key not in ordered:
+        rules.append(('%s.%s' % (cls.TableName(), key), False))
+    return rules
+
+  @classmethod
+  def _KeysetCondition(cls, rules, after, field_escape):
+    """Returns the condition and its values that select the rows after `after`.
+
+    Arguments:
+      @ rules: list of 2-tuples
+        The (field, descending) pairs from `_KeysetOrder`.
+      @ after: obj / tuple
+        The values of the ordering fields of the last row before the page.
+        If the order is on a single field, a single value is accepted.
+      @ field_escape: callable
+        Escapes the field names.
+    """
+    values = tuple(after) if isinstance(after, (tuple, list)) else (after,)
+    if len(values) != len(rules):
+      raise Error('Keyset pagination requires %d values to continue after, '
+                  'got %d.' % (len(rules), len(values)))
+    values = tuple(map(cls._ValueOrPrimary, values))
+    fields = [field_escape(field) for field, _descending in rules]
+    if None not in values and not any(desc for _field, desc in rules):
+      # Row constructor comparisons can use a composite index directly. NULLs
+      # sort first, so rows with NULLs in the ordering come before the values.
+      return '(%s) > (%s)' % (', '.join(fields),
+                              ', '.join(['%s'] * len(fields))), values
+    # MySQL sorts NULL before other values, so after them in descending order.
+    alternatives = []
+    params = []
+    for index, (field, (_name, descending)) in enumerate(zip(fields, rules)):
+      comparisons = []
+      arguments = []
+      for previous, value in zip(fields[:index], values):
+        if value is None:
+          comparisons.append('%s IS NULL' % previous)
+        else:
+          comparisons.append('%s = %%s' % previous)
+          arguments.append(value)
+      if values[index] is None:
+        if descending:
+          continue  # Nothing sorts after NULL.
+        comparisons.append('%s IS NOT NULL' % field)
+      elif descending:
+        comparisons.append('(%s < %%s OR %s IS NULL)' % (field, field))
+        arguments.append(values[index])
+      else:
+        comparisons.append('%s > %%s' % field)
+        arguments.append(values[index])
+      alternatives.append('(%s)' % ' AND '.join(comparisons))
+      params.extend(arguments)
+    if not alternatives:
+      return '0', ()
+    return '(%s)' % ' OR '.join(alternatives), tuple(params)
+
+  @staticmethod
+  def _AddCondition(conditions, params, condition, values):
+    """Returns the conditions and params with a parameterized condition added.
+
+    Conditions that were given without params have their literal percent signs
+    escaped, as the query now uses placeholders.
+    """
+    if not conditions:
+      conditions = []
+    elif isinstance(conditions, str):
+      conditions = [conditions]
+    if params is None:
+      conditions = [part.replace('%', '%%') for part in conditions]
+      params = ()
+    return list(conditions) + [condition], tuple(params) + tuple(values)
+
+  @staticmethod
+  def _EncodeCursor(values):
+    """Returns the opaque pagination token for the given ordering values."""
+    return base64.urlsafe_b64encode(simplejson.dumps(
+        values, default=str).encode('utf8')).decode('ascii')
+
+  @staticmethod
+  def _DecodeCursor(cursor):
+    """Returns the ordering values stored in a pagination token."""
+    try:
+      return tuple(simplejson.loads(
+          base64.urlsafe_b64decode(cursor.encode('ascii')), use_decimal=True))
+    except (ValueError, TypeError, UnicodeError):
+      raise Error('Invalid pagination cursor: %r' % cursor)
+
   @classmethod
   def _PrimaryKeyCondition(cls, connection, value):
     """Returns the primary key condition to be used."""
@@ -995,11 +1305,11 @@ class Record(BaseRecord):
         raise ValueError('Not enough values (%d) for compound key.', len(value))
       values = tuple(map(cls._ValueOrPrimary, value))
       return ' AND '.join('`%s` = %s' % (field, value) for field, value
-                   in zip(cls._PRIMARY_KEY, connection.EscapeValues(values)))
+                   in zip(cls._PRIMARY_KEY, cls._Bound(connection).EscapeValues(values)))
     return '`%s`.`%s` = %s' % (
         cls.TableName(),
         cls._PRIMARY_KEY,
-        connection.EscapeValues(cls._ValueOrPrimary(value)))
+        cls._Bound(connection).EscapeValues(cls._ValueOrPrimary(value)))
 
   def _RecordCreate(self, cursor):
     """Inserts the record's current values in the database as a new record.
@@ -1035,10 +1345,12 @@ class Record(BaseRecord):
         primary = tuple(self._record[key] for key in self._PRIMARY_KEY)
       else:
         primary = self._record[self._PRIMARY_KEY]
+      conditions, params = self._PrimaryKeyPlaceholders(primary)
       cursor.Update(
           table=self.TableName(),
           values=self._Changes(),
-          conditions=self._PrimaryKeyCondition(self.connection, primary))
+          conditions=conditions,
+          params=params)
     except KeyError:
       raise Error('Cannot update record without pre-existing primary key.')
     except cursor.OperationalError as err_obj:
@@ -1047,28 +1359,44 @@ class Record(BaseRecord):
       raise DatabaseError(err_obj)
 
   def _SaveForeign(self, cursor):
-    """Recursively saves all nested Record instances."""
+    """Recursively saves all nested Record instances.
+
+    Returns the (class, key) pairs of the saved records, like `_SaveSelf`.
+    """
+    stale = []
     for value in super(Record, self).items():
       if isinstance(value, Record):
         # Accessing protected members of a foreign class. Also, the only means
         # of recursively saving the record tree without opening multiple
         # database transactions (which would lead to exceptions really fast).
         # pylint: disable=W0212
-        value._SaveForeign(cursor)
-        value._SaveSelf(cursor)
+        stale.extend(value._SaveForeign(cursor))
+        stale.extend(value._SaveSelf(cursor))
+    return stale
 
   def _SaveSelf(self, cursor):
     """Updates the existing database entry with the record's current values.
 
     The constraint with which the record is updated is the name and value of the
     Record's primary key (`self._PRIMARY_KEY` and `self.key` resp.)
+
+    Returns the (class, key) pairs that the record is cached by, which have to
+    be invalidated again once the transaction is committed.
     """
     self._PreSave(cursor)
     difference = self._Changes()
+    stale = []
     if difference:
+      # The stored key, if the primary key changed, and the current key.
+      if not isinstance(self._PRIMARY_KEY, tuple):
+        stale.append(self._record.get(self._PRIMARY_KEY))
+      stale.append(self.key)
+      for key in stale:
+        self._Invalidate(self.connection, key)
       self._RecordUpdate(cursor)
       self._record.update(difference)
     self._PostSave(cursor)
+    return [(type(self), key) for key in stale]
 
   # ############################################################################
   # Public methods for creation, deletion and storing Record objects.
@@ -1076,7 +1404,7 @@ class Record(BaseRecord):
   @classmethod
   def Create(cls, connection, record):
     record = cls(connection, record, run_init_hook=False)
-    with connection as cursor:
+    with cls._Bound(connection) as cursor:
       # Accessing protected members of a foreign class.
       # pylint: disable=W0212
       record._PreCreate(cursor)
@@ -1084,27 +1412,98 @@ class Record(BaseRecord):
       record._PostCreate(cursor)
     return record
 
+  @classmethod
+  def CreateMany(cls, connection, records):
+    """Creates records in bulk, using multi-row inserts in a single transaction.
+
+    The `_PreCreate` and `_PostCreate` hooks run for every record, before and
+    after all records are inserted. When none of the records has a value for
+    the (single-column) primary key, and the server assigns consecutive
+    auto-increment values (auto_increment_increment is 1), the records get
+    the key that was assigned to them. Otherwise their keys are left unset.
+
+    Arguments:
+      @ connection: object
+        Database connection to use for the created records.
+      @ records: iterable of mappings
+        The record data to write to the database. All records should have the
+        same fields.
+
+    Returns:
+      list: the records that were created from the given mappings.
+    """
+    records = [cls(connection, record, run_init_hook=False)
+               for record in records]
+    if not records:
+      return records
+    with cls._Bound(connection) as cursor:
+      # Accessing protected members of a foreign class.
+      # pylint: disable=W0212
+      cls._PreCreateMany(cursor, records)
+      try:
+        results = cursor.InsertMany(
+            cls.TableName(), [record._DataRecord() for record in records])
+      except cursor.OperationalError as err_obj:
+        if err_obj.args and err_obj.args[0] == 1054:
+          raise BadFieldError(err_obj.args[1])
+        raise DatabaseError(err_obj)
+      if (not isinstance(cls._PRIMARY_KEY, tuple) and
+          all(record.get(cls._PRIMARY_KEY) is None for record in records) and
+          all(result.insertid for result in results) and
+          cursor.Execute('SELECT @@auto_increment_increment')[0][0] == 1):
+        position = 0
+        for result in results:
+          chunk = records[position:position + result.affected]
+          position += result.affected
+          for offset, record in enumerate(chunk):
+            record._record[cls._PRIMARY_KEY] = record.key = (
+                result.insertid + offset)
+      for record in records:
+        record._PostCreate(cursor)
+    return records
+
+  @classmethod
+  def _PreCreateMany(cls, cursor, records):
+    """Runs the `_PreCreate` hook of each record that CreateMany inserts."""
+    # pylint: disable=W0212
+    for record in records:
+      record._PreCreate(cursor)
+
   @classmethod
   def DeletePrimary(cls, connection, pkey_value):
-    with connection as cursor:
-      cursor.Delete(table=cls.TableName(),
-                    conditions=cls._PrimaryKeyCondition(connection, pkey_value))
+    conditions, params = cls._PrimaryKeyPlaceholders(pkey_value)
+    with cls._Bound(connection) as cursor:
+      cursor.Delete(table=cls.TableName(), conditions=conditions, params=params)
+    cls._Invalidate(
+        connection, params if isinstance(cls._PRIMARY_KEY, tuple) else params[0])
 
   @classmethod
   def FromPrimary(cls, connection, pkey_value):
-    with connection as cursor:
+    conditions, params = cls._PrimaryKeyPlaceholders(pkey_value)
+    if cls._IDENTITY_MAP or cls._CACHE:
+      record = cls._Cached(
+          connection, params if isinstance(cls._PRIMARY_KEY, tuple) else params[0])
+      if record is not None:
+        if cls._ModelCache(connection) is not None:
+          cls._ModelCache(connection).QuerySaved()
+        return record
+    with cls._Bound(connection) as cursor:
       record = cursor.Select(
-          table=cls.TableName(),
-          conditions=cls._PrimaryKeyCondition(connection, pkey_value))
+          table=cls.TableName(), conditions=conditions, params=params)
     if not record:
       raise NotExistError('There is no %r for primary key %r' % (
           cls.__name__, pkey_value))
-    return cls(connection, record[0])
+    record = cls(connection, record[0])
+    for store in (cls._IdentityMap(connection), cls._ModelCache(connection)):
+      if store is not None:
+        store.Add(record)
+    return record
 
   @classmethod
   def List(cls, connection, conditions=None, limit=None, offset=None,
            order=None, yield_unlimited_total_first=False, search=None,
-           tables=None, escape=True, fields=None):
+           tables=None, escape=True, fields=None, params=None, preload=None,
+           after=None):
     """Yields a Record object for every table entry.
 
     Arguments:
@@ -1113,6 +1512,7 @@ class Record(BaseRecord):
       % conditions: str / iterable ~~ None
         Optional query portion that will be used to limit the list of results.
         If multiple conditions are provided, they are joined on an 'AND' string.
+        With `params`, these can contain `%s` placeholders.
       % limit: int ~~ None
         Specifies a maximum number of items to be yielded. The limit happens on
         the database side, limiting the query results.
@@ -1135,18 +1535,47 @@ class Record(BaseRecord):
         Are conditions escaped?
       % fields: str / iterable ~~ *
         Specifies what fields should be returned
+      % params: iterable ~~ None
+        Values for the `%s` placeholders in the conditions, these are escaped
+        and bound to the query. Literal percent signs must then be written as
+        `%%`.
+      % preload: iterable of str ~~ None
+        Foreign relations that are loaded for all records at once, with one
+        query per relation, instead of one query per record on access.
+        Relations of relations are given as dotted paths ('author.publisher').
+      % after: obj / tuple ~~ None
+        Keyset pagination: only records that come after these values of the
+        `order` fields are listed. The primary key is added to the order, so
+        the values end with that of the primary key; for the default order
+        `after` is just the primary key value. Unlike a large `offset`, this
+        does not read and discard all the preceding rows.
 
     Yields:
       Record: Database record abstraction class.
     """
+    # Only complete records of this class' table are kept in the identity map
+    # and the model cache.
+    identity_map = model_cache = None
+    if fields is None and not tables:
+      identity_map = cls._IdentityMap(connection)
+      model_cache = cls._ModelCache(connection)
     if not tables:
       tables = [cls.TableName()]
     group = None
     if fields is None:
       fields = '%s.*' % cls.TableName()
+    if after is not None:
+      order = cls._KeysetOrder(order)
+      conditions, params = cls._AddCondition(
+          conditions, params, *cls._KeysetCondition(
+              order, after, cls._Bound(connection).EscapeField if escape else
+              lambda x: x))
     if search:
       group = '%s.%s' % (cls.TableName(), (cls.RecordKey() if getattr(cls, "RecordKey", None) else cls._PRIMARY_KEY))
       tables, searchconditions = cls._GetSearchQuery(connection, tables, search)
+      if params is not None:
+        searchconditions = [condition.replace('%', '%%')
+                            for condition in searchconditions]
       if conditions:
         if type(conditions) == list:
           conditions.extend(searchconditions)
@@ -1155,26 +1584,112 @@ class Record(BaseRecord):
           conditions = searchconditions
       else:
         conditions = searchconditions
-    cacheable = False
     if not offset or offset < 0:
       offset = 0
-    if hasattr(cls, '_addToCache'):
-      #TODO dont cache partial / multi-table objects
-      cacheable = True
-      connection.modelcache['_stats']['queries'].append('%s Record.List' % cls.TableName())
-    with connection as cursor:
+    with cls._Bound(connection) as cursor:
       records = cursor.Select(fields=fields,
                               table=tables, conditions=conditions,
                               limit=limit, offset=offset, order=order,
                               totalcount=yield_unlimited_total_first,
-                              escape=escape, group=group)
+                              escape=escape, group=group,
+                              params=None if params is None else tuple(params))
     if yield_unlimited_total_first:
       yield records.affected
     records = [cls(connection, record) for record in list(records)]
+    if model_cache is not None:
+      for record in records:
+        model_cache.Add(record)
+    if identity_map is not None:
+      for index, record in enumerate(records):
+        mapped = identity_map.Get(cls.TableName(), record.key)
+        if mapped is None:
+          identity_map.Add(record)
+        else:
+          records[index] = mapped
+    if preload and records:
+      cls._Preload(connection, records, preload)
     for record in records:
       yield record
-    if cacheable:
-      list(cls._cacheListPreseed(records))
+
+  @classmethod
+  def Paginate(cls, connection, limit, cursor=None, order=None,
+               estimate_count=False, conditions=None, params=None, **kwds):
+    """Returns a page of records, using keyset pagination.
+
+    Each page continues after the last record of the previous page, through
+    the cursor token of that page. The time to load a page therefore does
+    not grow with the number of preceding pages, as it does for `offset`.
+
+    Arguments:
+      @ connection: object
+        Database connection to use.
+      @ limit: int
+        The number of records on a page.
+      % cursor: str ~~ None
+        The `cursor` of the previous page, None for the first page.
+      % order: iterable of str/2-tuple ~~ None
+        The fields to order the records by, as for `List`. The primary key is
+        added to make the order unique.
+      % estimate_count: bool ~~ False
+        Sets the page's `total` to the estimated number of matching records,
+        see `EstimateCount`.
+      % conditions: str / iterable ~~ None
+        Query portion that limits the listed records, as for `List`.
+      % params: iterable ~~ None
+        Values for the `%s` placeholders in the conditions.
+      % **kwds: obj
+        Other arguments for `List`, like `preload`.
+
+    Returns:
+      Page: the list of records on the page, with the cursor for the next page.
+    """
+    rules = cls._KeysetOrder(order)
+    records = list(cls.List(
+        connection, conditions=conditions, params=params, limit=limit + 1,
+        order=rules, after=None if cursor is None else cls._DecodeCursor(cursor),
+        **kwds))
+    next_cursor = None
+    if len(records) > limit:
+      del records[limit:]
+      next_cursor = cls._EncodeCursor(
+          [records[-1]._record.get(field.rsplit('.', 1)[-1])
+           for field, _descending in rules])
+    total = None
+    if estimate_count:
+      total = cls.EstimateCount(connection, conditions=conditions, params=params)
+    return Page(records, cursor=next_cursor, total=total)
+
+  @classmethod
+  def EstimateCount(cls, connection, conditions=None, params=None):
+    """Returns an estimate of the number of records that match the conditions.
+
+    Unlike `yield_unlimited_total_first`, this does not scan all matching
+    rows. Without conditions the table's row count from the server statistics
+    is used, otherwise the number of rows the query planner expects to read.
+    Either can be quite far off, so this is meant for display purposes.
+
+    Arguments:
+      @ connection: object
+        Database connection to use.
+      % conditions: str / iterable ~~ None
+        Query portion that limits the counted records, as for `List`.
+      % params: iterable ~~ None
+        Values for the `%s` placeholders in the conditions.
+
+    Returns:
+      int: the estimated number of records.
+    """
+    with cls._Bound(connection) as cursor:
+      if not conditions:
+        result = cursor.Execute(
+            'SELECT `TABLE_ROWS` FROM `information_schema`.`TABLES` '
+            'WHERE `TABLE_SCHEMA` = DATABASE() AND `TABLE_NAME` = %s',
+            (cls.TableName(),))
+        return int(result[0][0] or 0) if result else 0
+      result = cursor.Execute('EXPLAIN SELECT 1 FROM `%s` WHERE %s' % (
+          cls.TableName(), cursor._StringConditions(conditions, None)),
+          None if params is None else tuple(params))
+    return int(result[0]['rows'] or 0) if result else 0
 
   # SQL Records have foreign relations, saving needs an extra argument for this.
   # pylint: disable=W0221
@@ -1191,18 +1706,20 @@ class Record(BaseRecord):
         saved. N.B. each record is saved using a separate transaction, meaning
         that a failure to save this object will *not* roll back child saves.
     """
-    with self.connection as cursor:
-      if save_foreign:
-        self._SaveForeign(cursor)
-      self._SaveSelf(cursor)
+    with self._Bound(self.connection) as cursor:
+      stale = self._SaveForeign(cursor) if save_foreign else []
+      stale.extend(self._SaveSelf(cursor))
+    # Other requests may have cached the old rows before the commit.
+    for record_class, key in stale:
+      record_class._Invalidate(self.connection, key)
     return self
   # pylint: enable=W0221
 
   @classmethod
-  def _GetSearchQuery(cls, connetion, tables, search):
+  def _GetSearchQuery(cls, connection, tables, search):
     """Extracts table information from the searchable columns list."""
     conditions = []
-    like = 'like "%%%s%%"' % connection.EscapeValues(search.strip())[1:-1]
+    like = 'like "%%%s%%"' % cls._Bound(connection).EscapeValues(search.strip())[1:-1]
     searchconditions = []
     thistable = cls.TableName()
     for column in cls.SEARCHABLE_COLUMNS:
@@ -1297,9 +1814,9 @@ class VersionedRecord(Record):
     Returns:
       Record: The newest record for the given identifier.
     """
-    safe_id = connection.EscapeValues(identifier)
+    safe_id = cls._Bound(connection).EscapeValues(identifier)
 
-    with connection as cursor:
+    with cls._Bound(connection) as cursor:
       record = cursor.Select(
           table=cls.TableName(), order=[(cls._PRIMARY_KEY, True)],
           conditions='`%s`=%s' % (cls.RecordKey(), safe_id), limit=1)
@@ -1311,7 +1828,8 @@ class VersionedRecord(Record):
   @classmethod
   def List(cls, connection, conditions=None, limit=None, offset=None,
            order=None, yield_unlimited_total_first=False, search=None,
-           tables=None, escape=True, fields=None):
+           tables=None, escape=True, fields=None, params=None, preload=None,
+           after=None):
     """Yields the latest Record for each versioned entry in the table.
 
     Arguments:
@@ -1342,10 +1860,24 @@ class VersionedRecord(Record):
         Are conditions escaped?
       % fields: str / iterable ~~ *
         Specifies what fields should be returned
+      % params: iterable ~~ None
+        Values for the `%s` placeholders in the conditions, these are escaped
+        and bound to the query. Literal percent signs must then be written as
+        `%%`.
+      % preload: iterable of str ~~ None
+        Foreign relations that are loaded for all records at once, with one
+        query per relation, instead of one query per record on access.
+        Relations of relations are given as dotted paths ('author.publisher').
+      % after: obj / tuple ~~ None
+        Keyset pagination: only records that come after these values of the
+        `order` fields are listed, see `Record.List`.
 
     Yields:
       Record: The Record with the newest version for each versioned entry.
     """
+    model_cache = None
+    if not fields and not tables:
+      model_cache = cls._ModelCache(connection)
     if not tables:
       tables = [cls.TableName()]
     if not fields:
@@ -1353,12 +1885,21 @@ class VersionedRecord(Record):
     else:
       if fields != '*':
         if type(fields) != str:
-          fields = ', '.join(connection.EscapeField(fields))
+          fields = ', '.join(cls._Bound(connection).EscapeField(fields))
         else:
-          fields = connection.EscapeField(fields)
+          fields = cls._Bound(connection).EscapeField(fields)
+    if after is not None:
+      order = cls._KeysetOrder(order)
+      conditions, params = cls._AddCondition(
+          conditions, params, *cls._KeysetCondition(
+              order, after, cls._Bound(connection).EscapeField if escape else
+              lambda x: x))
     if search:
       search = search.strip()
       tables, searchconditions = cls._GetSearchQuery(connection, tables, search)
+      if params is not None:
+        searchconditions = [condition.replace('%', '%%')
+                            for condition in searchconditions]
       if conditions:
         if type(conditions) == list:
           conditions.extend(searchconditions)
@@ -1367,17 +1908,12 @@ class VersionedRecord(Record):
           conditions = searchconditions
       else:
         conditions = searchconditions
-    field_escape = connection.EscapeField if escape else lambda x: x
+    field_escape = cls._Bound(connection).EscapeField if escape else lambda x: x
     if yield_unlimited_total_first and limit is not None:
       totalcount = 'SQL_CALC_FOUND_ROWS'
     else:
       totalcount = ''
-    cacheable = False
-    if hasattr(cls, '_addToCache'):
-      #TODO dont cache partial / multi-table objects
-      cacheable = True
-      connection.modelcache['_stats']['queries'].append('%s VersionedRecord.List' % cls.TableName())
-    with connection as cursor:
+    with cls._Bound(connection) as cursor:
       records = cursor.Execute("""
           SELECT %(totalcount)s %(fields)s
           FROM %(tables)s
@@ -1397,17 +1933,21 @@ class VersionedRecord(Record):
                  'conditions': cursor._StringConditions(conditions,
                                                       field_escape),
                  'order': cursor._StringOrder(order, field_escape),
-                 'limit': cursor._StringLimit(limit, offset)})
+                 'limit': cursor._StringLimit(limit, offset)},
+          None if params is None else tuple(params))
     if yield_unlimited_total_first and limit is not None:
-      with connection as cursor:
+      with cls._Bound(connection) as cursor:
         records.affected = cursor._Execute('SELECT FOUND_ROWS()')[0][0]
       yield records.affected
     # turn sqltalk rows into model
     records = [cls(connection, record) for record in list(records)]
+    if model_cache is not None:
+      for record in records:
+        model_cache.Add(record)
+    if preload and records:
+      cls._Preload(connection, records, preload)
     for record in records:
       yield record
-    if cacheable:
-      list(cls._cacheListPreseed(records))
 
   @classmethod
   def Versions(cls, connection, identifier, conditions='1'):
@@ -1424,8 +1964,8 @@ class VersionedRecord(Record):
     """
     if isinstance(conditions, (list, tuple)):
       conditions = ' AND '.join(conditions)
-    safe_id = connection.EscapeValues(identifier)
-    with connection as cursor:
+    safe_id = cls._Bound(connection).EscapeValues(identifier)
+    with cls._Bound(connection) as cursor:
       records = cursor.Select(table=cls.TableName(),
                               conditions='`%s` = %s AND %s' % (
                                   cls.RecordKey(), safe_id, conditions))
@@ -1448,6 +1988,37 @@ class VersionedRecord(Record):
     if last_key:
       return last_key[0][cls.RecordKey()]
 
+  @classmethod
+  def _LoadManyAsForeign(cls, connection, values, method=None):
+    """Loads the newest records for the given identifiers with a single query.
+
+    Returns a dictionary of the loaded records by identifier, or None if the
+    load method does not allow loading in a batch.
+    """
+    method = method or cls._LOAD_METHOD
+    if method != 'FromIdentifier':
+      return super(VersionedRecord, cls)._LoadManyAsForeign(
+          connection, values, method=method)
+    if not values:
+      return {}
+    records = cls.List(
+        connection, conditions='`%s`.`%s` IN %%s' % (
+            cls.TableName(), cls.RecordKey()),
+        params=(tuple(values),))
+    return {record.identifier: record for record in records}
+
+  @classmethod
+  def _PreCreateMany(cls, cursor, records):
+    """Attaches consecutive RecordKeys to the records that don't have one."""
+    next_key = None
+    for record in records:
+      if record.identifier is None:
+        if next_key is None:
+          next_key = cls._NextRecordKey(cursor)
+        record.identifier = next_key
+        next_key += 1
+    super(VersionedRecord, cls)._PreCreateMany(cursor, records)
+
   def _PreCreate(self, cursor):
     """Attaches a RecordKey to the Record if it doens't have one already.
 
@@ -1503,7 +2074,7 @@ class MongoRecord(BaseRecord):
   @classmethod
   def Collection(cls, connection):
     """Returns the collection that the MongoRecord resides in."""
-    return getattr(connection, cls.TableName())
+    return getattr(cls._Bound(connection), cls.TableName())
 
   @classmethod
   def Create(cls, connection, record):
@@ -1592,7 +2163,7 @@ class CachedPage(object):
 
     An optional 'maxage' integer can be specified instead of MAXAGE.
     """
-    with connection as cursor:
+    with _ConnectionFor(connection, cls) as cursor:
       cursor.Execute("""delete
         from
           %s
@@ -1606,7 +2177,8 @@ class CachedPage(object):
   @classmethod
   def FromSignature(cls, connection, maxage, name, modulename, args, kwargs):
     """Returns a cached page from the given signature."""
-    with connection as cursor:
+    database = _ConnectionFor(connection, cls)
+    with database as cursor:
       cache = cursor.Execute("""select
           data,
           TIME_TO_SEC(TIMEDIFF(UTC_TIMESTAMP(), created)) as age,
@@ -1624,10 +2196,10 @@ class CachedPage(object):
           """ % (
         cls.TableName(),
         (cls.MAXAGE if maxage is None else maxage),
-        connection.EscapeValues(name),
-        connection.EscapeValues(modulename),
-        connection.EscapeValues(args),
-        connection.EscapeValues(kwargs)))
+        database.EscapeValues(name),
+        database.EscapeValues(modulename),
+        database.EscapeValues(args),
+        database.EscapeValues(kwargs)))
 
     if cache:
       if cache[0]['creating'] is not None:
@@ -2,6 +2,7 @@
 """uWeb3 PageMaker class and its various Mixins."""
 
 import datetime
+import email.utils
 import logging
 import mimetypes
 import os
@@ -11,6 +12,7 @@ import threading
 import time
 import hashlib
 import glob
+from stat import S_ISREG
 from base64 import b64encode
 from pymysql import Error as pymysqlerr
 
@@ -18,6 +20,8 @@ from pymysql import Error as pymysqlerr
 import uweb3
 from ..connections import ConnectionManager
 from .. import response, templateparser
+from ..libs import cache
+from ..libs import compression
 
 RFC_1123_DATE = '%a, %d %b %Y %T GMT'
 
@@ -161,6 +165,28 @@ class XSRFToken(object):
     return h.hexdigest()
 
 
+class RequestVariable(object):
+  """Binds a request variable (cookies, query args, body) to the pagemaker.
+
+  The variable is only retrieved, and thus parsed, the first time it is used.
+  After that it's stored on the instance, as are any values assigned to it.
+  """
+  def __init__(self, name):
+    self.name = name
+    self.attribute = None
+
+  def __set_name__(self, owner, attribute):
+    self.attribute = attribute
+
+  def __get__(self, instance, owner):
+    if instance is None:
+      return self
+    req_vars = instance.req.vars
+    value = req_vars[self.name] if self.name in req_vars else {}
+    instance.__dict__[self.attribute] = value
+    return value
+
+
 class Base(object):
   # Constant for persistent storage accross requests. This will be accessible
   # by all threads of the same application (in the same Python process).
@@ -185,12 +211,41 @@ class Base(object):
     If the config file specificied a [templates] section and a `path` is
     assigned in there, this path will be used.
     Otherwise, the `TEMPLATE_DIR` will be used to load templates from.
+
+    The cache for rendered template fragments is configured in the same
+    section:
+      fragment_cache: 'memory' for an in-process cache, 'file' for one that is
+          shared by all processes, or 'off' (memory)
+      fragment_cache_size: the maximum number of fragments (1024)
+      fragment_cache_ttl: seconds that fragments are kept by default (60)
+      fragment_cache_path: the directory of a file cache (a `fragments`
+          directory private to the user and application)
+      fragment_cache_prune: the number of fragments that are stored between
+          prunings of a file cache (100)
     """
     if '__parser' not in self.persistent:
+      options = self.options.get('templates', {})
       self.persistent.Set('__parser', templateparser.Parser(
-          self.options.get('templates', {}).get('path', self.TEMPLATE_DIR)))
+          options.get('path', self.TEMPLATE_DIR),
+          fragment_cache=self._FragmentCache(options)))
     return self.persistent.Get('__parser')
 
+  @classmethod
+  def _FragmentCache(cls, options):
+    """Returns the fragment cache backend for the [templates] options."""
+    backend = options.get('fragment_cache', 'memory')
+    size = int(options.get('fragment_cache_size', 1024))
+    ttl = float(options.get('fragment_cache_ttl', 60))
+    if backend == 'file':
+      path = options.get('fragment_cache_path') or cache.DefaultPath(
+          getattr(cls, 'LOCAL_DIR', None), 'fragments')
+      return cache.FileCache(
+          path, ttl=ttl, maxsize=size,
+          prune_interval=int(options.get('fragment_cache_prune', 100)))
+    if backend == 'off':
+      return cache.TTLCache(0, ttl=ttl)
+    return cache.TTLCache(size, ttl=ttl)
+
 
 class WebsocketPageMaker(Base):
   """Pagemaker for the websocket routes.
@@ -289,6 +344,13 @@ class BasePageMaker(Base):
   CACHE_DURATION = MimeTypeDict({'text': 7, 'image': 30, 'application': 7,
       'text/css': 7})
 
+  # Request variables, these are parsed from the request on first use.
+  cookies = RequestVariable('cookie')
+  get = RequestVariable('get')
+  post = RequestVariable('post')
+  put = RequestVariable('put')
+  delete = RequestVariable('delete')
+
   def __init__(self,
               req,
               config=None,
@@ -305,21 +367,14 @@ class BasePageMaker(Base):
         This is the path to the uWeb3 routing file.
     """
     super(BasePageMaker, self).__init__()
-    self.__SetupPaths(executing_path)
+    cls = type(self)
+    if cls.__dict__.get('_SETUP_FOR', False) != executing_path:
+      cls._SetupClass(config, executing_path)
     self.req = req
-    self.cookies = req.vars['cookie']
-    self.get = req.vars['get']
-    self.post = req.vars['post'] if 'post' in req.vars else {}
-    self.put = req.vars['put'] if 'put' in req.vars else {}
-    self.delete = req.vars['delete'] if 'delete' in req.vars else {}
     self.config = config or None
     self.options = config.options if config else {}
-    self.debug = DebuggerMixin in self.__class__.__mro__
-    try:
-      self.connection = self.persistent.Get('connection')
-    except KeyError:
-      self.persistent.Set('connection', ConnectionManager(self.config, self.options, self.debug))
-      self.connection = self.persistent.Get('connection')
+    self.connection = cls._CONNECTION
+    self.connection.BindRequest(req)
 
   @classmethod
   def LoadModules(cls, routes='routes/*.py'):
@@ -350,34 +405,27 @@ class BasePageMaker(Base):
     self.connection.Rollback()
 
   @classmethod
-  def __SetupPaths(cls, executing_path):
-    """This sets up the correct paths for the PageMaker subclasses.
+  def _SetupClass(cls, config, executing_path):
+    """Sets up everything for the PageMaker class that is equal for all requests.
 
-    From the passed in `cls`, it retrieves the filename. Of that path, the
-    directory is used as the working directory. Then, the module constant
-    TEMPLATE_DIR is used to define class constants from.
+    This runs once per class (and executing path), on the first request that
+    the class handles. It sets up the paths of the class and retrieves the
+    ConnectionManager from the persistent storage, creating it if needed.
     """
-    # Unfortunately, mod_python does not always support retrieving the caller
-    # filename using sys.modules. In those cases we need to query the stack.
-    # pylint: disable=W0212
-    try:
-      local_file = os.path.abspath(sys.modules[cls.__module__].__file__)
-    except KeyError:
-      # This happens for old-style mod_python solutions: The pages file is
-      # imported through the mechanics of mod_pythoif '__mysql' not in self.persistent: (not package imports) and
-      # isn't known in sys modules. We use the CPython implementation details
-      # to get the correct executing file.
-      frame = sys._getframe()
-      initial = frame.f_code.co_filename
-      # pylint: enable=W0212
-      while initial == frame.f_code.co_filename:
-        if not frame.f_back:
-          break  # This happens during exception handling of DebuggingPageMaker
-        frame = frame.f_back
-      local_file = frame.f_code.co_filename
-    cls.LOCAL_DIR = cls_dir = executing_path
-    cls.PUBLIC_DIR = os.path.join(cls_dir, cls.PUBLIC_DIR)
-    cls.TEMPLATE_DIR = os.path.join(cls_dir, cls.TEMPLATE_DIR)
+    # The configured (relative) paths are kept, so the class can be set up
+    # again for another executing path.
+    dirs = cls.__dict__.get('_CONFIGURED_DIRS', (cls.PUBLIC_DIR, cls.TEMPLATE_DIR))
+    cls._CONFIGURED_DIRS = dirs
+    cls.LOCAL_DIR = executing_path
+    cls.PUBLIC_DIR = os.path.join(executing_path, dirs[0])
+    cls.TEMPLATE_DIR = os.path.join(executing_path, dirs[1])
+    cls.debug = DebuggerMixin in cls.__mro__
+    connection = cls.PERSISTENT.Get('connection', None)
+    if connection is None:
+      connection = cls.PERSISTENT.SetDefault('connection', ConnectionManager(
+          config, config.options if config else {}, cls.debug))
+    cls._CONNECTION = connection
+    cls._SETUP_FOR = executing_path
 
   def Static(self, rel_path):
     """Provides a handler for static content.
@@ -387,6 +435,10 @@ class BasePageMaker(Base):
     then the requested file is retrieved, its mimetype guessed, and returned
     to the client performing the request.
 
+    The file is not read into memory, but streamed to the client. Conditional
+    requests (If-None-Match, If-Modified-Since) are answered with a 304 response
+    and single byte ranges with a 206 response.
+
     Should the requested file not exist, a 404 page is returned instead.
 
     Arguments:
@@ -399,27 +451,163 @@ class BasePageMaker(Base):
     """
     rel_path = os.path.abspath(os.path.join(os.path.sep, rel_path))[1:]
     abs_path = os.path.join(self.PUBLIC_DIR, rel_path)
+    cache = getattr(self.req.registry, 'static_cache', None)
+    if cache is not None:
+      entry = cache.Get(abs_path)
+      if entry is not None:
+        return self._StaticCached(entry)
+    try:
+      staticfile = open(abs_path, 'rb')
+    except IOError:
+      return self._StaticNotFound(rel_path)
     try:
+      stat = os.fstat(staticfile.fileno())
+      if not S_ISREG(stat.st_mode):
+        staticfile.close()
+        return self._StaticNotFound(rel_path)
       content_type, _encoding = mimetypes.guess_type(abs_path)
       if not content_type:
         content_type = 'text/plain'
-      binary = False
-      if not content_type.startswith('text/'):
-        binary = True
-      with open(abs_path, 'rb' if binary else 'r') as staticfile:
-        mtime = os.path.getmtime(abs_path)
-        length = os.path.getsize(abs_path)
-        cache_days = self.CACHE_DURATION.get(content_type, 0)
-        expires = datetime.datetime.utcnow() + datetime.timedelta(cache_days)
-        return response.Response(content=staticfile.read(),
-                        content_type=content_type,
-                        headers={'Expires': expires.strftime(RFC_1123_DATE),
-                                 'cache-control': 'max-age=%d' %
-                                    (cache_days*24*60*60),
-                                 'last-modified': time.ctime(mtime),
-                                 'content-length': length})
-    except IOError:
-      return self._StaticNotFound(rel_path)
+      cache_days = self.CACHE_DURATION.get(content_type, 0)
+      headers = {'cache-control': 'max-age=%d' % (cache_days*24*60*60),
+                 'last-modified': time.strftime(
+                     RFC_1123_DATE, time.gmtime(stat.st_mtime)),
+                 'Accept-Ranges': 'bytes'}
+      if cache is not None and stat.st_size <= cache.max_file_size:
+        with staticfile:
+          entry = cache.Add(
+              abs_path, stat, content_type, headers, staticfile.read())
+        return self._StaticCached(entry)
+      etag = '"%x-%x"' % (stat.st_mtime_ns, stat.st_size)
+      headers['Expires'] = self._StaticExpires(content_type)
+      headers['ETag'] = etag
+      if self._StaticNotModified(etag, stat.st_mtime):
+        staticfile.close()
+        return response.Response(content_type=content_type, httpcode=304,
+                                 headers=headers)
+      byterange = self._StaticRange(stat.st_size, etag, stat.st_mtime)
+      if byterange is None:
+        headers['content-length'] = stat.st_size
+        return response.FileResponse(staticfile, content_type=content_type,
+                                     headers=headers)
+      if not byterange:
+        staticfile.close()
+        headers['Content-Range'] = 'bytes */%d' % stat.st_size
+        return response.Response(content_type=content_type, httpcode=416,
+                                 headers=headers)
+      first, last = byterange
+      headers['content-length'] = last - first + 1
+      headers['Content-Range'] = 'bytes %d-%d/%d' % (first, last, stat.st_size)
+      return response.FileResponse(
+          staticfile, offset=first, length=last - first + 1,
+          content_type=content_type, httpcode=206, headers=headers)
+    except Exception:
+      staticfile.close()
+      raise
+
+  def _StaticCached(self, entry):
+    """Returns the response for a static file from the in-memory cache.
+
+    A compressed variant is sent if the client accepts it, unless a byte range
+    was requested; ranges always apply to the uncompressed file.
+    """
+    encoding = None
+    if entry.variants and 'HTTP_RANGE' not in self.req.env:
+      encoding = compression.ChooseEncoding(
+          self.req.env.get('HTTP_ACCEPT_ENCODING'), entry.variants)
+    etag = entry.VariantTag(encoding)
+    headers = dict(entry.headers, ETag=etag,
+                   Expires=self._StaticExpires(entry.content_type))
+    if entry.variants:
+      headers['Vary'] = 'Accept-Encoding'
+    if self._StaticNotModified(etag, entry.mtime):
+      return response.Response(content_type=entry.content_type, httpcode=304,
+                               headers=headers)
+    httpcode = 200
+    if encoding is not None:
+      headers['Content-Encoding'] = encoding
+      body = entry.variants[encoding]
+    else:
+      body = entry.body
+      byterange = self._StaticRange(entry.size, etag, entry.mtime)
+      if byterange == ():
+        headers['Content-Range'] = 'bytes */%d' % entry.size
+        return response.Response(content_type=entry.content_type,
+                                 httpcode=416, headers=headers)
+      if byterange is not None:
+        first, last = byterange
+        headers['Content-Range'] = 'bytes %d-%d/%d' % (first, last, entry.size)
+        body = body[first:last + 1]
+        httpcode = 206
+    headers['content-length'] = len(body)
+    return response.Response(content=body, content_type=entry.content_type,
+                             httpcode=httpcode, headers=headers)
+
+  def _StaticExpires(self, content_type):
+    """Returns the Expires header value for a static file of `content_type`."""
+    cache_days = self.CACHE_DURATION.get(content_type, 0)
+    expires = datetime.datetime.utcnow() + datetime.timedelta(cache_days)
+    return expires.strftime(RFC_1123_DATE)
+
+  def _StaticNotModified(self, etag, mtime):
+    """Returns whether the client's cached copy of a static file is current.
+
+    If-None-Match takes precedence over If-Modified-Since, as per RFC 7232.
+    """
+    if_none_match = self.req.env.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+      tags = [tag.strip() for tag in if_none_match.split(',')]
+      return '*' in tags or etag in tags or 'W/' + etag in tags
+    if_modified_since = self.req.env.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since:
+      try:
+        since = email.utils.parsedate_to_datetime(if_modified_since)
+      except (TypeError, ValueError):
+        return False
+      return int(mtime) <= since.timestamp()
+    return False
+
+  def _StaticRange(self, size, etag, mtime):
+    """Returns the byte range requested for a static file.
+
+    Only single ranges are supported, requests for multiple ranges get the full
+    file, as does a request whose If-Range does not match the current file.
+
+    Returns:
+      None: if the full file should be sent.
+      tuple: the first and last (inclusive) byte position of the range.
+      (): if the requested range is not satisfiable.
+    """
+    byterange = self.req.env.get('HTTP_RANGE', '')
+    if not byterange.startswith('bytes=') or ',' in byterange:
+      return None
+    if_range = self.req.env.get('HTTP_IF_RANGE')
+    if if_range and if_range != etag and if_range != time.strftime(
+        RFC_1123_DATE, time.gmtime(mtime)):
+      return None
+    first, _sep, last = byterange[6:].strip().partition('-')
+    try:
+      if not first:
+        first, last = max(size - int(last), 0), size - 1
+      else:
+        first, last = int(first), min(int(last) if last else size - 1, size - 1)
+    except ValueError:
+      return None
+    if first > last or first >= size:
+      return ()
+    return first, last
+
+  def PrometheusMetrics(self):
+    """Provides a handler that exposes the request metrics to Prometheus.
+
+    Route a path to this handler to expose the metrics, they are only collected
+    when enabled in the [metrics] section of the config.
+    """
+    collected = getattr(self.req.registry, 'metrics', None)
+    if collected is None:
+      return self._NotFound(self.req.path)
+    return response.Response(collected.Prometheus(),
+                             content_type='text/plain; version=0.0.4')
 
   def _StaticNotFound(self, _path):
     message = 'This is not the path you\'re looking for. No such file %r' % (
@@ -431,6 +619,11 @@ class BasePageMaker(Base):
       self.req.env['PATH_INFO'])
     return response.Response(message, content_type='text/html', httpcode=404)
 
+  def _RequestBodyTooLarge(self):
+    message = 'The request body exceeds the maximum of %d bytes.' % (
+        self.req.MAX_BODY_SIZE)
+    return response.Response(message, content_type='text/plain', httpcode=413)
+
   def InternalServerError(self, exc_type, exc_value, traceback):
     """Returns a plain text notification about an internal server error."""
     error = 'INTERNAL SERVER ERROR (HTTP 500) DURING PROCESSING OF %r' % (
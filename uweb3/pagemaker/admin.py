@@ -13,6 +13,9 @@ from .. import templateparser
 
 NOT_ALLOWED_METHODS = dir({}) + ['key', 'identifier']
 
+# Number of records on a page of the admin's record listing.
+PAGE_SIZE = 50
+
 FIELDTYPES = {'datetime': datetime.datetime,
               'decimal': decimal.Decimal}
 
@@ -39,6 +42,7 @@ class AdminMixin(object):
     edithtml = None
     message = None
     docs = None
+    page = None
     if len(urlparts) > 2:
       if urlparts[1] == 'table':
         table = urlparts[2]
@@ -57,8 +61,8 @@ class AdminMixin(object):
           elif method == 'save':
             message = self.__SaveRecord(table, self.post.getfirst('key'))
         else:
-          (columns, results) = self.__AdminTablesMethodsResults(urlparts[2],
-                                                                method)
+          (columns, results, page) = self.__AdminTablesMethodsResults(
+              urlparts[2], method, self.get.getfirst('cursor'))
 
           resulttemplate = templateparser.FileTemplate(
               os.path.join(os.path.dirname(__file__), 'admin', 'record.html'))
@@ -82,7 +86,8 @@ class AdminMixin(object):
                                results=resultshtml,
                                edit=edithtml,
                                message=message,
-                               docs=docs)
+                               docs=docs,
+                               page=page)
 
   def __GetDocs(self, table, method):
     if self.__CheckTable(table):
@@ -201,15 +206,32 @@ class AdminMixin(object):
       return methods
     return False
 
-  def __AdminTablesMethodsResults(self, tablename, methodname='List'):
+  def __AdminTablesMethodsResults(self, tablename, methodname='List',
+                                  cursor=None):
+    """Returns the columns, the records and the page that they are on.
+
+    Records are listed a page at a time, using keyset pagination, with an
+    estimate of the total number of records. An invalid `cursor` (from an
+    edited or outdated link) lists the first page instead.
+    """
     if self.__CheckTable(tablename):
       table = getattr(self.ADMIN_MODEL, tablename)
-      method = getattr(table, methodname)
-      results = method(self.connection)
+      page = None
+      if methodname == 'List':
+        try:
+          results = page = table.Paginate(
+              self.connection, PAGE_SIZE, cursor=cursor, estimate_count=True)
+        except model.Error:
+          if cursor is None:
+            raise
+          results = page = table.Paginate(
+              self.connection, PAGE_SIZE, estimate_count=True)
+      else:
+        results = getattr(table, methodname)(self.connection)
       resultslist = []
       for result in results:
         resultslist.append({'result': result.values(),
                             'key': result.key})
       if resultslist:
-        return result.keys(), resultslist
-      return (), ()
+        return result.keys(), resultslist, page
+      return (), (), page
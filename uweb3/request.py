@@ -7,11 +7,12 @@ import cgi
 import sys
 import urllib
 import io
-from cgi import parse_qs
+from urllib.parse import parse_qs, parse_qsl
 import io as stringIO
 import http.cookies as cookie
 import re
 import json
+import tempfile
 
 # uWeb modules
 from . import response
@@ -21,6 +22,10 @@ class CookieTooBigError(Exception):
   """Error class for cookie when size is bigger than 4096 bytes"""
 
 
+class RequestBodyTooLargeError(Exception):
+  """The request body exceeds the configured maximum size."""
+
+
 class Cookie(cookie.SimpleCookie):
   """Cookie class that uses the most specific value for a cookie name.
 
@@ -49,32 +54,174 @@ class Cookie(cookie.SimpleCookie):
       dict.__setitem__(self, key, morsel)
 
 
+class LazyVars(dict):
+  """Dictionary of request variables that are parsed on first access.
+
+  Each variable has a loader function, which is only called when the variable
+  is first requested. Membership tests do not trigger any parsing.
+  """
+  def __init__(self, loaders):
+    super(LazyVars, self).__init__()
+    self._loaders = loaders
+
+  def __missing__(self, key):
+    # The loader is only dropped once it succeeded, so failures can be retried.
+    value = self._loaders[key]()
+    self._loaders.pop(key, None)
+    super(LazyVars, self).__setitem__(key, value)
+    return value
+
+  def __contains__(self, key):
+    return key in self._loaders or super(LazyVars, self).__contains__(key)
+
+  def __setitem__(self, key, value):
+    self._loaders.pop(key, None)
+    super(LazyVars, self).__setitem__(key, value)
+
+  def __iter__(self):
+    self._LoadAll()
+    return super(LazyVars, self).__iter__()
+
+  def __len__(self):
+    return len(self._loaders) + super(LazyVars, self).__len__()
+
+  def _LoadAll(self):
+    """Runs all pending loaders."""
+    for key in list(self._loaders):
+      self[key]
+
+  def get(self, key, default=None):
+    """Returns the value for `key` if its present, otherwise `default`."""
+    if key in self:
+      return self[key]
+    return default
+
+  def items(self):
+    self._LoadAll()
+    return super(LazyVars, self).items()
+
+  def keys(self):
+    self._LoadAll()
+    return super(LazyVars, self).keys()
+
+  def values(self):
+    self._LoadAll()
+    return super(LazyVars, self).values()
+
+
+class BoundedInput(object):
+  """Wraps the wsgi input stream and refuses to read beyond a maximum size."""
+  def __init__(self, stream, max_size):
+    self.stream = stream
+    self.max_size = max_size
+    self.position = 0
+
+  def _Count(self, data):
+    self.position += len(data)
+    if self.max_size is not None and self.position > self.max_size:
+      raise RequestBodyTooLargeError(
+          'Request body exceeds %d bytes' % self.max_size)
+    return data
+
+  def read(self, size=-1):
+    if self.max_size is not None and (size is None or size < 0):
+      size = self.max_size - self.position + 1
+    return self._Count(self.stream.read(size))
+
+  def readline(self, size=-1):
+    return self._Count(self.stream.readline(size))
+
+
 class Request(object):
+  # Maximum size of the request body in bytes, None for no limit.
+  MAX_BODY_SIZE = None
+
   def __init__(self, env, registry):
     self.env = env
-    self.headers = dict(self.headers_from_env(env))
     self.registry = registry
     self._out_headers = []
     self._out_status = 200
     self._response = None
+    self._headers = None
+    self._input = None
     self.method = self.env['REQUEST_METHOD']
-    self.vars = {'cookie': dict((name, value.value) for name, value in
-                                Cookie(self.env.get('HTTP_COOKIE')).items()),
-                 'get': QueryArgsDict(cgi.parse_qs(self.env['QUERY_STRING']))}
-    self.env['host'] = self.headers.get('Host', '')
+    self.env['host'] = self.env.get('HTTP_HOST', '')
+    # Cookies, query arguments and the request body are only parsed on demand.
+    loaders = {'cookie': self._ParseCookies,
+               'get': self._ParseQueryString}
     if self.method in ('POST', 'PUT', 'DELETE'):
-      request_body_size = 0
-      try:
-        request_body_size = int(self.env.get('CONTENT_LENGTH', 0))
-      except Exception:
-        pass
-      request_payload = self.env['wsgi.input'].read(request_body_size)
-      self.input = request_payload
-      if self.env['CONTENT_TYPE'] == 'application/json':
-        self.vars[self.method.lower()] = json.loads(request_payload)
-      else:
-        self.vars[self.method.lower()] = IndexedFieldStorage(stringIO.StringIO(request_payload.decode("utf-8")),
-             environ={'REQUEST_METHOD': 'POST'})
+      loaders[self.method.lower()] = self._ParseBody
+    self.vars = LazyVars(loaders)
+
+  @property
+  def cookies(self):
+    """Returns a dictionary of the cookies sent with the request."""
+    return self.vars['cookie']
+
+  @property
+  def headers(self):
+    """Returns a dictionary of the request headers, with lowercase names."""
+    if self._headers is None:
+      self._headers = dict(self.headers_from_env(self.env))
+    return self._headers
+
+  @property
+  def content_length(self):
+    """Returns the announced length of the request body, or None if unknown."""
+    try:
+      return int(self.env['CONTENT_LENGTH'])
+    except (KeyError, TypeError, ValueError):
+      return None
+
+  @property
+  def body(self):
+    """Returns the request body as a file-like object.
+
+    The size of the body is checked against MAX_BODY_SIZE before anything is
+    read, bodies that exceed it raise a RequestBodyTooLargeError.
+    """
+    length = self.content_length
+    if (self.MAX_BODY_SIZE is not None and length is not None
+        and length > self.MAX_BODY_SIZE):
+      raise RequestBodyTooLargeError(
+          'Request body of %d bytes exceeds %d bytes' % (
+              length, self.MAX_BODY_SIZE))
+    return BoundedInput(self.env['wsgi.input'], self.MAX_BODY_SIZE)
+
+  @property
+  def input(self):
+    """Returns the raw request body, this is read on first access."""
+    if self._input is None:
+      length = self.content_length
+      body = self.body
+      self._input = body.read(length) if length is not None else b''
+    return self._input
+
+  def _ParseCookies(self):
+    """Returns the request cookies as a dictionary."""
+    return dict((name, value.value) for name, value in
+                Cookie(self.env.get('HTTP_COOKIE')).items())
+
+  def _ParseQueryString(self):
+    """Returns the query arguments of the request as QueryArgsDict."""
+    return QueryArgsDict(parse_qs(self.env.get('QUERY_STRING', '')))
+
+  def _ParseBody(self):
+    """Returns the parsed request body, as JSON or IndexedFieldStorage."""
+    content_type = self.env.get('CONTENT_TYPE', '')
+    if content_type.startswith('multipart/form-data'):
+      # Multipart bodies are parsed straight from the input stream, so uploaded
+      # files never have to be held in memory as a whole.
+      headers = {'content-type': content_type}
+      if self.content_length is not None:
+        headers['content-length'] = str(self.content_length)
+      return IndexedFieldStorage(self.body, headers=headers,
+                                 environ={'REQUEST_METHOD': 'POST'})
+    request_payload = self.input
+    if content_type == 'application/json':
+      return json.loads(request_payload)
+    return IndexedFieldStorage(stringIO.StringIO(request_payload.decode("utf-8")),
+         environ={'REQUEST_METHOD': 'POST'})
 
   @property
   def path(self):
@@ -174,27 +321,81 @@ class IndexedFieldStorage(cgi.FieldStorage):
        Multiple occurrances of 'foo[bar]' will result in unspecified behavior.
     3) Automatically attempts to parse all input as UTF8. This is the proposed
        standard as of 2005: http://tools.ietf.org/html/rfc3986.
+    4) Uploaded files in multipart/form-data are returned as UploadedFile
+       objects, rather than being read into memory as a whole. Files larger
+       than SPOOL_SIZE bytes are written to a temporary file while parsing.
   """
   FIELD_AS_ARRAY = re.compile(r'(.*)\[(.*)\]')
+  SPOOL_SIZE = 1024 * 1024
+
   def iteritems(self):
     return ((key, self.getlist(key)) for key in self)
 
   def items(self):
     return list(self.iteritems())
 
-  def read_urlencoded(self):
+  def getfirst(self, key, default=None):
+    """Returns the first value for the requested key, or a fallback value."""
+    values = self.getlist(key)
+    return values[0] if values else default
+
+  def getlist(self, key):
+    """Returns a list with all values that were given for the requested key.
+
+    N.B. If the given key does not exist, an empty list is returned.
+    """
+    if key not in self:
+      return []
+    fields = self[key]
+    if not isinstance(fields, list):
+      fields = [fields]
+    return [self._FieldValue(field) for field in fields]
+
+  @staticmethod
+  def _FieldValue(field):
+    """Returns the value of a field, or an UploadedFile for file fields."""
+    if getattr(field, 'filename', None):
+      return UploadedFile(field)
+    return field.value
+
+  def _IndexFields(self, fields):
+    """Groups fields with 'foo[bar]' style names into dictionaries.
+
+    Arguments:
+      @ fields: iterable of (name, field)
+        The field objects with their names, in order of appearance.
+    """
     indexed = {}
     self.list = []
-    for field, value in cgi.parse_qsl(self.fp.read(self.length),
-                                      self.keep_blank_values,
-                                      self.strict_parsing):
-      if self.FIELD_AS_ARRAY.match(str(field)):
-        field_group, field_key = self.FIELD_AS_ARRAY.match(field).groups()
+    for name, field in fields:
+      array_field = self.FIELD_AS_ARRAY.match(str(name))
+      if array_field:
+        field_group, field_key = array_field.groups()
         indexed.setdefault(field_group, cgi.MiniFieldStorage(field_group, {}))
-        indexed[field_group].value[field_key] = value
+        indexed[field_group].value[field_key] = self._FieldValue(field)
       else:
-        self.list.append(cgi.MiniFieldStorage(field, value))
+        self.list.append(field)
     self.list = list(indexed.values()) + self.list
+
+  def make_file(self):
+    """Returns a file that stays in memory up to SPOOL_SIZE bytes."""
+    if self._binary_file:
+      return tempfile.SpooledTemporaryFile(max_size=self.SPOOL_SIZE, mode='w+b')
+    return tempfile.SpooledTemporaryFile(
+        max_size=self.SPOOL_SIZE, mode='w+', encoding=self.encoding,
+        newline='\n')
+
+  def read_multi(self, environ, keep_blank_values, strict_parsing):
+    super(IndexedFieldStorage, self).read_multi(
+        environ, keep_blank_values, strict_parsing)
+    self._IndexFields((field.name, field) for field in self.list)
+
+  def read_urlencoded(self):
+    self._IndexFields(
+        (field, cgi.MiniFieldStorage(field, value)) for field, value in
+        parse_qsl(self.fp.read(self.length),
+                  self.keep_blank_values,
+                  self.strict_parsing))
     self.skip_lines()
 
   def __repr__(self):
@@ -208,6 +409,42 @@ class IndexedFieldStorage(cgi.FieldStorage):
     return d
 
 
+class UploadedFile(object):
+  """A file uploaded through a multipart/form-data request.
+
+  This behaves as a (read-only) file object, with the uploaded content, and has
+  the following additional attributes:
+    name: The name of the form field.
+    filename: The filename as given by the client.
+    content_type: The content type as given by the client.
+    size: The size of the file in bytes.
+  """
+  def __init__(self, field):
+    self.name = field.name
+    self.filename = field.filename
+    self.content_type = field.type
+    self.file = field.file
+
+  def __getattr__(self, attribute):
+    return getattr(self.file, attribute)
+
+  def __iter__(self):
+    return iter(self.file)
+
+  def __repr__(self):
+    return '<%s %r (%s, %d bytes)>' % (
+        type(self).__name__, self.filename, self.content_type, self.size)
+
+  @property
+  def size(self):
+    """Returns the size of the uploaded file in bytes."""
+    position = self.file.tell()
+    self.file.seek(0, io.SEEK_END)
+    size = self.file.tell()
+    self.file.seek(position)
+    return size
+
+
 class QueryArgsDict(dict):
   def getfirst(self, key, default=None):
     """Returns the first value for the requested key, or a fallback value."""
@@ -7,10 +7,12 @@ try:
 except ImportError:
   import http.client as httplib
 
+import codecs
+import collections.abc
 import json
 
 from collections import defaultdict
-from .libs.safestring import JSONsafestring
+from .libs.safestring import Basesafestring, JSONsafestring
 
 class Response(object):
   """Defines a full HTTP response.
@@ -26,9 +28,12 @@ class Response(object):
     """Initializes a Page object.
 
     Arguments:
-      @ content: str
+      @ content: str / iterable
         The content to return to the client. This can be either plain text, html
-        or the contents of a file (images for example).
+        or the contents of a file (images for example). An iterable (such as a
+        generator or a list) of str and/or bytes chunks is streamed to the
+        client. For JSON responses, only iterators are streamed; other
+        iterables are the value to encode.
       % content_type: str ~~ CONTENT_TYPE ('text/html' by default)
         The content type of the response. This should NOT be set in headers.
       % httpcode: int ~~ 200
@@ -72,6 +77,17 @@ class Response(object):
   def text(self, content):
     self.content = content
 
+  @property
+  def streaming(self):
+    """Returns whether the content is an iterable that should be streamed."""
+    content = self.content
+    if isinstance(content, (str, bytes, bytearray, collections.abc.Mapping)):
+      return False
+    if isinstance(content, collections.abc.Iterator):
+      return True
+    return (isinstance(content, collections.abc.Iterable) and
+            not self.clean_content_type().startswith('application/json'))
+
   # Retrieve a header list
   @property
   def headerlist(self):
@@ -99,6 +115,110 @@ class Response(object):
     return self.content
 
 
+class FileResponse(Response):
+  """A response that sends (part of) an open file as its body.
+
+  The file is not read into memory; the WSGI handler streams it to the client
+  through the server's `wsgi.file_wrapper` where possible, so the server can use
+  sendfile(), or in blocks otherwise.
+  """
+  BLOCK_SIZE = 64 * 1024
+
+  def __init__(self, fileobj, offset=0, length=None, **kwds):
+    """Initializes a FileResponse.
+
+    Arguments:
+      @ fileobj: file
+        The file to send, opened in binary mode. It is closed after sending.
+      % offset: int ~~ 0
+        The position in the file to start sending from.
+      % length: int ~~ None
+        The number of bytes to send, None sends the file up to its end.
+      % **kwds: Response arguments such as content_type, httpcode and headers.
+    """
+    super(FileResponse, self).__init__(**kwds)
+    self.file = fileobj
+    self.offset = offset
+    self.length = length
+
+  def Body(self, env):
+    """Returns the WSGI iterable for the file, given the WSGI environment."""
+    file_wrapper = env.get('wsgi.file_wrapper')
+    if file_wrapper is not None and not self.offset and self.length is None:
+      return file_wrapper(self.file, self.BLOCK_SIZE)
+    return self.Iterate()
+
+  def Iterate(self):
+    """Yields the (selected part of the) file in blocks of BLOCK_SIZE."""
+    try:
+      self.file.seek(self.offset)
+      remaining = self.length
+      while remaining is None or remaining > 0:
+        size = self.BLOCK_SIZE
+        if remaining is not None:
+          size = min(size, remaining)
+          remaining -= size
+        block = self.file.read(size)
+        if not block:
+          break
+        yield block
+    finally:
+      self.file.close()
+
+
+class StreamingBody(object):
+  """WSGI iterable for a streamed response body.
+
+  Chunks of text are escaped for the response's content type (unless they're
+  already safe strings) and encoded incrementally; bytes are passed on as-is.
+  When the server closes the iterable, the given callbacks are called, so that
+  request cleanup happens only after the last chunk was sent.
+  """
+  def __init__(self, chunks, charset, escape=None, on_close=()):
+    """Initializes a StreamingBody.
+
+    Arguments:
+      @ chunks: iterator
+        The str and/or bytes chunks that make up the body.
+      @ charset: str
+        The character set to encode text chunks in.
+      % escape: callable ~~ None
+        Makes a text chunk safe for the content type, like the encoders of
+        uWeb do for regular responses.
+      % on_close: iterable of callables ~~ ()
+        Functions to call when the body is closed.
+    """
+    self.chunks = chunks
+    self.escape = escape
+    self.encoder = codecs.getincrementalencoder(charset)()
+    self.on_close = list(on_close)
+
+  def __iter__(self):
+    for chunk in self.chunks:
+      if isinstance(chunk, (bytes, bytearray)):
+        if chunk:
+          yield chunk
+        continue
+      if self.escape is not None and not isinstance(chunk, Basesafestring):
+        chunk = self.escape(chunk)
+      chunk = self.encoder.encode(chunk)
+      if chunk:
+        yield chunk
+    chunk = self.encoder.encode('', final=True)
+    if chunk:
+      yield chunk
+
+  def close(self):
+    """Closes the chunk iterator and calls the on_close callbacks."""
+    try:
+      if hasattr(self.chunks, 'close'):
+        self.chunks.close()
+    finally:
+      callbacks, self.on_close = self.on_close, []
+      for callback in callbacks:
+        callback()
+
+
 class Redirect(Response):
   """A response tailored to do redirects."""
   REDIRECT_PAGE = ('<!DOCTYPE html><html><head><title>Page moved</title></head>'
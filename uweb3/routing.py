@@ -0,0 +1,283 @@
+#!/usr/bin/python3
+"""uWeb3 compiled request routing.
+
+Classes:
+  DispatchTable: Resolves urls against a list of routes without scanning them
+                 one by one for each request.
+"""
+
+# Standard modules
+import re
+
+# Package modules
+from .libs.cache import LRUCache
+
+# Characters that end the literal prefix of a route pattern.
+REGEX_SPECIAL = frozenset('.^$*+?{}[]|()')
+REGEX_QUANTIFIERS = frozenset('*+?{')
+# Route patterns that use these constructs can't be merged into one alternation.
+UNCOMBINABLE = re.compile(r'\\[1-9]|\(\?P[<=]|\(\?\(')
+
+
+def LiteralPrefix(pattern):
+  """Returns the literal string that every url matching `pattern` starts with.
+
+  The prefix ends at the first regex construct, if the final literal character
+  is quantified it is dropped from the prefix. Patterns with a top-level
+  alternation can match anything and have no prefix at all.
+
+  Arguments:
+    @ pattern: str
+      The (uncompiled) regex pattern for a route.
+
+  Returns:
+    str: the literal prefix, possibly empty.
+  """
+  depth = 0
+  escaped = in_class = False
+  for char in pattern:
+    if escaped:
+      escaped = False
+    elif char == '\\':
+      escaped = True
+    elif in_class:
+      in_class = char != ']'
+    elif char == '[':
+      in_class = True
+    elif char == '(':
+      depth += 1
+    elif char == ')':
+      depth -= 1
+    elif char == '|' and not depth:
+      return ''
+
+  prefix = []
+  index = 0
+  if pattern.startswith('^'):
+    index = 1
+  while index < len(pattern):
+    char = pattern[index]
+    if char == '\\':
+      escaped = pattern[index + 1:index + 2]
+      if not escaped or escaped.isalnum():
+        break  # Character classes like \d or \w, or anchors like \A.
+      char = escaped
+      index += 1
+    elif char in REGEX_SPECIAL:
+      break
+    following = pattern[index + 1:index + 2]
+    if following and following in REGEX_QUANTIFIERS:
+      break
+    prefix.append(char)
+    index += 1
+  return ''.join(prefix)
+
+
+class Route(object):
+  """A single compiled route, as configured on the Router."""
+  __slots__ = ('pattern', 'regex', 'handler', 'method', 'host', 'hostregex',
+               'page_maker', 'prefix', 'combinable')
+
+  def __init__(self, pattern, handler, method, host, page_maker):
+    """Initializes a Route.
+
+    Arguments:
+      @ pattern: str
+        The regex (without end anchor) that urls should match.
+      @ handler: str
+        Name of the handler method on the `page_maker`.
+      @ method: str
+        The http method this route applies to, or 'ALL'.
+      @ host: str
+        The host pattern (regex) this route applies to, or '*'.
+      @ page_maker: PageMaker
+        The pagemaker class that provides the handler.
+    """
+    self.pattern = pattern
+    self.regex = re.compile(pattern + '$', re.UNICODE)
+    self.handler = handler
+    self.method = method
+    self.host = host
+    self.hostregex = None
+    if host != '*':
+      self.hostregex = re.compile(f"^{host}$", re.IGNORECASE)
+    self.page_maker = page_maker
+    self.prefix = LiteralPrefix(pattern)
+    self.combinable = not UNCOMBINABLE.search(pattern)
+
+  def __repr__(self):
+    return '%s(%r, %r)' % (type(self).__name__, self.pattern, self.handler)
+
+
+class RouteMatcher(object):
+  """Matches an url against an ordered set of candidate routes at once.
+
+  Where possible the candidate patterns are combined into a single alternation
+  regex. Python regexes try alternatives from left to right, so the first route
+  that matches is the one that is returned, exactly like a linear scan would.
+  """
+  def __init__(self, routes):
+    self.routes = routes
+    self.combined = None
+    if len(routes) > 1 and all(route.combinable for route in routes):
+      self._Combine()
+
+  def _Combine(self):
+    """Builds the alternation regex and the group offsets for each route."""
+    alternatives = []
+    self.offsets = {}
+    group = 1
+    for route in self.routes:
+      alternatives.append('(%s$)' % route.pattern)
+      self.offsets[group] = route, group, group + route.regex.groups
+      group += route.regex.groups + 1
+    try:
+      self.combined = re.compile('|'.join(alternatives), re.UNICODE)
+    except (re.error, OverflowError, RecursionError):
+      self.combined = None
+
+  def Match(self, url):
+    """Returns the first matching route and its regex groups, or None."""
+    if self.combined is not None:
+      match = self.combined.match(url)
+      if match is None:
+        return None
+      # The wrapping group of an alternative closes last, so it's `lastindex`.
+      route, start, end = self.offsets[match.lastindex]
+      return route, match.groups()[start:end]
+    for route in self.routes:
+      match = route.regex.match(url)
+      if match:
+        return route, match.groups()
+    return None
+
+
+class TrieNode(object):
+  """Node in the literal prefix trie of a DispatchTable bucket."""
+  __slots__ = ('children', 'routes', 'matcher')
+
+  def __init__(self):
+    self.children = {}
+    self.routes = []
+    self.matcher = None
+
+
+class RouteBucket(object):
+  """All routes that may apply to a given method and host, indexed by prefix.
+
+  Every route is stored in the trie under its literal prefix. The candidates for
+  an url are all routes whose prefix the url starts with; these are precombined
+  into a RouteMatcher for each trie node that holds routes.
+  """
+  def __init__(self, routes):
+    self.root = TrieNode()
+    for position, route in enumerate(routes):
+      node = self.root
+      for char in route.prefix:
+        node = node.children.setdefault(char, TrieNode())
+      node.routes.append((position, route))
+    self._CompileNode(self.root, [])
+
+  def _CompileNode(self, node, candidates):
+    """Attaches matchers to `node` and its descendants."""
+    if node.routes or node is self.root:
+      candidates = sorted(candidates + node.routes, key=lambda item: item[0])
+      node.matcher = RouteMatcher([route for _position, route in candidates])
+    for child in node.children.values():
+      self._CompileNode(child, candidates)
+
+  def Match(self, url):
+    """Returns the first matching route and its regex groups, or None."""
+    node = self.root
+    matcher = node.matcher
+    for char in url:
+      node = node.children.get(char)
+      if node is None:
+        break
+      if node.matcher is not None:
+        matcher = node.matcher
+    return matcher.Match(url)
+
+
+class DispatchTable(object):
+  """Resolves requests to routes, with first-match-wins semantics.
+
+  Routes are grouped in buckets per request method and set of matching host
+  patterns. Buckets are compiled the first time they are needed.
+
+  Resolved routes are kept in an LRU cache keyed on method, host and url, so
+  that frequently requested urls skip regex matching entirely.
+  """
+  def __init__(self, routes, cache_size=1024):
+    """Initializes the DispatchTable.
+
+    Arguments:
+      @ routes: list of Route
+        The routes to dispatch to, in order of precedence.
+      % cache_size: int ~~ 1024
+        Number of resolved routes to cache, 0 disables the cache.
+    """
+    self.routes = list(routes)
+    self.hosts = {}
+    for route in self.routes:
+      if route.hostregex is not None:
+        self.hosts.setdefault(route.host, route.hostregex)
+    self.cache = LRUCache(cache_size)
+    self._buckets = {}
+
+  def _Bucket(self, method, hosts):
+    """Returns the (cached) RouteBucket for the method and matching hosts."""
+    key = method, hosts
+    try:
+      return self._buckets[key]
+    except KeyError:
+      pass
+    bucket = RouteBucket([
+        route for route in self.routes
+        if route.method in ('ALL', method)
+        and (route.host == '*' or route.host in hosts)])
+    self._buckets[key] = bucket
+    return bucket
+
+  def _MatchingHosts(self, host):
+    """Returns a dict of host patterns that match `host`, with their groups."""
+    matches = {}
+    for hostpattern, hostregex in self.hosts.items():
+      hostmatch = hostregex.match(host)
+      if hostmatch:
+        matches[hostpattern] = hostmatch.groups()
+    return matches
+
+  def Resolve(self, url, method, host):
+    """Returns the route handler and arguments for the request, or None.
+
+    Arguments:
+      @ url: str
+        The URL requested by the client.
+      @ method: str
+        The http method requested by the client.
+      @ host: str
+        The http host header value requested by the client.
+
+    Returns:
+      4-tuple: handler name, tuple of pattern matches, host matches and the
+               pagemaker class. None if no route matches.
+    """
+    key = method, host, url
+    resolved = self.cache.Get(key)
+    if resolved is not None:
+      return resolved
+    hostmatches = self._MatchingHosts(host) if self.hosts else {}
+    bucket = self._Bucket(method, tuple(hostmatches))
+    result = bucket.Match(url)
+    if result is None:
+      # Misses are not cached, or random urls would flush the popular ones.
+      return None
+    route, groups = result
+    # strip out optional groups, as they return '', which would override
+    # the handlers default argument values later on in the page_maker
+    groups = tuple(group for group in groups if group)
+    resolved = (
+        route.handler, groups, hostmatches.get(route.host), route.page_maker)
+    self.cache.Set(key, resolved)
+    return resolved
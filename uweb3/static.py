@@ -0,0 +1,134 @@
+#!/usr/bin/python3
+"""uWeb3 in-memory cache for small static files.
+
+Classes:
+  StaticEntry: A cached static file, with its precomputed headers and
+               compressed variants.
+  StaticCache: Bounded cache of StaticEntry objects, that revalidates entries
+               against the file's modification time.
+"""
+
+# Standard modules
+import os
+import time
+
+# Package modules
+from .libs import compression
+from .libs.cache import LRUCache
+
+# Content types for which compressed variants are prepared.
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json',
+                      'application/xml', 'image/svg+xml')
+
+
+class StaticEntry(object):
+  """A static file held in memory."""
+  __slots__ = ('path', 'mtime', 'mtime_ns', 'size', 'etag', 'content_type',
+               'headers', 'body', 'variants', 'checked')
+
+  def __init__(self, path, stat, content_type, headers, body):
+    self.path = path
+    self.mtime = stat.st_mtime
+    self.mtime_ns = stat.st_mtime_ns
+    self.size = stat.st_size
+    self.etag = '"%x-%x"' % (stat.st_mtime_ns, stat.st_size)
+    self.content_type = content_type
+    self.headers = headers
+    self.body = body
+    self.variants = {}
+    self.checked = time.time()
+
+  @property
+  def cost(self):
+    """The number of bytes this entry holds in memory."""
+    return len(self.body) + sum(len(body) for body in self.variants.values())
+
+  def VariantTag(self, encoding):
+    """Returns the ETag for the given content coding of this file."""
+    if encoding is None:
+      return self.etag
+    return '%s-%s"' % (self.etag[:-1], encoding)
+
+
+class StaticCache(object):
+  """Keeps small static files in memory, bounded by their total size.
+
+  Entries are revalidated against the modification time and size of the file
+  on disk at most once every `check_interval` seconds.
+  """
+  def __init__(self, max_size=16 * 1024 * 1024, max_file_size=256 * 1024,
+               check_interval=2, compress_level=6, compress_min_size=256):
+    """Initializes a StaticCache.
+
+    Arguments:
+      % max_size: int ~~ 16MiB
+        The maximum number of bytes held by the cache, including variants.
+      % max_file_size: int ~~ 256KiB
+        Files larger than this are never cached.
+      % check_interval: float ~~ 2
+        Seconds between checks of a cached file's modification time.
+      % compress_level: int ~~ 6
+        The compression level for the gzip and brotli variants.
+      % compress_min_size: int ~~ 256
+        Files smaller than this are not compressed.
+    """
+    self.max_file_size = max_file_size
+    self.check_interval = check_interval
+    self.compress_level = compress_level
+    self.compress_min_size = compress_min_size
+    self.entries = LRUCache(max_size)
+
+  def Add(self, path, stat, content_type, headers, body):
+    """Caches the given file content and returns its StaticEntry.
+
+    Compressed variants are only kept when they are smaller than the original.
+
+    Arguments:
+      @ path: str
+        The absolute path of the file.
+      @ stat: os.stat_result
+        The result of stat() for the file at the time it was read.
+      @ content_type: str
+        The content type of the file.
+      @ headers: dict
+        The response headers that do not change between requests.
+      @ body: bytes
+        The content of the file.
+    """
+    entry = StaticEntry(path, stat, content_type, headers, body)
+    if (len(body) >= self.compress_min_size and
+        content_type.startswith(COMPRESSIBLE_TYPES)):
+      for encoding in compression.ENCODINGS:
+        variant = compression.Compress(body, encoding, self.compress_level)
+        if len(variant) < len(body):
+          entry.variants[encoding] = variant
+    self.entries.Set(path, entry, cost=entry.cost)
+    return entry
+
+  def Get(self, path):
+    """Returns the StaticEntry for `path`, or None if it's not (validly) cached.
+
+    Arguments:
+      @ path: str
+        The absolute path of the file.
+    """
+    entry = self.entries.Get(path)
+    if entry is None:
+      return None
+    now = time.time()
+    if now - entry.checked >= self.check_interval:
+      try:
+        current = os.stat(path)
+      except OSError:
+        self.entries.Del(path)
+        return None
+      if (current.st_mtime_ns, current.st_size) != (entry.mtime_ns, entry.size):
+        self.entries.Del(path)
+        return None
+      entry.checked = now
+    return entry
+
+  def Stats(self):
+    """Returns a dictionary with the cache size and its usage counters."""
+    return self.entries.Stats()
+
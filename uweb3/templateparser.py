@@ -18,6 +18,9 @@ import os
 import re
 import urllib.parse as urlparse
 from .libs.safestring import *
+from .libs import cache
+from .libs import metrics
+import functools
 import hashlib
 import itertools
 import ast, math
@@ -61,9 +64,9 @@ class LazyTagValueRetrieval(object):
   lazy retrieval of tag values means that shortcircuit conditional expressions
   become possible.
   """
-  def __init__(self, values):
+  def __init__(self, values, tags=None):
     self._values = values
-    self._tags = {}
+    self._tags = {} if tags is None else tags
 
   # ############################################################################
   # Methods for delayed tag value retrieval
@@ -137,8 +140,12 @@ class Parser(dict):
   Beyond parsing, the parser grants easy access to the TAG_FUNCTIONS dictionary,
   providing the `RegisterFunction` method to add or replace functions in this
   module constant.
+
+  Rendered fragments of templates, marked with {{ cache }}, or whole templates
+  parsed with `ParseCached`, are kept in the parser's `fragment_cache`.
   """
-  def __init__(self, path='.', templates=(), noparse=False):
+  def __init__(self, path='.', templates=(), noparse=False,
+               fragment_cache=None):
     """Initializes a Parser instance.
 
     This sets up the template directory and preloads any templates given.
@@ -151,10 +158,15 @@ class Parser(dict):
       % noparse: Bool ~~ False
         Skip parsing the templates to output, instead return their
         structure and replaced values
+      % fragment_cache: cache backend ~~ None
+        The cache that holds rendered fragments, a TTLCache or FileCache from
+        `uweb3.libs.cache`. Defaults to an in-process TTLCache.
     """
     super(Parser, self).__init__()
     self.template_dir = path
     self.noparse = noparse
+    self.fragment_cache = (
+        cache.TTLCache() if fragment_cache is None else fragment_cache)
     self.tags = {}
     self.requesttags = {}
     self.astvisitor = AstVisitor(EVALWHITELIST)
@@ -225,7 +237,80 @@ class Parser(dict):
       replacements.update(self.tags)
     if self.requesttags:
       replacements.update(self.requesttags)
-    return self[template].Parse(**replacements)
+    with metrics.Phase('template'):
+      return self[template].Parse(**replacements)
+
+  def Stream(self, template, **replacements):
+    """Returns an iterator over the parsed template, in HTML safe chunks.
+
+    This works like `Parse`, but the template is rendered while the chunks are
+    consumed, instead of all at once. The iterator can be returned as the
+    content of a Response, which then streams the page to the client.
+
+    Arguments:
+      @ template: str
+        Template name, or the relative path to find it on.
+      @ **replacements: dict
+        Dictionary of replacement objects. Tags are looked up in here.
+
+    Returns:
+      iterator: HTMLsafestring chunks of the parsed template.
+    """
+    if self.tags:
+      replacements.update(self.tags)
+    if self.requesttags:
+      replacements.update(self.requesttags)
+    return metrics.Timed(self[template].Iterate(**replacements), 'template')
+
+  def ParseCached(self, template, key, ttl=None, **replacements):
+    """Returns the parsed template, from the fragment cache where possible.
+
+    The output is cached by the template name, its modification time and the
+    given `key`. The key should identify the replacements that the output
+    depends on, as they are not looked at to find the cached output.
+
+    Arguments:
+      @ template: str
+        Template name, or the relative path to find it on.
+      @ key: str
+        Identifies the output among the others for this template.
+      % ttl: float ~~ None
+        Seconds the output is cached, defaults to the ttl of the cache.
+      @ **replacements: dict
+        Dictionary of replacement objects. Tags are looked up in here.
+
+    Returns:
+      HTMLsafestring: The template with relevant tags replaced.
+    """
+    if self.noparse:
+      return self.Parse(template, **replacements)
+    tmpl = self[template]
+    if isinstance(tmpl, FileTemplate):
+      tmpl.ReloadIfModified()
+    return self.CacheFragment(
+        '%s:%s:%s' % (template, getattr(tmpl, '_file_mtime', 0), key),
+        lambda: self.Parse(template, **replacements), ttl=ttl)
+
+  def CacheFragment(self, key, render, ttl=None):
+    """Returns the cached output for `key`, rendering and storing it if needed.
+
+    Arguments:
+      @ key: str
+        The key of the output in the fragment cache.
+      @ render: callable
+        Returns the output when it is not cached, called without arguments.
+      % ttl: float ~~ None
+        Seconds the output is cached, defaults to the ttl of the cache.
+    """
+    fragment = self.fragment_cache.Get(key)
+    if fragment is None:
+      fragment = render()
+      self.fragment_cache.Set(key, fragment, ttl=ttl)
+    return fragment
+
+  def FragmentStats(self):
+    """Returns the size and the hit and miss counters of the fragment cache."""
+    return self.fragment_cache.Stats()
 
   def ParseString(self, template, **replacements):
     """Returns the given `template` with its tags replaced by **replacements.
@@ -245,7 +330,8 @@ class Parser(dict):
       replacements.update(self.tags)
     if self.requesttags:
       replacements.update(self.requesttags)
-    return Template(template, parser=self).Parse(**replacements)
+    with metrics.Phase('template'):
+      return Template(template, parser=self).Parse(**replacements)
 
   @staticmethod
   def RegisterFunction(name, function):
@@ -321,6 +407,8 @@ class Template(list):
         )+)?                        # end of function block
       \])                         # end of tag""",
       re.VERBOSE)
+  # Approximate size (in characters) of the chunks yielded by `Iterate`.
+  CHUNK_SIZE = 8192
 
   def __init__(self, raw_template, parser=None):
     """Initializes a Template from a string.
@@ -393,13 +481,33 @@ class Template(list):
         raise TemplateSyntaxError('Closed %d scopes too many' % abs(scope_diff))
       raise TemplateSyntaxError('Template left %d open scopes.' % scope_diff)
 
+  def Iterate(self, **kwds):
+    """Yields the parsed template as HTMLsafestring chunks.
+
+    The parts of the template are rendered one after the other, and their
+    output is yielded in chunks of about CHUNK_SIZE characters. Only the chunk
+    that is being built is held in memory.
+    """
+    buffer = []
+    size = 0
+    for node in self:
+      for piece in node.Iterate(**kwds):
+        buffer.append(piece)
+        size += len(piece)
+        if size >= self.CHUNK_SIZE:
+          yield HTMLsafestring(''.join(buffer))
+          buffer = []
+          size = 0
+    if buffer:
+      yield HTMLsafestring(''.join(buffer))
+
   def Parse(self, returnRawTemplate=False, **kwds):
     """Returns the parsed template as HTMLsafestring.
 
     The template is parsed by parsing each of its members and combining that.
+    The `content_hash` of the result is only computed when it is used.
     """
     htmlsafe = HTMLsafestring(''.join(tag.Parse(**kwds) for tag in self))
-    htmlsafe.content_hash = hashlib.md5(htmlsafe.encode()).hexdigest()
     if returnRawTemplate:
       raw = HTMLsafestring(self)
       raw.content_hash = htmlsafe.content_hash
@@ -497,6 +605,14 @@ class Template(list):
     """Processing for {{ endif }} template syntax."""
     self._CloseScope(TemplateConditional)
 
+  def _TemplateConstructCache(self, *nodes):
+    """Processing for {{ cache }} template syntax."""
+    self._StartScope(TemplateCache(self, *nodes))
+
+  def _TemplateConstructEndcache(self):
+    """Processing for {{ endcache }} template syntax."""
+    self._CloseScope(TemplateCache)
+
   # ############################################################################
   # Methods for scope management
   #
@@ -567,6 +683,14 @@ class FileTemplate(Template):
               'page_hash': result.page_hash}
     return result
 
+  def Iterate(self, **kwds):
+    """Yields the parsed template as HTMLsafestring chunks.
+
+    Unlike `Parse`, this always renders the template, also in noparse mode.
+    """
+    self.ReloadIfModified()
+    return super().Iterate(**kwds)
+
   def ReloadIfModified(self):
     """Reloads the template file if it was modified on disk.
 
@@ -595,10 +719,10 @@ class FileTemplate(Template):
 class TemplateConditional(object):
   """A template construct to control flow based on the value of a tag."""
   def __init__(self, expr, astvisitor):
+    self.astvisitor = astvisitor
     self.branches = []
     self.default = None
     self.NewBranch(expr)
-    self.astvisitor = astvisitor
 
   def __repr__(self):
     repr_branches = []
@@ -650,25 +774,22 @@ class TemplateConditional(object):
       raise TemplateSyntaxError('Only one {{ else }} clause is allowed.')
     self.default = []
 
-  def Expression(self, expr, **kwds):
+  @staticmethod
+  def Expression(expr, **kwds):
     """Returns the evaluated result of a tag expression."""
-    nodes = []
-    local_vars = LazyTagValueRetrieval(kwds)
-    for num, node in enumerate(expr):
-      if isinstance(node, TemplateTag):
-        node_name = '__tmpl_var_%d' % num
-        local_vars[node_name] = node
-        nodes.append(node_name)
-      else:
-        nodes.append(node)
     try:
-      return LimitedEval(''.join(nodes), self.astvisitor, local_vars)
+      return expr.Evaluate(kwds)
     except NameError as error:
       raise TemplateNameError(str(error).capitalize() + '. Try it as tagname?')
 
   def NewBranch(self, expr):
-    """Begins a new branch based on the given expression."""
-    self.branches.append((tuple(Template.TagSplit(expr)), []))
+    """Begins a new branch based on the given expression.
+
+    The expression is validated and compiled here, once, rather than each time
+    the conditional is parsed.
+    """
+    self.branches.append((
+        TemplateExpression(Template.TagSplit(expr), self.astvisitor), []))
 
   def Parse(self, **kwds):
     """Returns the TemplateConditional parsed as string.
@@ -684,12 +805,51 @@ class TemplateConditional(object):
     is True, the `else` branch is parsed and returned (where available, if no
     `else` branch exists '' is returned.
     """
+    return ''.join(part.Parse(**kwds) for part in self._Branch(**kwds))
+
+  def Iterate(self, **kwds):
+    """Yields the output of the parts of the branch that applies."""
+    for part in self._Branch(**kwds):
+      yield from part.Iterate(**kwds)
+
+  def _Branch(self, **kwds):
+    """Returns the parts of the first branch whose expression is True.
+
+    If there is none, the `else` branch is returned, or an empty tuple if the
+    conditional does not have one.
+    """
     for expr, branch in self.branches:
       if self.Expression(expr, **kwds):
-        return ''.join(part.Parse(**kwds) for part in branch)
-    if self.default:
-      return ''.join(part.Parse(**kwds) for part in self.default)
-    return ''
+        return branch
+    return self.default or ()
+
+
+class TemplateExpression(tuple):
+  """The parts of a conditional expression, along with its compiled code.
+
+  The tags in the expression are replaced by local names in the code. When the
+  expression is evaluated, those names are bound to the tag values, which are
+  only retrieved when the evaluation gets to them.
+  """
+  def __new__(cls, parts, astvisitor):
+    expression = super(TemplateExpression, cls).__new__(cls, parts)
+    expression.tags = {}
+    nodes = []
+    for num, node in enumerate(expression):
+      if isinstance(node, TemplateTag):
+        node_name = '__tmpl_var_%d' % num
+        expression.tags[node_name] = node
+        nodes.append(node_name)
+      else:
+        nodes.append(node)
+    expression.code = LimitedCompile(''.join(nodes), astvisitor)
+    expression.functions = astvisitor.whitelists['functions']
+    return expression
+
+  def Evaluate(self, kwds):
+    """Returns the result of the expression for the given replacements."""
+    return eval(self.code, self.functions,
+                LazyTagValueRetrieval(kwds, self.tags))
 
 
 class TemplateConditionalPresence(TemplateConditional):
@@ -764,7 +924,21 @@ class TemplateLoop(list):
     iterable, all members of the TemplateLoop body will be parsed, with the
     item from the iterable added to the replacements dict as alias(es).
     """
-    output = []
+    return ''.join(''.join(tag.Parse(**replacements) for tag in self)
+                   for replacements in self._Replacements(**kwds))
+
+  def Iterate(self, **kwds):
+    """Yields the output of the loop body, one part at a time."""
+    for replacements in self._Replacements(**kwds):
+      for tag in self:
+        yield from tag.Iterate(**replacements)
+
+  def _Replacements(self, **kwds):
+    """Yields the replacements for each iteration of the loop.
+
+    The same dictionary is yielded every time, with the alias(es) updated to
+    the current item.
+    """
     replacements = kwds.copy()
     for item in self.tag.Iterator(**kwds):
       if self.aliascount == 1:
@@ -778,8 +952,91 @@ class TemplateLoop(list):
           raise TemplateValueError(
               'Cannot unpack %s into %d tags' % (type(item), self.aliascount))
         replacements.update(zip(self.aliases, item))
-      output.append(''.join(tag.Parse(**replacements) for tag in self))
-    return ''.join(output)
+      yield replacements
+
+
+class TemplateCache(list):
+  """A template construct that caches the rendered output of its body.
+
+  The output is stored in the fragment cache of the template's parser, by the
+  path and modification time of the template, the content of the block and the
+  value of the key, which is a string that may contain tags:
+
+    {{ cache key=[product:id]-[language] ttl=300 }}...{{ endcache }}
+
+  The ttl (in seconds) is optional, the default is the ttl of the cache.
+  Templates without a parser render the block every time.
+  """
+  def __init__(self, template, *options):
+    """Initializes a TemplateCache instance.
+
+    Arguments:
+      @ template: Template
+        The template that the block is part of.
+      @ *options: str
+        The `name=value` options of the block, `key` is required.
+
+    Raises:
+      TemplateSyntaxError: The key is missing, or an option is not valid.
+    """
+    super(TemplateCache, self).__init__()
+    self.template = template
+    self.key = None
+    self.ttl = None
+    for option in options:
+      name, _sep, value = option.partition('=')
+      if not value:
+        raise TemplateSyntaxError('Bad option %r in {{ cache }}' % option)
+      if name == 'key':
+        self.key = tuple(Template.TagSplit(value))
+      elif name == 'ttl':
+        try:
+          self.ttl = float(value)
+        except ValueError:
+          raise TemplateSyntaxError('Bad ttl %r in {{ cache }}' % value)
+      else:
+        raise TemplateSyntaxError('Unknown option %r in {{ cache }}' % name)
+    if self.key is None:
+      raise TemplateSyntaxError('{{ cache }} requires a key')
+
+  def __repr__(self):
+    return '%s(%s)' % (type(self).__name__, list(self))
+
+  def __str__(self):
+    options = ['key=%s' % ''.join(map(str, self.key))]
+    if self.ttl is not None:
+      options.append('ttl=%g' % self.ttl)
+    return '{{ cache %s }}%s{{ endcache }}' % (
+        ' '.join(options), ''.join(map(str, self)))
+
+  @functools.cached_property
+  def digest(self):
+    """Hash of the content of the block, separating blocks in one template."""
+    return hashlib.md5(str(self).encode('utf8')).hexdigest()
+
+  def CacheKey(self, **kwds):
+    """Returns the key of the rendered block in the fragment cache."""
+    return '%s:%s:%s:%s' % (
+        getattr(self.template, '_file_name', ''),
+        getattr(self.template, '_file_mtime', 0),
+        self.digest,
+        ''.join(node.Parse(**kwds) for node in self.key))
+
+  def Parse(self, **kwds):
+    """Returns the rendered block, from the fragment cache where possible."""
+    parser = self.template.parser
+    if parser is None:
+      return self.Render(**kwds)
+    return parser.CacheFragment(
+        self.CacheKey(**kwds), lambda: self.Render(**kwds), ttl=self.ttl)
+
+  def Iterate(self, **kwds):
+    """Yields the rendered block, which is cached as a whole."""
+    yield self.Parse(**kwds)
+
+  def Render(self, **kwds):
+    """Returns the block rendered from its parts, bypassing the cache."""
+    return HTMLsafestring(''.join(part.Parse(**kwds) for part in self))
 
 
 class TemplateTag(object):
@@ -801,6 +1058,10 @@ class TemplateTag(object):
       re.VERBOSE)
   FUNC_FINDER = re.compile('\|([\w-]+(?:\([^()]*?\))?)')
   FUNC_CLOSURE = re.compile('(\w+)\((.*)\)')
+  # Syntax allowed in the arguments of closure functions: literals and math.
+  FUNC_ARGUMENTS = (ast.Expression, ast.Tuple, ast.List, ast.Dict, ast.Set,
+                    ast.Constant, ast.Load, ast.UnaryOp, ast.BinOp,
+                    ast.operator, ast.unaryop)
   ALLOWPRIVATE = False # will we allow access to private members for object lookup
 
   def __init__(self, name, indices=(), functions=()):
@@ -813,10 +1074,16 @@ class TemplateTag(object):
         Indices that should be applied to arrive at the proper tag value.
       % functions: iterable ~~ None
         Names of template functions that should be applied to the value.
+        Closure functions include their arguments, as in `limit(20)`.
+
+    Raises:
+      TemplateSyntaxError: The arguments of a closure function are invalid.
+      TemplateNameError: A function is not a known template function.
     """
     self.name = name
     self.indices = indices if self.ALLOWPRIVATE else list(index for index in indices if not index.startswith('_') or not index.endswith('_'))
     self.functions = functions
+    self.calls = tuple(map(self.ParseFunction, functions))
 
   def __repr__(self):
     return '%s(%r)' % (type(self).__name__, str(self))
@@ -874,28 +1141,61 @@ class TemplateTag(object):
       raise TemplateNameError('No replacement with name %r' % self.name)
 
   @classmethod
-  def ApplyFunction(cls, func, value):
+  def ParseFunction(cls, func):
+    """Returns the name of a tag function and its closure arguments.
+
+    For functions that are not closures, the arguments are None. Arguments may
+    only be literals and math on them; they are evaluated here, once, so that
+    applying the function only has to call it.
+
+    Raises:
+      TemplateSyntaxError: The arguments are not valid.
+      TemplateNameError: The function is not a known template function.
+    """
     closure = cls.FUNC_CLOSURE.match(func)
+    args = None
+    if closure:
+      func, args = closure.groups()
+      if args.strip():
+        try:
+          tree = ast.parse(args + ',', mode='eval')
+        except SyntaxError:
+          raise TemplateSyntaxError('Invalid argument syntax: %r' % args)
+        for node in ast.walk(tree):
+          if isinstance(node, ast.Name):
+            raise TemplateSyntaxError(
+                'Access to scope outside of parser variables is not allowed: '
+                '%r' % node.id)
+          if not isinstance(node, cls.FUNC_ARGUMENTS):
+            raise TemplateSyntaxError('Invalid argument syntax: %r' % args)
+        args = eval(compile(tree, '<string>', 'eval'), {'__builtins__': {}}, {})
+      else:
+        args = ()
+    if func not in TAG_FUNCTIONS:
+      raise TemplateNameError('Unknown template tag function %r' % func)
+    return func, args
+
+  @classmethod
+  def ApplyFunction(cls, func, value):
+    """Applies a tag function to the value and returns the result.
+
+    The function is given as the (name, arguments) of `ParseFunction`, or as
+    the function string from the tag. It is looked up by name, so functions
+    that were replaced after the tag was created are used in their new form.
+    """
+    if isinstance(func, str):
+      func = cls.ParseFunction(func)
+    func, args = func
     try:
-      if not closure:
+      if args is None:
         return TAG_FUNCTIONS[func](value)
-      func, args = closure.groups()
-      #XXX(Elmer): This uses eval, it's so much easier than lexing and parsing
-      # the regex leading up to this point make sure no function calls end up in
-      # here, nor variables, Math might show up though
-      args = eval(args + ',', {'__builtins__': {}}, {}) if args.strip() else ()
       return TAG_FUNCTIONS[func](*args)(value)
-    except SyntaxError:
-      raise TemplateSyntaxError('Invalid argument syntax: %r' % args)
     except TypeError as err_obj:
       raise TemplateTypeError(
           ('Templatefunction raised an TypeError %s(%s) ' % (func, value), err_obj))
     except KeyError as err_obj:
       raise TemplateNameError(
           'Unknown template tag function %r' % err_obj.args[0])
-    except NameError as err_obj:
-      raise TemplateSyntaxError(
-          'Access to scope outside of parser variables is not allowed: %r' % err_obj.args[0])
 
   def Parse(self, **kwds):
     """Returns the parsed string of the tag, using given replacements.
@@ -914,7 +1214,9 @@ class TemplateTag(object):
 
     All tag functions are derived from the module constant TAG_FUNCTIONS, and
     are looked up when requested. This means that if a function is changed after
-    the template has been created, the new function will be used instead.
+    the template has been created, the new function will be used instead. The
+    functions must exist when the template is created though, and the arguments
+    of closure functions are parsed at that time too.
     """
     try:
       value = self.GetValue(kwds)
@@ -922,13 +1224,16 @@ class TemplateTag(object):
       # On any failure to get the given index, return the unmodified tag.
       return str(self)
     # Process functions, or apply default if value is not Basesafestring
-    if self.functions:
-      for func in self.functions:
-        value = self.ApplyFunction(func, value)
+    for call in self.calls:
+      value = self.ApplyFunction(call, value)
     if not isinstance(value, Basesafestring):
       value = TAG_FUNCTIONS['default'](value)
     return value
 
+  def Iterate(self, **kwds):
+    """Yields the parsed tag, as a template part that is being streamed."""
+    yield self.Parse(**kwds)
+
   def Iterator(self, **kwds):
     """Parses the tag for iteration purposes.
 
@@ -940,8 +1245,8 @@ class TemplateTag(object):
     except TemplateKeyError:
       # On any failure to get the given index, return an empty iterator
       return ()
-    for func in self.functions:
-      value = TAG_FUNCTIONS[func](value)
+    for call in self.calls:
+      value = self.ApplyFunction(call, value)
     return iter(value)
 
   @staticmethod
@@ -992,6 +1297,10 @@ class TemplateText(str):
     """Returns the string value of the TemplateText."""
     return str(self)
 
+  def Iterate(self, **_kwds):
+    """Yields the string value of the TemplateText."""
+    yield str(self)
+
 
 class JITTag(object):
   """This is a template Tag which is only evaulated on replacement.
@@ -1045,10 +1354,14 @@ class AstVisitor(ast.NodeVisitor):
     if call.func.id not in self.whitelists['functions']:
       raise TemplateEvaluationError('`%s` is not an allowed function call' % call.func.id)
 
-def LimitedEval(expr, astvisitor, evallocals = {}):
+def LimitedCompile(expr, astvisitor):
+  """Returns the code for `expr`, after checking it against the whitelists."""
   tree = ast.parse(expr, mode='eval')
   astvisitor.visit(tree)
-  return eval(compile(tree, "<string>", "eval"),
+  return compile(tree, "<string>", "eval")
+
+def LimitedEval(expr, astvisitor, evallocals = {}):
+  return eval(LimitedCompile(expr, astvisitor),
       astvisitor.whitelists['functions'],
       evallocals)
 
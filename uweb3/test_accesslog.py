@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+"""Tests for the accesslog module."""
+
+# Too many public methods
+# pylint: disable-msg=R0904
+
+# Standard modules
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+# Unittest target
+from uweb3 import accesslog
+
+
+class AccessLogTest(unittest.TestCase):
+  """Tests writing access log records from a background thread."""
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    self.path = os.path.join(self.root, 'access.log')
+    self.logger = logging.getLogger('uweb3_test_accesslog')
+    self.logger.setLevel(logging.INFO)
+    self.logger.propagate = False
+
+  def tearDown(self):
+    for handler in list(self.logger.handlers):
+      self.logger.removeHandler(handler)
+      handler.close()
+    shutil.rmtree(self.root)
+
+  def Logger(self, **options):
+    """Returns the test logger, writing through a new AccessLogWriter."""
+    writer = accesslog.AccessLogWriter(self.path, **options)
+    writer.start()
+    self.handler = accesslog.AccessLogHandler(writer)
+    self.logger.addHandler(self.handler)
+    return self.logger
+
+  def Log(self, logger, path='/', status=200):
+    logger.info('access', extra={'access': {
+        'host': 'example.com', 'method': 'GET', 'path': path, 'status': status,
+        'protocol': 'HTTP/1.1', 'size': 5, 'latency': 0.001}})
+
+  def Lines(self, path=None):
+    with open(path or self.path) as log:
+      return log.read().splitlines()
+
+  def testTextFormat(self):
+    """The text format matches the classic uWeb access log line"""
+    self.Log(self.Logger())
+    self.handler.close()
+    line, = self.Lines()
+    self.assertTrue(line.startswith('example.com - - ['))
+    self.assertTrue(line.endswith('] "GET / 200 HTTP/1.1"'))
+
+  def testJsonFormat(self):
+    """JSON lines contain all fields, including latency and size"""
+    logger = self.Logger(log_format='json')
+    for number in range(10):
+      self.Log(logger, path='/%d' % number)
+    self.handler.close()
+    records = [json.loads(line) for line in self.Lines()]
+    self.assertEqual([record['path'] for record in records],
+                     ['/%d' % number for number in range(10)])
+    self.assertEqual(records[0]['latency'], 0.001)
+    self.assertEqual(records[0]['size'], 5)
+    self.assertIn('time', records[0])
+
+  def testRotation(self):
+    """The log file is rotated when it grows beyond the maximum size"""
+    logger = self.Logger(max_bytes=100, backup_count=2, batch_size=1)
+    for number in range(10):
+      self.Log(logger, path='/%d' % number)
+    self.handler.close()
+    self.assertTrue(os.path.exists(self.path + '.1'))
+    self.assertTrue(os.path.exists(self.path + '.2'))
+    self.assertFalse(os.path.exists(self.path + '.3'))
+    self.assertLessEqual(os.path.getsize(self.path), 100)
+    self.assertTrue(self.Lines()[-1].endswith('"GET /9 200 HTTP/1.1"'))
+
+
+  def testWriteErrors(self):
+    """Records that cannot be written are dropped, the writer carries on"""
+    self.path = os.path.join(self.root, 'logs', 'access.log')
+    logger = self.Logger(batch_size=1)
+    with self.assertLogs('uweb3.accesslog', 'ERROR'):
+      self.Log(logger, path='/lost')
+      for _attempt in range(200):
+        if self.handler.writer.dropped:
+          break
+        time.sleep(0.01)
+    self.assertEqual(self.handler.writer.dropped, 1)
+    os.mkdir(os.path.dirname(self.path))
+    self.Log(logger, path='/kept')
+    self.handler.close()
+    line, = self.Lines()
+    self.assertTrue(line.endswith('"GET /kept 200 HTTP/1.1"'))
+
+if __name__ == '__main__':
+  unittest.main(testRunner=unittest.TextTestRunner(verbosity=2))
@@ -0,0 +1,559 @@
+#!/usr/bin/python3
+"""Tests for the connection pool and the connection manager."""
+
+# Too many public methods
+# pylint: disable-msg=R0904
+
+# Standard modules
+import collections
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+# Third-party modules
+import pymysql
+from pymysql import converters
+from pymysql.constants import CR
+from pymysql.constants import SERVER_STATUS
+
+# Unittest target
+from uweb3 import connections
+from uweb3.libs import cache
+from uweb3.libs.sqltalk.mysql import connection as mysql_connection
+from uweb3.libs.sqltalk.mysql import cursor as mysql_cursor
+from uweb3.libs.sqltalk.mysql import pool
+
+
+class FakeConnection(object):
+  """Stands in for a MySQL connection."""
+  def __init__(self, alive=True):
+    self.alive = alive
+    self.closed = False
+    self.pings = 0
+    self.lock = threading.Lock()
+
+  def ping(self, reconnect=True):
+    self.pings += 1
+    if not self.alive:
+      raise OSError('Connection lost')
+
+  def close(self):
+    self.closed = True
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    pass
+
+
+class ConnectionPoolTest(unittest.TestCase):
+  """Tests checking connections in and out of the ConnectionPool."""
+
+  def setUp(self):
+    self.opened = []
+
+  def Connect(self):
+    connection = FakeConnection()
+    self.opened.append(connection)
+    return connection
+
+  def testReuse(self):
+    """Released connections are reused, most recently used first"""
+    connections_pool = pool.ConnectionPool(self.Connect, max_size=2)
+    first = connections_pool.Acquire()
+    second = connections_pool.Acquire()
+    self.assertIsNot(first, second)
+    connections_pool.Release(first)
+    connections_pool.Release(second)
+    self.assertIs(connections_pool.Acquire(), second)
+    self.assertEqual(len(self.opened), 2)
+    stats = connections_pool.Stats()
+    self.assertEqual(stats['in_use'], 1)
+    self.assertEqual(stats['idle'], 1)
+    self.assertEqual(stats['checkouts'], 3)
+
+  def testMinSize(self):
+    """The minimum number of connections is opened upfront"""
+    connections_pool = pool.ConnectionPool(self.Connect, min_size=2)
+    self.assertEqual(len(self.opened), 2)
+    self.assertEqual(connections_pool.Stats()['idle'], 2)
+
+  def testTimeout(self):
+    """Waiting for a connection beyond the timeout raises PoolTimeoutError"""
+    connections_pool = pool.ConnectionPool(self.Connect, max_size=1)
+    connections_pool.Acquire()
+    self.assertRaises(pool.PoolTimeoutError, connections_pool.Acquire, 0.01)
+    stats = connections_pool.Stats()
+    self.assertEqual(stats['timeouts'], 1)
+    self.assertEqual(stats['waits'], 1)
+
+  def testWaitForRelease(self):
+    """A waiting thread gets the connection that another thread releases"""
+    connections_pool = pool.ConnectionPool(self.Connect, max_size=1)
+    connection = connections_pool.Acquire()
+    timer = threading.Timer(0.05, connections_pool.Release, (connection,))
+    timer.start()
+    self.assertIs(connections_pool.Acquire(timeout=5), connection)
+    timer.join()
+    self.assertGreater(connections_pool.Stats()['wait_time'], 0)
+
+  def testBrokenConnection(self):
+    """Idle connections that fail their health check are replaced"""
+    connections_pool = pool.ConnectionPool(self.Connect, health_check=0)
+    connection = connections_pool.Acquire()
+    connections_pool.Release(connection)
+    connection.alive = False
+    replacement = connections_pool.Acquire()
+    self.assertIsNot(replacement, connection)
+    self.assertTrue(connection.closed)
+    self.assertEqual(connections_pool.Stats()['size'], 1)
+
+  def testHealthCheckInterval(self):
+    """Recently used connections are not pinged"""
+    connections_pool = pool.ConnectionPool(self.Connect, health_check=60)
+    connection = connections_pool.Acquire()
+    connections_pool.Release(connection)
+    connections_pool.Acquire()
+    self.assertEqual(connection.pings, 0)
+
+  def testLifetime(self):
+    """Connections past their lifetime are closed when released"""
+    connections_pool = pool.ConnectionPool(self.Connect, max_lifetime=0.01)
+    connection = connections_pool.Acquire()
+    time.sleep(0.02)
+    connections_pool.Release(connection)
+    self.assertTrue(connection.closed)
+    stats = connections_pool.Stats()
+    self.assertEqual(stats['recycled'], 1)
+    self.assertEqual(stats['size'], 0)
+
+  def testIdleTimeout(self):
+    """Connections that idle too long are closed, down to the minimum size"""
+    connections_pool = pool.ConnectionPool(
+        self.Connect, min_size=1, idle_timeout=0.01)
+    extra = [connections_pool.Acquire(), connections_pool.Acquire()]
+    for connection in extra:
+      connections_pool.Release(connection)
+    time.sleep(0.02)
+    connections_pool.Acquire()
+    self.assertEqual(sum(conn.closed for conn in self.opened), 1)
+    self.assertEqual(connections_pool.Stats()['size'], 1)
+
+  def testOpenTransaction(self):
+    """Connections released inside a transaction are closed"""
+    connections_pool = pool.ConnectionPool(self.Connect)
+    connection = connections_pool.Acquire()
+    connection.lock.acquire()
+    connections_pool.Release(connection)
+    self.assertTrue(connection.closed)
+    self.assertEqual(connections_pool.Stats()['size'], 0)
+
+  def testClose(self):
+    """Closing the pool closes idle connections"""
+    connections_pool = pool.ConnectionPool(self.Connect, min_size=2)
+    connections_pool.Close()
+    self.assertTrue(all(conn.closed for conn in self.opened))
+
+
+class MysqlConnectorTest(unittest.TestCase):
+  """Tests the per-thread connection checkout of the Mysql connector."""
+
+  def setUp(self):
+    self.connector = object.__new__(connections.Mysql)
+    self.connector._local = threading.local()
+    self.connector.pool = pool.ConnectionPool(FakeConnection, max_size=2)
+
+  def testPerThread(self):
+    """Each thread uses its own connection, until it is released"""
+    connection = self.connector.connection
+    self.assertIs(self.connector.connection, connection)
+    other = []
+    thread = threading.Thread(
+        target=lambda: other.append(self.connector.connection))
+    thread.start()
+    thread.join()
+    self.assertIsNot(other[0], connection)
+    self.connector.Release()
+    self.assertEqual(self.connector.pool.Stats()['in_use'], 1)
+
+
+class FakeConnector(connections.Connector):
+  """Connector that counts how often it is set up."""
+  _NAME = 'fake'
+  setups = []
+
+  def __init__(self, config, options, request, debug=False):
+    self.setups.append(request)
+    self.connection = FakeConnection()
+
+
+class FakeModel(object):
+  """Model class that is bound to the FakeConnector."""
+  _CONNECTOR = 'fake'
+
+  @classmethod
+  def Transaction(cls, manager):
+    with manager as connection:
+      return connection
+
+
+class ConnectionManagerTest(unittest.TestCase):
+  """Tests resolving the connection for model classes."""
+
+  def setUp(self):
+    FakeConnector.setups = []
+    self.manager = connections.ConnectionManager(None, {}, False)
+    self.manager.RegisterConnector(FakeConnector)
+    self.manager.BindRequest('request')
+
+  def testFor(self):
+    """The connection is resolved from the class and reused"""
+    connection = self.manager.For(FakeModel)
+    self.assertIsInstance(connection, FakeConnection)
+    self.assertIs(self.manager.For(FakeModel), connection)
+    self.assertEqual(FakeConnector.setups, ['request'])
+
+  def testIdentityMap(self):
+    """Each request has its own identity map, which is cleared afterwards"""
+    identity_map = self.manager.IdentityMap()
+    self.assertIs(self.manager.IdentityMap(), identity_map)
+    other = []
+    thread = threading.Thread(
+        target=lambda: other.append(self.manager.IdentityMap()))
+    thread.start()
+    thread.join()
+    self.assertIsNot(other[0], identity_map)
+    self.manager.PostRequest()
+    self.assertIsNot(self.manager.IdentityMap(), identity_map)
+
+  def testRelevantConnectionDeprecated(self):
+    """Using the manager as a connection still works, with a warning"""
+    with self.assertWarns(DeprecationWarning):
+      connection = FakeModel.Transaction(self.manager)
+    self.assertIs(connection, self.manager.For(FakeModel))
+
+
+class IdentityMapTest(unittest.TestCase):
+  """Tests the IdentityMap bookkeeping."""
+
+  def testIdentityMap(self):
+    """Records are found by table and key, and hits and misses are counted"""
+    record = type('Author', (dict,), {'key': 1, 'TableName': lambda self: 'author'})()
+    identity_map = connections.IdentityMap()
+    self.assertIsNone(identity_map.Get('author', 1))
+    identity_map.Add(record)
+    self.assertIs(identity_map.Get('author', 1), record)
+    self.assertIsNone(identity_map.Get('book', 1))
+    identity_map.Discard('author', 1)
+    self.assertIsNone(identity_map.Get('author', 1))
+    self.assertEqual(identity_map.Stats(),
+                     {'hits': 1, 'misses': 3, 'size': 0})
+
+
+class ModelCacheTest(unittest.TestCase):
+  """Tests the ModelCache and its backends."""
+
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+    self.record = type('Author', (dict,), {
+        'key': 1, '_record': {'ID': 1, 'name': 'A. Bronte'},
+        'TableName': lambda self: 'author'})()
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+  def testTTLCache(self):
+    """Entries of a TTLCache expire, and count as misses afterwards"""
+    ttlcache = cache.TTLCache(10, ttl=60)
+    ttlcache.Set('fresh', 1)
+    ttlcache.Set('stale', 2, ttl=-1)
+    self.assertEqual(ttlcache.Get('fresh'), 1)
+    self.assertIsNone(ttlcache.Get('stale'))
+    self.assertNotIn('stale', ttlcache)
+    stats = ttlcache.Stats()
+    self.assertEqual((stats['hits'], stats['misses'], stats['expirations']),
+                     (1, 1, 1))
+
+  def testFileCache(self):
+    """A FileCache is shared by all instances that use the same directory"""
+    filecache = cache.FileCache(self.path, ttl=60)
+    filecache.Set('author:1', {'name': 'A. Bronte'})
+    filecache.Set('author:2', {'name': 'E. Bronte'}, ttl=-1)
+    other = cache.FileCache(self.path)
+    self.assertEqual(other.Get('author:1'), {'name': 'A. Bronte'})
+    self.assertEqual(filecache.Prune(), 1)
+    filecache.Del('author:1')
+    self.assertIsNone(other.Get('author:1'))
+    self.assertEqual(filecache.Stats()['evictions'], 1)
+
+  def testFileCacheBound(self):
+    """A FileCache is pruned to its maximum size every few stored entries"""
+    filecache = cache.FileCache(self.path, maxsize=2, prune_interval=4)
+    for number in range(3):
+      filecache.Set('author:%d' % number, number)
+      os.utime(filecache._Filename('author:%d' % number), (number, number))
+    self.assertEqual(len(os.listdir(self.path)), 3)
+    filecache.Set('author:3', 3)
+    self.assertEqual(len(os.listdir(self.path)), 2)
+    self.assertIsNone(filecache.Get('author:0'))
+    self.assertEqual(filecache.Get('author:3'), 3)
+    self.assertEqual(filecache.Stats()['evictions'], 2)
+
+  def testFileCachePermissions(self):
+    """A FileCache only uses private directories and its own entry files"""
+    os.chmod(self.path, 0o777)
+    self.assertRaises(PermissionError, cache.FileCache, self.path)
+    os.chmod(self.path, 0o700)
+    filecache = cache.FileCache(self.path)
+    filecache.Set('author:1', {'name': 'A. Bronte'})
+    with mock.patch('os.getuid', return_value=os.getuid() + 1):
+      self.assertIsNone(filecache.Get('author:1'))
+    self.assertEqual(filecache.Get('author:1'), {'name': 'A. Bronte'})
+
+  def testDefaultPath(self):
+    """Every user and application gets its own default cache directory"""
+    path = cache.DefaultPath('/srv/app', 'models')
+    self.assertIn('uweb3-%d-' % os.getuid(), path)
+    self.assertTrue(path.endswith('models'))
+    self.assertNotEqual(path, cache.DefaultPath('/srv/other', 'models'))
+
+  def testModelCache(self):
+    """Rows are stored by table and key, and removed when discarded"""
+    for backend in (cache.TTLCache(), cache.FileCache(self.path)):
+      model_cache = connections.ModelCache(backend)
+      model_cache.Add(self.record)
+      self.assertEqual(model_cache.Get('author', 1), self.record._record)
+      self.assertIsNone(model_cache.Get('book', 1))
+      model_cache.Discard('author', 1)
+      self.assertIsNone(model_cache.Get('author', 1))
+      model_cache.QuerySaved()
+      self.assertEqual(model_cache.Stats()['queries_saved'], 1)
+
+  def testConfiguration(self):
+    """The ConnectionManager sets up the cache from the [modelcache] section"""
+    manager = connections.ConnectionManager(None, {}, False)
+    self.assertIsNone(manager.CacheStats())
+    self.assertIsInstance(manager.ModelCache().backend, cache.TTLCache)
+    self.assertIs(manager.ModelCache(), manager.ModelCache())
+    manager = connections.ConnectionManager(None, {'modelcache': {
+        'backend': 'file', 'path': self.path, 'ttl': '5'}}, False)
+    self.assertIsInstance(manager.ModelCache().backend, cache.FileCache)
+    self.assertEqual(manager.CacheStats()['ttl'], 5)
+
+
+class FakeCursor(object):
+  """Stands in for a cursor, failing the first `failures` executions."""
+  def __init__(self, failures=0):
+    self.failures = failures
+    self.executed = []
+
+  def execute(self, query):
+    self.executed.append(query)
+    if self.failures:
+      self.failures -= 1
+      raise mysql_connection.Connection.OperationalError(
+          CR.CR_SERVER_GONE_ERROR, 'MySQL server has gone away')
+
+  def fetchall(self):
+    return ({'one': 1},)
+
+
+class ConnectionLivenessTest(unittest.TestCase):
+  """Tests the liveness checks and autocommit handling of the Connection."""
+
+  def setUp(self):
+    self.events = []
+    self.connection = object.__new__(mysql_connection.Connection)
+    self.connection._sock = object()
+    self.connection._rfile = None
+    self.connection._result = None
+    self.connection._affected_rows = 0
+    self.connection.charset = 'utf8'
+    self.connection.logger = logging.getLogger('test_connections')
+    self.connection.queries = []
+    self.connection.counter_queries = 0
+    self.connection.autocommit_mode = False
+    self.connection.server_status = 0
+    self.connection.ping_interval = 30
+    self.connection.last_used = time.monotonic()
+    self.connection.check_connection = False
+    self.connection._send_autocommit_mode = (
+        lambda: self.events.append('autocommit'))
+    # Only the pymysql methods that talk to the server are replaced.
+    self.server_alive = True
+    base = pymysql.connections.Connection
+    for name, method in (('ping', self.Ping), ('connect', self.Connect)):
+      patcher = mock.patch.object(base, name, method)
+      patcher.start()
+      self.addCleanup(patcher.stop)
+
+  def Ping(self, reconnect=True):
+    self.events.append('ping')
+    if not self.server_alive:
+      raise pymysql.err.OperationalError(
+          CR.CR_SERVER_GONE_ERROR, 'MySQL server has gone away')
+
+  def Connect(self, sock=None):
+    self.events.append('reconnect')
+    self.server_alive = True
+
+  def testNoPingWhenRecentlyUsed(self):
+    """A recently used connection is not pinged"""
+    self.connection._EnsureConnected()
+    self.assertEqual(self.events, [])
+
+  def testPingAfterIdle(self):
+    """A connection that idled beyond the ping interval is pinged"""
+    self.connection.last_used -= 60
+    idle_since = self.connection.last_used
+    self.connection._EnsureConnected()
+    self.assertEqual(self.events, ['ping'])
+    self.assertGreater(self.connection.last_used, idle_since)
+
+  def testPingAfterError(self):
+    """A connection that had an error is pinged before its next use"""
+    self.connection.check_connection = True
+    self.connection._EnsureConnected()
+    self.assertEqual(self.events, ['ping'])
+    self.assertFalse(self.connection.check_connection)
+
+  def testReconnectAfterFailedPing(self):
+    """A connection that fails its ping is replaced by a new one"""
+    self.server_alive = False
+    self.connection.last_used -= 60
+    idle_since = self.connection.last_used
+    self.connection._EnsureConnected()
+    self.assertEqual(self.events, ['ping', 'reconnect'])
+    self.assertGreater(self.connection.last_used, idle_since)
+    self.assertIsNone(self.connection._sock)
+
+  def testAutocommitOnlyOnChange(self):
+    """The autocommit mode is only sent when it differs from the server's"""
+    self.connection._SetAutocommitState(False)
+    self.assertEqual(self.events, [])
+    self.connection._SetAutocommitState(True)
+    self.assertEqual(self.events, ['autocommit'])
+    self.connection.server_status = SERVER_STATUS.SERVER_STATUS_AUTOCOMMIT
+    self.connection._SetAutocommitState(True)
+    self.assertEqual(self.events, ['autocommit'])
+
+  def testRetryRead(self):
+    """Reads are retried on a new connection when the connection was lost"""
+    cursor = FakeCursor(failures=1)
+    result = self.connection.Query('SELECT 1', cursor)
+    self.assertEqual(self.events, ['reconnect'])
+    self.assertEqual(len(cursor.executed), 2)
+    self.assertEqual(result[0]['one'], 1)
+
+  def testNoRetryWrite(self):
+    """Writes, or reads later in a transaction, are not retried"""
+    self.assertRaises(mysql_connection.Connection.OperationalError,
+                      self.connection.Query, 'DELETE FROM `a`', FakeCursor(1))
+    self.connection.queries = ['UPDATE `a` SET `b`=1', 'SELECT 1']
+    self.assertRaises(mysql_connection.Connection.OperationalError,
+                      self.connection.Query, 'SELECT 1', FakeCursor(1))
+    self.assertEqual(self.events, [])
+    self.assertTrue(self.connection.check_connection)
+
+
+class ParameterizedQueryTest(unittest.TestCase):
+  """Tests binding parameters to queries with placeholders."""
+
+  def setUp(self):
+    self.executed = []
+    self.connection = object.__new__(mysql_connection.Connection)
+    self.connection.charset = self.connection.encoding = 'utf8'
+    self.connection.encoders = converters.encoders
+    self.connection.server_status = 0
+    self.connection.statement_cache_size = 2
+    self.connection.statements = collections.OrderedDict()
+    self.connection.logger = logging.getLogger('test_connections')
+    self.connection.queries = []
+    self.connection.Query = (
+        lambda query, cursor: self.executed.append(query) or [])
+
+  def testBind(self):
+    """Parameters are escaped into the placeholders, %% is a percent sign"""
+    statement = mysql_connection.Statement(
+        "SELECT 1 WHERE `a` = %s AND `b` LIKE 'x%%' AND `c` IN %s", 'utf8')
+    self.assertEqual(statement.params, 2)
+    self.assertEqual(
+        statement.Bind(self.connection, ("it's", (1, 2))),
+        b"SELECT 1 WHERE `a` = 'it\\'s' AND `b` LIKE 'x%' AND `c` IN (1,2)")
+    self.assertRaises(mysql_connection.Connection.ProgrammingError,
+                      statement.Bind, self.connection, (1,))
+
+  def testQuotedLiterals(self):
+    """Quoted literals keep the doubling rule, and may not hold placeholders"""
+    statement = mysql_connection.Statement(
+        """SELECT '100%%', "it\\'s %%s", `a%b` FROM `t` WHERE `a` = %s""",
+        'utf8')
+    self.assertEqual(statement.params, 1)
+    self.assertEqual(
+        statement.Bind(self.connection, (1,)),
+        b"""SELECT '100%', "it\\'s %s", `a%b` FROM `t` WHERE `a` = 1""")
+    with self.assertRaises(mysql_connection.Connection.ProgrammingError) as error:
+      mysql_connection.Statement("SELECT 1 WHERE `b` LIKE '%sales'", 'utf8')
+    self.assertIn('%%', str(error.exception))
+
+  def testStatementCache(self):
+    """Statements are reused by query text, least recently used out first"""
+    first = self.connection.Prepare('SELECT %s')
+    self.assertIs(self.connection.Prepare('SELECT %s'), first)
+    self.connection.Prepare('SELECT %s, %s')
+    self.connection.Prepare('SELECT 1')
+    self.assertEqual(list(self.connection.statements),
+                     ['SELECT %s, %s', 'SELECT 1'])
+    self.connection.statement_cache_size = 0
+    self.assertIsNot(self.connection.Prepare('SELECT 1'),
+                     self.connection.Prepare('SELECT 1'))
+
+  def testStatementsKeptOnReconnect(self):
+    """Pinging or reconnecting keeps the statement cache and its size"""
+    statement = self.connection.Prepare('SELECT %s')
+    self.connection._sock = None
+    base = pymysql.connections.Connection
+    with mock.patch.object(base, 'ping'), mock.patch.object(base, 'connect'):
+      self.connection.ping()
+      self.connection._Reconnect()
+    self.assertEqual(self.connection.statement_cache_size, 2)
+    self.assertIs(self.connection.Prepare('SELECT %s'), statement)
+
+  def testCursorParams(self):
+    """Select, Update and Delete bind params to their conditions"""
+    cursor = mysql_cursor.Cursor(self.connection)
+    cursor.Select(table='a', conditions='`id` = %s', params=(5,))
+    cursor.Update(table='a', values={'name': 'b'}, conditions='`id` = %s',
+                  params=(5,))
+    cursor.Delete(table='a', conditions='`id` = %s', params=(5,))
+    self.assertEqual([b' '.join(query.split()) for query in self.executed], [
+        b"SELECT * FROM `a` WHERE `id` = 5",
+        b"UPDATE `a` SET `name`='b' WHERE `id` = 5",
+        b"delete from `a` where `id` = 5"])
+
+  def testInsertMany(self):
+    """Rows are inserted with multi-row inserts, split by size"""
+    self.connection.Query = (
+        lambda query, cursor: self.executed.append(query) or
+        mysql_cursor.sqlresult.ResultSet(affected=query.count('), (') + 1,
+                                         insertid=len(self.executed)))
+    cursor = mysql_cursor.Cursor(self.connection)
+    rows = [{'name': 'row %d' % num, 'id': num} for num in range(3)]
+    results = cursor.InsertMany('a', rows, max_size=70)
+    self.assertEqual(self.executed, [
+        "INSERT INTO `a` (`name`, `id`) VALUES ('row 0', 0), ('row 1', 1)",
+        "INSERT INTO `a` (`name`, `id`) VALUES ('row 2', 2)"])
+    self.assertEqual([result.affected for result in results], [2, 1])
+    self.assertEqual(len(cursor.InsertMany('a', rows)), 1)
+    result = cursor.Insert('a', rows)
+    self.assertEqual((result.affected, result.insertid), (3, 4))
+
+
+if __name__ == '__main__':
+  unittest.main(testRunner=unittest.TextTestRunner(verbosity=2))
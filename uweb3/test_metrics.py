@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+"""Tests for the metrics module."""
+
+# Too many public methods
+# pylint: disable-msg=R0904
+
+# Standard modules
+import socket
+import unittest
+
+# Unittest target
+from uweb3.libs import metrics
+from uweb3 import templateparser
+
+
+class HistogramTest(unittest.TestCase):
+  """Tests the bucketing of observations."""
+
+  def testCumulative(self):
+    """Bucket counts are cumulative, including an infinite bucket"""
+    histogram = metrics.Histogram((0.1, 1))
+    for value in (0.05, 0.1, 0.5, 5):
+      histogram.Observe(value)
+    self.assertEqual(histogram.Cumulative(),
+                     [(0.1, 2), (1, 3), (float('inf'), 4)])
+    self.assertEqual(histogram.count, 4)
+    self.assertAlmostEqual(histogram.sum, 5.65)
+
+
+class RequestTimerTest(unittest.TestCase):
+  """Tests the measuring of request phases."""
+
+  def tearDown(self):
+    metrics.Activate(metrics.NULL_TIMER)
+
+  def testMarks(self):
+    """Marks assign the time since the previous mark to a phase"""
+    timer = metrics.RequestTimer()
+    timer.Mark('routing')
+    timer.Mark('handler')
+    timer.Mark('routing')
+    self.assertEqual(sorted(timer.phases), ['handler', 'routing'])
+    self.assertLessEqual(sum(timer.phases.values()), timer.Elapsed())
+
+  def testTemplatePhase(self):
+    """Template parsing is measured when a timer is active"""
+    parser = templateparser.Parser()
+    parser.ParseString('[x]', x=1)
+    timer = metrics.RequestTimer()
+    metrics.Activate(timer)
+    parser.ParseString('[x]', x=1)
+    self.assertIn('template', timer.phases)
+    self.assertEqual(metrics.NULL_TIMER.phases, {})
+
+  def testTimedStream(self):
+    """Streamed items are timed on the timer of their request when consumed"""
+    timer = metrics.RequestTimer()
+    metrics.Activate(timer)
+    chunks = metrics.Timed(
+        templateparser.Template('[x]').Iterate(x=1), 'template')
+    metrics.Activate(metrics.NULL_TIMER)
+    self.assertEqual(list(chunks), ['1'])
+    self.assertIn('template', timer.phases)
+    self.assertIs(metrics.Current(), metrics.NULL_TIMER)
+
+
+class MetricsTest(unittest.TestCase):
+  """Tests aggregation and exposition of request metrics."""
+
+  def setUp(self):
+    self.metrics = metrics.Metrics(buckets=(0.1, 1))
+    self.metrics.Record('Index', 200, 0.05, {'handler': 0.04})
+    self.metrics.Record('Index', 200, 0.5, {'handler': 0.4})
+    self.metrics.Record('_NotFound', 404, 0.01, {})
+
+  def testSnapshot(self):
+    """The snapshot holds status counters and route and phase histograms"""
+    snapshot = self.metrics.Snapshot()
+    self.assertEqual(snapshot['requests'], 3)
+    self.assertEqual(snapshot['statuses'], {200: 2, 404: 1})
+    self.assertEqual(snapshot['routes']['Index']['count'], 2)
+    self.assertEqual(snapshot['phases']['handler']['buckets'][0], (0.1, 1))
+
+  def testPrometheus(self):
+    """Metrics are exposed in the Prometheus text format"""
+    lines = self.metrics.Prometheus().splitlines()
+    self.assertIn('uweb3_requests_total{status="404"} 1', lines)
+    self.assertIn('uweb3_request_duration_seconds_bucket'
+                  '{route="Index",le="0.1"} 1', lines)
+    self.assertIn('uweb3_request_duration_seconds_bucket'
+                  '{route="Index",le="+Inf"} 2', lines)
+    self.assertIn('uweb3_phase_duration_seconds_count{phase="handler"} 2',
+                  lines)
+
+  def testStatsdSink(self):
+    """Each request is sent to statsd as a single datagram"""
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(('127.0.0.1', 0))
+    server.settimeout(1)
+    self.addCleanup(server.close)
+    sink = metrics.StatsdSink('127.0.0.1', server.getsockname()[1], 'app')
+    collection = metrics.Metrics(sinks=[sink])
+    collection.Record('Index', 200, 0.25, {'handler': 0.2})
+    self.assertEqual(server.recv(1024).decode('utf8').splitlines(),
+                     ['app.route.Index:250.000|ms', 'app.status.200:1|c',
+                      'app.phase.handler:200.000|ms'])
+
+
+if __name__ == '__main__':
+  unittest.main(testRunner=unittest.TextTestRunner(verbosity=2))
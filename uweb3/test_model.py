@@ -11,6 +11,8 @@ import unittest
 from uweb3.ext_lib.libs.sqltalk import mysql
 # Unittest target
 from uweb3 import model
+from uweb3.connections import IdentityMap, ModelCache
+from uweb3.libs.cache import TTLCache
 from pymysql.err import InternalError
 
 # ##############################################################################
@@ -139,6 +141,96 @@ class RecordTests(unittest.TestCase):
     author = Author.FromPrimary(self.connection, new_author.key)
     self.assertEqual(author['name'], 'W. Shakespeare')
 
+  def testCreateMany(self):
+    """Records can be created in bulk, and get their insert IDs assigned"""
+    authors = Author.CreateMany(
+        self.connection, [{'name': 'Author %d' % num} for num in range(50)])
+    self.assertEqual([author.key for author in authors], list(range(1, 51)))
+    self.assertEqual(Author.FromPrimary(self.connection, 50)['name'],
+                     'Author 49')
+
+  def testListPreload(self):
+    """[Record] Preloaded relations are loaded with one query per relation"""
+    author = Author.Create(self.connection, {'name': 'A. Christie'})
+    for num in range(5):
+      Book.Create(self.connection, {'author': author.key, 'title': str(num)})
+    queries = self.connection.counter_queries
+    books = list(Book.List(self.connection, preload=['author']))
+    self.assertEqual(self.connection.counter_queries - queries, 2)
+    self.assertEqual([book['author']['name'] for book in books],
+                     ['A. Christie'] * 5)
+    self.assertEqual(self.connection.counter_queries - queries, 2)
+
+  def testListAfter(self):
+    """[Record] Listing continues after the given values of the order fields"""
+    for name in ('b', 'a', 'c', 'a'):
+      Author.Create(self.connection, {'name': name})
+    self.assertEqual(
+        [author.key for author in Author.List(self.connection, after=2)],
+        [3, 4])
+    self.assertEqual(
+        [author.key for author in Author.List(
+            self.connection, order=['name'], after=('a', 2))],
+        [4, 1, 3])
+    self.assertEqual(
+        [author.key for author in Author.List(
+            self.connection, order=[('name', True)], after=('b', 1))],
+        [2, 4])
+
+  def testPaginate(self):
+    """[Record] Pages continue after the previous one through their cursor"""
+    for num in range(5):
+      Author.Create(self.connection, {'name': 'Author %d' % (num % 2)})
+    keys = []
+    cursor = None
+    while True:
+      page = Author.Paginate(self.connection, 2, cursor=cursor, order=['name'])
+      keys.append([author.key for author in page])
+      cursor = page.cursor
+      if cursor is None:
+        break
+    self.assertEqual(keys, [[1, 3], [5, 2], [4]])
+    self.assertRaises(model.Error, Author.Paginate, self.connection, 2,
+                      cursor='not a cursor')
+
+  def testIdentityMap(self):
+    """[Record] The identity map returns loaded records until they're saved"""
+    manager = type('Manager', (object,), {
+        'For': lambda manager, cls: self.connection,
+        'IdentityMap': lambda manager, store=IdentityMap(): store})()
+    Author._IDENTITY_MAP = True
+    try:
+      author = Author.Create(self.connection, {'name': 'E. Bronte'})
+      loaded = Author.FromPrimary(manager, author.key)
+      self.assertIs(Author.FromPrimary(manager, author.key), loaded)
+      self.assertIs(list(Author.List(manager))[0], loaded)
+      loaded['name'] = 'A. Bronte'
+      loaded.Save()
+      self.assertIsNot(Author.FromPrimary(manager, author.key), loaded)
+    finally:
+      Author._IDENTITY_MAP = False
+
+  def testModelCache(self):
+    """[Record] The model cache is used across requests until a record changes"""
+    model_cache = ModelCache(TTLCache())
+    manager = type('Manager', (object,), {
+        'For': lambda manager, cls: self.connection,
+        'ModelCache': lambda manager: model_cache})()
+    Author._CACHE = True
+    try:
+      author = Author.Create(self.connection, {'name': 'E. Bronte'})
+      self.assertEqual(Author.FromPrimary(manager, author.key), author)
+      self.assertEqual(Author.FromPrimary(manager, author.key), author)
+      self.assertEqual(model_cache.Stats()['queries_saved'], 1)
+      loaded = Author.FromPrimary(manager, author.key)
+      loaded['name'] = 'A. Bronte'
+      loaded.Save()
+      self.assertIsNone(model_cache.Get('author', author.key))
+      self.assertEqual(
+          Author.FromPrimary(manager, author.key)['name'], 'A. Bronte')
+    finally:
+      Author._CACHE = False
+
   def testCreateRecordWithBadField(self):
     """Database record creation fails if there are unknown fields present"""
     self.assertRaises(InternalError, Author.Create, self.connection,
@@ -292,6 +384,12 @@ class VersionedRecordTests(unittest.TestCase):
     self.assertEqual(loaded['name'], 'J. Grisham')
     self.assertEqual(loaded, author)
 
+  def testCreateManyVersioned(self):
+    """[Versioned] Records created in bulk get consecutive identifiers"""
+    authors = VersionedAuthor.CreateMany(
+        self.connection, [{'name': 'J. Austen'}, {'name': 'C. Bronte'}])
+    self.assertEqual([author.identifier for author in authors], [1, 2])
+
   def testUpdateVersioned(self):
     """[Versioned] Updating records and loading from identifier works"""
     author = VersionedAuthor.Create(self.connection, {'name': 'Z. Gray'})
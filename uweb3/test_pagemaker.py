@@ -0,0 +1,259 @@
+#!/usr/bin/python3
+"""Tests for the pagemaker module."""
+
+# Too many public methods
+# pylint: disable-msg=R0904
+
+# Standard modules
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+# Unittest target
+from uweb3 import pagemaker, request, response, static
+from uweb3.libs import cache
+
+
+class StaticPageMaker(pagemaker.PageMaker):
+  """PageMaker that serves static files from a temporary directory."""
+  PUBLIC_DIR = 'public'
+
+
+class ClassSetupTest(unittest.TestCase):
+  """Tests the one-time setup of PageMaker classes."""
+
+  def Construct(self, executing_path):
+    environ = {'REQUEST_METHOD': 'GET', 'wsgi.input': io.BytesIO()}
+    return StaticPageMaker(request.Request(environ, None),
+                           executing_path=executing_path)
+
+  def testPaths(self):
+    """Paths are set up per executing path, relative to the configured ones"""
+    self.Construct('/srv/first')
+    self.assertEqual(StaticPageMaker.PUBLIC_DIR, '/srv/first/public')
+    self.assertEqual(StaticPageMaker.TEMPLATE_DIR, '/srv/first/templates')
+    self.Construct('/srv/second')
+    self.assertEqual(StaticPageMaker.PUBLIC_DIR, '/srv/second/public')
+
+  def testSetupOnce(self):
+    """The class setup only runs for the first request"""
+    self.Construct('/srv/once')
+    StaticPageMaker.PUBLIC_DIR = 'changed'
+    page = self.Construct('/srv/once')
+    self.assertEqual(page.PUBLIC_DIR, 'changed')
+    self.assertIs(page.connection, pagemaker.PageMaker.PERSISTENT.Get('connection'))
+    self.assertFalse(page.debug)
+
+
+class StaticTest(unittest.TestCase):
+  """Tests serving of static files."""
+  CONTENT = bytes(range(256)) * 4
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    os.mkdir(os.path.join(self.root, 'public'))
+    with open(os.path.join(self.root, 'public', 'data.bin'), 'wb') as data:
+      data.write(self.CONTENT)
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+
+  def Static(self, path='data.bin', registry=None, **env):
+    """Returns the response of the Static handler for the given path."""
+    environ = {'REQUEST_METHOD': 'GET',
+               'PATH_INFO': '/' + path,
+               'wsgi.input': io.BytesIO()}
+    environ.update(env)
+    req = request.Request(environ, registry)
+    page = StaticPageMaker(req, executing_path=self.root)
+    return page.Static(path)
+
+  @staticmethod
+  def Body(page):
+    """Returns the full body of a FileResponse."""
+    return b''.join(page.Body({}))
+
+  def testFullFile(self):
+    """Files are streamed with validators and without reading them upfront"""
+    page = self.Static()
+    self.assertIsInstance(page, response.FileResponse)
+    self.assertEqual(page.httpcode, 200)
+    self.assertEqual(page.headers['content-length'], len(self.CONTENT))
+    self.assertIn('ETag', page.headers)
+    self.assertEqual(self.Body(page), self.CONTENT)
+    self.assertTrue(page.file.closed)
+
+  def testFileWrapper(self):
+    """The server's file_wrapper is used for full files"""
+    page = self.Static()
+    self.assertEqual(page.Body({'wsgi.file_wrapper': lambda *args: args}),
+                     (page.file, response.FileResponse.BLOCK_SIZE))
+    page.file.close()
+
+  def testNotFound(self):
+    """Missing files, directories and uplevel paths are not found"""
+    for path in ('missing.bin', '', '../public/data.bin/..'):
+      self.assertEqual(self.Static(path).httpcode, 404, path)
+
+  def testIfNoneMatch(self):
+    """A matching ETag gets a 304 response"""
+    etag = self.Static().headers['ETag']
+    self.assertEqual(self.Static(HTTP_IF_NONE_MATCH=etag).httpcode, 304)
+    self.assertEqual(
+        self.Static(HTTP_IF_NONE_MATCH='"other", %s' % etag).httpcode, 304)
+    self.assertEqual(self.Static(HTTP_IF_NONE_MATCH='"other"').httpcode, 200)
+
+  def testIfModifiedSince(self):
+    """An up to date If-Modified-Since date gets a 304 response"""
+    modified = self.Static().headers['last-modified']
+    self.assertEqual(self.Static(HTTP_IF_MODIFIED_SINCE=modified).httpcode, 304)
+    earlier = time.strftime(pagemaker.RFC_1123_DATE, time.gmtime(86400))
+    self.assertEqual(self.Static(HTTP_IF_MODIFIED_SINCE=earlier).httpcode, 200)
+
+  def testRange(self):
+    """Single byte ranges get a 206 response with only the requested bytes"""
+    page = self.Static(HTTP_RANGE='bytes=10-19')
+    self.assertEqual(page.httpcode, 206)
+    self.assertEqual(page.headers['Content-Range'], 'bytes 10-19/1024')
+    self.assertEqual(self.Body(page), self.CONTENT[10:20])
+    self.assertEqual(self.Body(self.Static(HTTP_RANGE='bytes=1000-')),
+                     self.CONTENT[1000:])
+    self.assertEqual(self.Body(self.Static(HTTP_RANGE='bytes=-4')),
+                     self.CONTENT[-4:])
+
+  def testUnsatisfiableRange(self):
+    """Ranges beyond the end of the file get a 416 response"""
+    page = self.Static(HTTP_RANGE='bytes=2000-')
+    self.assertEqual(page.httpcode, 416)
+    self.assertEqual(page.headers['Content-Range'], 'bytes */1024')
+
+  def testIfRange(self):
+    """A range with an outdated If-Range gets the full file"""
+    page = self.Static(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"outdated"')
+    self.assertEqual(page.httpcode, 200)
+    self.assertEqual(self.Body(page), self.CONTENT)
+
+
+class StaticCacheTest(StaticTest):
+  """Tests serving of static files from the in-memory cache."""
+  CSS = b'body { color: red; }\n' * 100
+
+  def setUp(self):
+    super(StaticCacheTest, self).setUp()
+    with open(os.path.join(self.root, 'public', 'style.css'), 'wb') as css:
+      css.write(self.CSS)
+    self.registry = type('Registry', (object,), {})()
+    self.registry.static_cache = static.StaticCache(check_interval=0)
+
+  def Static(self, path='data.bin', registry=None, **env):
+    return super(StaticCacheTest, self).Static(
+        path, registry=self.registry, **env)
+
+  @staticmethod
+  def Body(page):
+    return page.content
+
+  def testFullFile(self):
+    """Small files are cached and served from memory"""
+    self.Static()
+    os.remove(os.path.join(self.root, 'public', 'data.bin'))
+    self.registry.static_cache.check_interval = 60
+    page = self.Static()
+    self.assertNotIsInstance(page, response.FileResponse)
+    self.assertEqual(page.content, self.CONTENT)
+    self.assertEqual(self.registry.static_cache.Stats()['hits'], 1)
+
+  def testFileWrapper(self):
+    """Large files bypass the cache and are streamed"""
+    self.registry.static_cache.max_file_size = 100
+    self.assertIsInstance(self.Static(), response.FileResponse)
+    self.Static().file.close()
+    self.assertEqual(len(self.registry.static_cache.entries), 0)
+
+  def testInvalidation(self):
+    """Entries are dropped when the file changes on disk"""
+    self.Static()
+    path = os.path.join(self.root, 'public', 'data.bin')
+    with open(path, 'wb') as data:
+      data.write(b'changed')
+    os.utime(path, ns=(0, 0))
+    self.assertEqual(self.Static().content, b'changed')
+
+  def testCompressedVariants(self):
+    """Compressible files are sent compressed if the client accepts that"""
+    page = self.Static('style.css', HTTP_ACCEPT_ENCODING='gzip, deflate')
+    self.assertEqual(page.headers['Content-Encoding'], 'gzip')
+    self.assertEqual(page.headers['Vary'], 'Accept-Encoding')
+    self.assertEqual(gzip.decompress(page.content), self.CSS)
+    self.assertEqual(page.headers['content-length'], len(page.content))
+    etag = page.headers['ETag']
+    self.assertEqual(self.Static('style.css', HTTP_ACCEPT_ENCODING='gzip',
+                                 HTTP_IF_NONE_MATCH=etag).httpcode, 304)
+    page = self.Static('style.css', HTTP_ACCEPT_ENCODING='gzip;q=0')
+    self.assertNotIn('Content-Encoding', page.headers)
+    self.assertNotEqual(page.headers['ETag'], etag)
+    self.assertEqual(page.content, self.CSS)
+
+
+class LRUCacheCostTest(unittest.TestCase):
+  """Tests bounding the LRUCache by entry cost."""
+
+  def testCostEviction(self):
+    """Entries are evicted until the total cost fits the maximum size"""
+    lrucache = cache.LRUCache(100)
+    lrucache.Set('a', 'a', cost=60)
+    lrucache.Set('b', 'b', cost=30)
+    lrucache.Set('c', 'c', cost=50)
+    self.assertNotIn('a', lrucache)
+    self.assertEqual(lrucache.currsize, 80)
+    lrucache.Set('d', 'd', cost=101)
+    self.assertNotIn('d', lrucache)
+    lrucache.Del('b')
+    self.assertEqual(lrucache.currsize, 50)
+
+  def testOversizedReplacement(self):
+    """Replacing a value by one that is too large removes the old value"""
+    lrucache = cache.LRUCache(100)
+    lrucache.Set('a', 'old', cost=60)
+    lrucache.Set('b', 'b', cost=10)
+    lrucache.Set('a', 'new', cost=101)
+    self.assertIsNone(lrucache.Get('a'))
+    self.assertNotIn('a', lrucache)
+    self.assertEqual(lrucache.currsize, 10)
+    ttlcache = cache.TTLCache(100)
+    ttlcache.Set('a', 'old', cost=60)
+    ttlcache.Set('a', 'new', cost=101)
+    self.assertIsNone(ttlcache.Get('a'))
+    self.assertEqual(ttlcache.currsize, 0)
+
+
+
+class FragmentCacheTest(unittest.TestCase):
+  """Tests setting up the template fragment cache from the config."""
+
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+  def testFileCache(self):
+    """A file cache for fragments is bounded and pruned periodically"""
+    fragments = StaticPageMaker._FragmentCache({
+        'fragment_cache': 'file', 'fragment_cache_path': self.path,
+        'fragment_cache_size': '50', 'fragment_cache_prune': '10'})
+    self.assertIsInstance(fragments, cache.FileCache)
+    self.assertEqual((fragments.maxsize, fragments.prune_interval), (50, 10))
+
+  def testDefaultPath(self):
+    """Fragments are kept apart from the model cache of the application"""
+    self.assertNotEqual(cache.DefaultPath(self.path, 'fragments'),
+                        cache.DefaultPath(self.path, 'models'))
+    self.assertIsInstance(StaticPageMaker._FragmentCache({}), cache.TTLCache)
+
+if __name__ == '__main__':
+  unittest.main(testRunner=unittest.TextTestRunner(verbosity=2))
@@ -0,0 +1,390 @@
+#!/usr/bin/python3
+"""Tests for the SQL records of the model module, without a database server.
+
+The records use a FakeConnection, a MySQL connection that answers queries from
+a script, so the queries the model issues can be checked.
+"""
+
+# Too many public methods
+# pylint: disable=R0904
+
+# Standard modules
+import collections
+import decimal
+import logging
+import unittest
+from unittest import mock
+
+# Third-party modules
+import pymysql
+from pymysql import converters
+
+# Unittest target
+from uweb3 import connections
+from uweb3 import model
+from uweb3.libs.sqltalk import sqlresult
+from uweb3.libs.sqltalk.mysql import connection as mysql_connection
+from uweb3.libs.sqltalk.mysql import cursor as mysql_cursor
+
+
+# ##############################################################################
+# Record classes for testing
+#
+class Author(model.Record):
+  """Author class for testing purposes."""
+
+
+class Publisher(model.Record):
+  """Publisher class for testing purposes."""
+
+
+class Book(model.Record):
+  """Book class for testing purposes."""
+
+
+class Reader(model.Record):
+  """Reader class for testing purposes, kept in the identity map."""
+  _IDENTITY_MAP = True
+
+
+class Subscriber(model.Record):
+  """Subscriber class for testing purposes, kept in the model cache."""
+  _CACHE = True
+
+
+class FakeConnection(mysql_connection.Connection):
+  """A MySQL connection that answers queries from a script, without a server.
+
+  Inserts get consecutive auto-increment values, other queries are answered
+  with the queued `results` in order, or with an empty result. All queries are
+  recorded in `queries`.
+  """
+  def __init__(self, auto_increment=True, increment=1):
+    # The pymysql connection is not set up, nothing connects to a server.
+    # pylint: disable=W0231
+    self.charset = self.encoding = 'utf8'
+    self.encoders = converters.encoders
+    self.server_status = 0
+    self.statement_cache_size = 0
+    self.statements = collections.OrderedDict()
+    self.logger = logging.getLogger('test_record')
+    self.queries = []
+    self.results = []
+    self.auto_increment = auto_increment
+    self.increment = increment
+    self.next_id = 1
+    self.error = None
+
+  def __enter__(self):
+    return mysql_cursor.Cursor(self)
+
+  def __exit__(self, *exc_info):
+    return False
+
+  def Query(self, query_string, cur=None):
+    if isinstance(query_string, bytes):
+      query_string = query_string.decode(self.charset)
+    if self.error is not None:
+      raise self.error
+    if query_string.startswith('INSERT'):
+      rows = query_string.count('), (') + 1
+      insertid = self.next_id if self.auto_increment else 0
+      self.next_id += rows * self.increment
+      return sqlresult.ResultSet(affected=rows, insertid=insertid)
+    if '@@auto_increment_increment' in query_string:
+      return Rows({'@@auto_increment_increment': self.increment})
+    if self.results:
+      return self.results.pop(0)
+    return sqlresult.ResultSet()
+
+
+class FakeManager(connections.ConnectionManager):
+  """A ConnectionManager that gives all records the same FakeConnection."""
+  def __init__(self, connection, options=None):
+    super(FakeManager, self).__init__(None, options or {}, False)
+    self.connection = connection
+
+  def For(self, record_class):
+    return self.connection
+
+
+def Rows(*rows):
+  """Returns a ResultSet with the given rows (dictionaries)."""
+  return sqlresult.ResultSet(fields=list(rows[0]), result=rows)
+
+
+# ##############################################################################
+# Start of tests
+#
+class CreateManyTest(unittest.TestCase):
+  """Tests creating records in bulk."""
+
+  def testAutoIncrementKeys(self):
+    """Records without a key get the consecutive auto-increment values"""
+    connection = FakeConnection()
+    authors = Author.CreateMany(
+        connection, [{'name': name} for name in ('a', 'b', 'c')])
+    self.assertEqual([author.key for author in authors], [1, 2, 3])
+    self.assertEqual([author['ID'] for author in authors], [1, 2, 3])
+    self.assertEqual(connection.queries, [
+        "INSERT INTO `author` (`name`) VALUES ('a'), ('b'), ('c')",
+        'SELECT @@auto_increment_increment'])
+
+  def testNoDerivedKeys(self):
+    """Keys are not guessed for other increments, or without auto-increment"""
+    for connection in (FakeConnection(increment=2),
+                       FakeConnection(auto_increment=False)):
+      authors = Author.CreateMany(connection, [{'name': 'a'}, {'name': 'b'}])
+      self.assertEqual([author.key for author in authors], [None, None])
+
+  def testExplicitKeys(self):
+    """Records with a key keep it, the increment is not looked up"""
+    connection = FakeConnection()
+    authors = Author.CreateMany(
+        connection, [{'ID': 8, 'name': 'a'}, {'ID': 5, 'name': 'b'}])
+    self.assertEqual([author.key for author in authors], [8, 5])
+    self.assertEqual(len(connection.queries), 1)
+
+  def testBadField(self):
+    """A bad column name raises BadFieldError, like creating a single record"""
+    connection = FakeConnection()
+    connection.error = pymysql.OperationalError(
+        1054, "Unknown column 'nmae' in 'field list'")
+    self.assertRaises(model.BadFieldError, Author.CreateMany,
+                      connection, [{'nmae': 'a'}])
+    connection.error = pymysql.OperationalError(1205, 'Lock wait timeout')
+    self.assertRaises(model.DatabaseError, Author.CreateMany,
+                      connection, [{'name': 'a'}])
+
+
+class PreloadTest(unittest.TestCase):
+  """Tests loading the foreign relations of listed records in batches."""
+
+  def testOneQueryPerForeignClass(self):
+    """Each preloaded relation is loaded with a single query"""
+    connection = FakeConnection()
+    connection.results = [
+        Rows({'ID': 1, 'author': 1, 'publisher': 1},
+             {'ID': 2, 'author': 2, 'publisher': 1},
+             {'ID': 3, 'author': 1, 'publisher': None}),
+        Rows({'ID': 1, 'name': 'Christie'}, {'ID': 2, 'name': 'Tolkien'}),
+        Rows({'ID': 1, 'name': 'Penguin'})]
+    books = list(Book.List(connection, preload=['author', 'publisher']))
+    self.assertEqual([' '.join(query.split()) for query in connection.queries], [
+        'SELECT `book`.* FROM `book` WHERE 1',
+        'SELECT `author`.* FROM `author` WHERE `author`.`ID` IN (1,2)',
+        'SELECT `publisher`.* FROM `publisher` WHERE `publisher`.`ID` IN (1)'])
+    self.assertEqual([book['author']['name'] for book in books],
+                     ['Christie', 'Tolkien', 'Christie'])
+    self.assertIs(books[0]['author'], books[2]['author'])
+    self.assertEqual(books[1]['publisher']['name'], 'Penguin')
+    self.assertIsNone(books[2]['publisher'])
+    self.assertEqual(len(connection.queries), 3)
+
+
+class IdentityMapTest(unittest.TestCase):
+  """Tests keeping the records loaded during a request in the identity map."""
+
+  def setUp(self):
+    self.connection = FakeConnection()
+    self.manager = FakeManager(self.connection)
+
+  def testSameRecord(self):
+    """Loading a record again returns the same object, without a query"""
+    self.connection.results = [
+        Rows({'ID': 1, 'name': 'a'}),
+        Rows({'ID': 1, 'name': 'a'}, {'ID': 2, 'name': 'b'})]
+    reader = Reader.FromPrimary(self.manager, 1)
+    self.assertIs(Reader.FromPrimary(self.manager, 1), reader)
+    self.assertEqual(len(self.connection.queries), 1)
+    readers = list(Reader.List(self.manager))
+    self.assertIs(readers[0], reader)
+    self.assertIs(Reader.FromPrimary(self.manager, 2), readers[1])
+    self.assertEqual(len(self.connection.queries), 2)
+
+  def testInvalidation(self):
+    """Saved and deleted records, and the end of the request, clear the map"""
+    self.connection.results = [Rows({'ID': 1, 'name': 'a'})]
+    reader = Reader.FromPrimary(self.manager, 1)
+    reader['name'] = 'b'
+    reader.Save()
+    self.connection.results = [Rows({'ID': 1, 'name': 'b'})]
+    self.assertIsNot(Reader.FromPrimary(self.manager, 1), reader)
+    Reader.DeletePrimary(self.manager, 1)
+    self.connection.results = [Rows({'ID': 1, 'name': 'b'})]
+    reader = Reader.FromPrimary(self.manager, 1)
+    self.manager.PostRequest()
+    self.connection.results = [Rows({'ID': 1, 'name': 'b'})]
+    self.assertIsNot(Reader.FromPrimary(self.manager, 1), reader)
+    self.assertEqual(len(self.connection.queries), 6)
+
+  def testStringKeys(self):
+    """Keys given as strings find and remove the records mapped by int key"""
+    self.connection.results = [Rows({'ID': 5, 'name': 'a'})]
+    reader = Reader.FromPrimary(self.manager, 5)
+    self.assertIs(Reader.FromPrimary(self.manager, '5'), reader)
+    Reader.DeletePrimary(self.manager, '5')
+    self.assertIsNone(self.manager.IdentityMap().Get('reader', 5))
+    self.assertEqual(len(self.connection.queries), 2)
+
+
+class ModelCacheTest(unittest.TestCase):
+  """Tests keeping records in the model cache across requests."""
+
+  def setUp(self):
+    self.connection = FakeConnection()
+    self.manager = FakeManager(
+        self.connection, {'modelcache': {'size': '10', 'ttl': '60'}})
+
+  def testCachedAcrossRequests(self):
+    """Records are loaded from the cache, also in later requests"""
+    self.connection.results = [Rows({'ID': 1, 'name': 'a'})]
+    subscriber = Subscriber.FromPrimary(self.manager, 1)
+    self.manager.PostRequest()
+    self.assertEqual(Subscriber.FromPrimary(self.manager, 1), subscriber)
+    self.assertEqual(len(self.connection.queries), 1)
+    self.assertEqual(self.manager.CacheStats()['queries_saved'], 1)
+
+  def testListPreseedsCache(self):
+    """Listed records are cached, unless only some of their fields are read"""
+    self.connection.results = [
+        Rows({'ID': 1, 'name': 'a'}), Rows({'ID': 2, 'name': 'b'})]
+    list(Subscriber.List(self.manager))
+    list(Subscriber.List(self.manager, fields='ID'))
+    self.assertEqual(Subscriber.FromPrimary(self.manager, 1)['name'], 'a')
+    self.assertIsNone(self.manager.ModelCache().Get('subscriber', 2))
+    self.assertEqual(len(self.connection.queries), 2)
+
+  def testInvalidation(self):
+    """Saving or deleting a record removes it from the cache"""
+    self.connection.results = [Rows({'ID': 1, 'name': 'a'})]
+    subscriber = Subscriber.FromPrimary(self.manager, 1)
+    subscriber['name'] = 'b'
+    subscriber.Save()
+    self.assertIsNone(self.manager.ModelCache().Get('subscriber', 1))
+    self.connection.results = [Rows({'ID': 1, 'name': 'b'})]
+    self.assertEqual(Subscriber.FromPrimary(self.manager, 1)['name'], 'b')
+    Subscriber.DeletePrimary(self.manager, 1)
+    self.assertIsNone(self.manager.ModelCache().Get('subscriber', 1))
+    self.assertRaises(model.NotExistError,
+                      Subscriber.FromPrimary, self.manager, 1)
+
+  def testInvalidationAfterCommit(self):
+    """Rows cached while a save is in progress are invalidated after it"""
+    self.connection.results = [Rows({'ID': 1, 'name': 'a'})]
+    subscriber = Subscriber.FromPrimary(self.manager, 1)
+    subscriber['name'] = 'b'
+    stale = Subscriber(self.manager, {'ID': 1, 'name': 'a'})
+    with mock.patch.object(Subscriber, '_PostSave', lambda self, cursor:
+                           self.connection.ModelCache().Add(stale)):
+      subscriber.Save()
+    self.assertIsNone(self.manager.ModelCache().Get('subscriber', 1))
+
+  def testStringKeys(self):
+    """Keys given as strings find and remove the records cached by int key"""
+    self.connection.results = [Rows({'ID': 5, 'name': 'a'})]
+    subscriber = Subscriber.FromPrimary(self.manager, 5)
+    self.manager.PostRequest()
+    self.assertEqual(Subscriber.FromPrimary(self.manager, '5'), subscriber)
+    self.assertEqual(len(self.connection.queries), 1)
+    self.manager.PostRequest()
+    Subscriber.DeletePrimary(self.manager, '5')
+    self.assertRaises(model.NotExistError,
+                      Subscriber.FromPrimary, self.manager, 5)
+
+
+class KeysetPaginationTest(unittest.TestCase):
+  """Tests the queries for keyset pagination and estimated counts."""
+
+  def setUp(self):
+    self.connection = FakeConnection()
+
+  def Condition(self, order, after):
+    """Returns the keyset condition for the given order and values."""
+    return Author._KeysetCondition(
+        Author._KeysetOrder(order), after, self.connection.EscapeField)
+
+  def Queries(self):
+    """Returns the executed queries, with their whitespace normalized."""
+    return [' '.join(query.split()) for query in self.connection.queries]
+
+  def testOrder(self):
+    """The primary key is added to the order, to make it unique"""
+    self.assertEqual(Author._KeysetOrder(['name', ('born', True)]), [
+        ('name', False), ('born', True), ('author.ID', False)])
+    self.assertEqual(Author._KeysetOrder([('ID', True)]), [('ID', True)])
+
+  def testAscending(self):
+    """Ascending orders compare a row constructor, for the composite index"""
+    self.assertEqual(self.Condition(['name'], ('a', 2)), (
+        '(`name`, `author`.`ID`) > (%s, %s)', ('a', 2)))
+    self.assertEqual(self.Condition(None, 5), ('(`author`.`ID`) > (%s)', (5,)))
+
+  def testDescending(self):
+    """Descending fields continue with lower values, then NULLs"""
+    self.assertEqual(self.Condition([('name', True)], ('b', 1)), (
+        '(((`name` < %s OR `name` IS NULL)) OR '
+        '(`name` = %s AND `author`.`ID` > %s))', ('b', 'b', 1)))
+    self.assertEqual(self.Condition([('name', True), ('born', False)],
+                                    ('b', 1900, 4)), (
+        '(((`name` < %s OR `name` IS NULL)) OR '
+        '(`name` = %s AND `born` > %s) OR '
+        '(`name` = %s AND `born` = %s AND `author`.`ID` > %s))',
+        ('b', 'b', 1900, 'b', 1900, 4)))
+
+  def testNull(self):
+    """NULLs sort first, and last in descending order"""
+    self.assertEqual(self.Condition(['name'], (None, 2)), (
+        '((`name` IS NOT NULL) OR (`name` IS NULL AND `author`.`ID` > %s))',
+        (2,)))
+    self.assertEqual(self.Condition([('name', True)], (None, 2)), (
+        '((`name` IS NULL AND `author`.`ID` > %s))', (2,)))
+    self.assertEqual(self.Condition(['name', ('born', True)], ('a', None, 3)), (
+        '((`name` > %s) OR '
+        '(`name` = %s AND `born` IS NULL AND `author`.`ID` > %s))',
+        ('a', 'a', 3)))
+
+  def testValueCount(self):
+    """A value is needed for every field of the order"""
+    self.assertRaises(model.Error, self.Condition, ['name'], ('a',))
+
+  def testCursor(self):
+    """Cursors are opaque tokens that hold the values of the ordering"""
+    values = ['a', None, decimal.Decimal('1.50'), 3]
+    cursor = Author._EncodeCursor(values)
+    self.assertRegex(cursor, r'^[\w=-]+$')
+    self.assertEqual(Author._DecodeCursor(cursor), tuple(values))
+    for cursor in ('not a cursor', Author._EncodeCursor(5)[:-2]):
+      self.assertRaises(model.Error, Author._DecodeCursor, cursor)
+
+  def testPaginate(self):
+    """Pages continue after the last record of the previous page"""
+    self.connection.results = [
+        Rows({'ID': 1, 'name': 'a'}, {'ID': 3, 'name': 'b'},
+             {'ID': 2, 'name': 'b'}),
+        Rows({'TABLE_ROWS': 40})]
+    page = Author.Paginate(self.connection, 2, order=['name'],
+                           estimate_count=True)
+    self.assertEqual([author.key for author in page], [1, 3])
+    self.assertEqual(Author._DecodeCursor(page.cursor), ('b', 3))
+    self.assertEqual(page.total, 40)
+    self.connection.results = [Rows({'ID': 2, 'name': 'b'}), Rows({'rows': 7})]
+    page = Author.Paginate(self.connection, 2, cursor=page.cursor,
+                           order=['name'], estimate_count=True,
+                           conditions='`name` LIKE "b%"')
+    self.assertEqual([author.key for author in page], [2])
+    self.assertIsNone(page.cursor)
+    self.assertEqual(page.total, 7)
+    self.assertEqual(self.Queries(), [
+        'SELECT `author`.* FROM `author` WHERE 1 '
+        'ORDER BY `name` , `author`.`ID` LIMIT 3',
+        'SELECT `TABLE_ROWS` FROM `information_schema`.`TABLES` WHERE '
+        "`TABLE_SCHEMA` = DATABASE() AND `TABLE_NAME` = 'author'",
+        'SELECT `author`.* FROM `author` WHERE `name` LIKE "b%" AND '
+        "(`name`, `author`.`ID`) > ('b', 3) "
+        'ORDER BY `name` , `author`.`ID` LIMIT 3',
+        'EXPLAIN SELECT 1 FROM `author` WHERE `name` LIKE "b%"'])
+
+
+if __name__ == '__main__':
+  unittest.main(testRunner=unittest.TextTestRunner(verbosity=2))
@@ -14,6 +14,7 @@ try:
 except ImportError:
   import io as stringIO
 
+import io
 import unittest
 import urllib
 
@@ -80,5 +81,147 @@ class IndexedFieldStorageTest(unittest.TestCase):
     self.assertEqual(form_data[2], 'fourth')
 
 
+class LazyRequestTest(unittest.TestCase):
+  """Tests the on-demand parsing of request variables."""
+
+  def CreateRequest(self, method='GET', body=b'', **env):
+    """Returns a Request for a minimal WSGI environment."""
+    environ = {'REQUEST_METHOD': method,
+               'QUERY_STRING': 'q=search&q=again',
+               'HTTP_COOKIE': 'session=abc',
+               'HTTP_HOST': 'example.com',
+               'CONTENT_LENGTH': str(len(body)),
+               'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+               'wsgi.input': io.BytesIO(body)}
+    environ.update(env)
+    return request.Request(environ, None)
+
+  def testNothingParsedUpfront(self):
+    """Creating a Request does not read the body or parse any variables"""
+    req = self.CreateRequest('POST', b'key=value')
+    self.assertEqual(req.env['wsgi.input'].tell(), 0)
+    self.assertIn('post', req.vars)
+    self.assertEqual(req.env['wsgi.input'].tell(), 0)
+    self.assertEqual(dict.__len__(req.vars), 0)
+    self.assertEqual(req.env['host'], 'example.com')
+
+  def testVariables(self):
+    """Variables are parsed on access and keep their types"""
+    req = self.CreateRequest('POST', b'key=value')
+    self.assertEqual(req.vars['cookie'], {'session': 'abc'})
+    self.assertEqual(req.cookies, {'session': 'abc'})
+    self.assertEqual(req.vars['get'].getlist('q'), ['search', 'again'])
+    self.assertEqual(req.vars['post'].getfirst('key'), 'value')
+    self.assertEqual(req.input, b'key=value')
+    self.assertEqual(sorted(req.vars), ['cookie', 'get', 'post'])
+
+  def testNoBodyForGet(self):
+    """GET requests have no body variables"""
+    req = self.CreateRequest()
+    self.assertNotIn('post', req.vars)
+    self.assertEqual(req.headers['cookie'], 'session=abc')
+
+  def testJsonBody(self):
+    """JSON bodies are decoded"""
+    req = self.CreateRequest('PUT', b'{"key": [1, 2]}',
+                             CONTENT_TYPE='application/json')
+    self.assertEqual(req.vars['put'], {'key': [1, 2]})
+
+  def testAssignmentReplacesLoader(self):
+    """Assigned variables take the place of the unparsed ones"""
+    req = self.CreateRequest('POST', b'key=value')
+    req.vars['post'] = {}
+    self.assertEqual(req.vars['post'], {})
+    self.assertEqual(req.env['wsgi.input'].tell(), 0)
+
+  def testFailedLoaderKept(self):
+    """A loader that raises is kept, so the variable can be loaded later"""
+    attempts = []
+    def Loader():
+      attempts.append(None)
+      if len(attempts) == 1:
+        raise ValueError('Not yet')
+      return {'key': 'value'}
+    lazy = request.LazyVars({'post': Loader})
+    self.assertRaises(ValueError, lazy.__getitem__, 'post')
+    self.assertIn('post', lazy)
+    self.assertEqual(lazy['post'], {'key': 'value'})
+    self.assertEqual(len(attempts), 2)
+    self.assertRaises(KeyError, lazy.__getitem__, 'get')
+
+
+class MultipartRequestTest(unittest.TestCase):
+  """Tests the streaming parser for multipart/form-data request bodies."""
+  BOUNDARY = 'xYzZY'
+
+  def CreateRequest(self, parts, **env):
+    """Returns a POST Request with the given (name, filename, content) parts."""
+    body = []
+    for name, filename, content in parts:
+      body.append(b'--%s\r\n' % self.BOUNDARY.encode())
+      disposition = 'Content-Disposition: form-data; name="%s"' % name
+      if filename:
+        disposition += '; filename="%s"' % filename
+      body.append(disposition.encode() + b'\r\n')
+      if filename:
+        body.append(b'Content-Type: application/octet-stream\r\n')
+      body.append(b'\r\n' + content + b'\r\n')
+    body.append(b'--%s--\r\n' % self.BOUNDARY.encode())
+    body = b''.join(body)
+    environ = {'REQUEST_METHOD': 'POST',
+               'CONTENT_LENGTH': str(len(body)),
+               'CONTENT_TYPE': 'multipart/form-data; boundary=%s' % (
+                   self.BOUNDARY),
+               'wsgi.input': io.BytesIO(body)}
+    environ.update(env)
+    return request.Request(environ, None)
+
+  def testFields(self):
+    """Regular fields are returned as strings, bracketed names as dicts"""
+    req = self.CreateRequest([('key', None, b'value'),
+                              ('user[name]', None, b'Bob'),
+                              ('user[age]', None, b'42')])
+    self.assertEqual(req.vars['post'].getfirst('key'), 'value')
+    self.assertEqual(req.vars['post'].getfirst('user'),
+                     {'name': 'Bob', 'age': '42'})
+
+  def testUploadedFile(self):
+    """Files are file-like objects with name, size and content type"""
+    content = bytes(range(256)) * 16
+    req = self.CreateRequest([('upload', 'data.bin', content)])
+    upload = req.vars['post'].getfirst('upload')
+    self.assertIsInstance(upload, request.UploadedFile)
+    self.assertEqual(upload.name, 'upload')
+    self.assertEqual(upload.filename, 'data.bin')
+    self.assertEqual(upload.content_type, 'application/octet-stream')
+    self.assertEqual(upload.size, len(content))
+    upload.seek(0)
+    self.assertEqual(upload.read(), content)
+
+  def testLargeUploadSpooled(self):
+    """Files larger than the spool size are written to disk"""
+    content = b'x' * (request.IndexedFieldStorage.SPOOL_SIZE + 1)
+    req = self.CreateRequest([('upload', 'big.bin', content)])
+    upload = req.vars['post'].getfirst('upload')
+    self.assertTrue(upload.file._rolled)
+    self.assertEqual(upload.size, len(content))
+
+  def testMaximumBodySize(self):
+    """Bodies exceeding the maximum size are refused before being read"""
+    req = self.CreateRequest([('key', None, b'value')])
+    req.MAX_BODY_SIZE = 10
+    self.assertRaises(request.RequestBodyTooLargeError,
+                      lambda: req.vars['post'])
+    self.assertEqual(req.env['wsgi.input'].tell(), 0)
+
+  def testMaximumBodySizeUnknownLength(self):
+    """Bodies without a length are cut off at the maximum size"""
+    req = self.CreateRequest([('key', None, b'value' * 10)])
+    del req.env['CONTENT_LENGTH']
+    req.MAX_BODY_SIZE = 50
+    self.assertRaises(request.RequestBodyTooLargeError,
+                      lambda: req.vars['post'])
+
+
 if __name__ == '__main__':
   unittest.main(testRunner=unittest.TextTestRunner(verbosity=2))
@@ -0,0 +1,181 @@
+#!/usr/bin/python3
+"""Tests for the response module."""
+
+# Too many public methods
+# pylint: disable-msg=R0904
+
+# Standard modules
+import gzip
+import hashlib
+import unittest
+import zlib
+
+# Unittest target
+import uweb3
+from uweb3 import response
+from uweb3.libs import compression
+from uweb3.libs.safestring import HTMLsafestring
+
+
+class StreamingResponseTest(unittest.TestCase):
+  """Tests responses with an iterator as their content."""
+
+  def testStreaming(self):
+    """Iterables are streamed, strings, mappings and JSON values are not"""
+    self.assertTrue(response.Response(iter(['a'])).streaming)
+    self.assertTrue(response.Response(str(x) for x in range(3)).streaming)
+    self.assertTrue(response.Response(['a', b'b']).streaming)
+    self.assertTrue(response.Response(('a', 'b')).streaming)
+    for content in ('text', b'bytes', bytearray(b'bytes'), {'a': 1}, None):
+      self.assertFalse(response.Response(content).streaming)
+    self.assertFalse(response.Response(['a', 'b'],
+                                       content_type='application/json').streaming)
+
+  def testListBody(self):
+    """A list of chunks is escaped and encoded chunk by chunk"""
+    page = response.Response(['<p>', HTMLsafestring('<b>'), b'</p>'])
+    self.assertTrue(page.streaming)
+    body = response.StreamingBody(
+        page.text, page.charset, escape=lambda x: HTMLsafestring(x, unsafe=True))
+    self.assertEqual(list(body), [b'&lt;p&gt;', b'<b>', b'</p>'])
+
+  def testEncoding(self):
+    """Text chunks are escaped and encoded, bytes and safe strings are not"""
+    chunks = ['<b>', HTMLsafestring('<i>'), b'<u>', 'caf\N{LATIN SMALL LETTER E WITH ACUTE}']
+    body = response.StreamingBody(
+        iter(chunks), 'utf8', escape=lambda x: HTMLsafestring(x, unsafe=True))
+    self.assertEqual(list(body), [b'&lt;b&gt;', b'<i>', b'<u>', b'caf\xc3\xa9'])
+
+  def testIncrementalEncoding(self):
+    """Stateful encodings only emit their byte order mark once"""
+    body = response.StreamingBody(iter(['a', 'b']), 'utf-16')
+    self.assertEqual(b''.join(body).decode('utf-16'), 'ab')
+
+  def testCloseCallbacks(self):
+    """Callbacks run when the body is closed, after the chunks were produced"""
+    events = []
+
+    def Chunks():
+      try:
+        events.append('first')
+        yield 'first'
+        events.append('second')
+        yield 'second'
+      finally:
+        events.append('generator closed')
+
+    body = response.StreamingBody(
+        Chunks(), 'utf8', on_close=[lambda: events.append('cleanup')])
+    self.assertEqual(events, [])
+    self.assertEqual(next(iter(body)), b'first')
+    body.close()
+    self.assertEqual(events, ['first', 'generator closed', 'cleanup'])
+    body.close()
+    self.assertEqual(events.count('cleanup'), 1)
+
+
+class CompressionTest(unittest.TestCase):
+  """Tests negotiated compression of responses."""
+
+  def setUp(self):
+    self.app = object.__new__(uweb3.uWeb)
+    self.app.compression = {'level': 6, 'min_size': 100,
+                            'types': frozenset(['text/html'])}
+
+  def Compress(self, page, accept_encoding='gzip'):
+    """Returns the response after compression for the given Accept-Encoding."""
+    req = type('Request', (object,), {})()
+    req.env = {'HTTP_ACCEPT_ENCODING': accept_encoding}
+    return self.app._Compress(req, page)
+
+  def testChooseEncoding(self):
+    """The encoding is chosen from those the client accepts"""
+    self.assertEqual(compression.ChooseEncoding('gzip, deflate'), 'gzip')
+    self.assertEqual(compression.ChooseEncoding('*'), compression.ENCODINGS[0])
+    self.assertIsNone(compression.ChooseEncoding('gzip;q=0, deflate'))
+    self.assertIsNone(compression.ChooseEncoding(None))
+
+  def testCompressed(self):
+    """Large enough responses of a configured type are compressed"""
+    page = self.Compress(response.Response('<p>Hello</p>' * 20))
+    self.assertEqual(page.headers['Content-Encoding'], 'gzip')
+    self.assertEqual(page.headers['Vary'], 'Accept-Encoding')
+    self.assertEqual(gzip.decompress(page.text), b'<p>Hello</p>' * 20)
+
+  def testNotCompressed(self):
+    """Small, unaccepted, other type or already encoded responses are kept"""
+    page = self.Compress(response.Response('<p>Hello</p>'))
+    self.assertNotIn('Content-Encoding', page.headers)
+    self.assertEqual(page.headers['Vary'], 'Accept-Encoding')
+    page = self.Compress(response.Response('x' * 200), accept_encoding='')
+    self.assertNotIn('Content-Encoding', page.headers)
+    page = self.Compress(response.Response('x' * 200, content_type='image/png'))
+    self.assertNotIn('Vary', page.headers)
+    page = self.Compress(response.Response(
+        b'x' * 200, headers={'Content-Encoding': 'br'}))
+    self.assertEqual(page.text, b'x' * 200)
+
+  def testStreamed(self):
+    """Streamed responses are compressed chunk by chunk"""
+    closed = []
+    body = response.StreamingBody(iter(['<p>%d</p>' % x for x in range(5)]),
+                                  'utf8', on_close=[lambda: closed.append(1)])
+    page = self.Compress(response.Response(body))
+    self.assertIsInstance(page.text, compression.CompressedBody)
+    chunks = list(page.text)
+    self.assertEqual(len(chunks), 6)
+    decompressor = zlib.decompressobj(31)
+    self.assertEqual(decompressor.decompress(chunks[0]), b'<p>0</p>')
+    self.assertEqual(gzip.decompress(b''.join(chunks)),
+                     b''.join(b'<p>%d</p>' % x for x in range(5)))
+    page.text.close()
+    self.assertEqual(closed, [1])
+
+
+class ETagTest(unittest.TestCase):
+  """Tests ETags and conditional requests for dynamic responses."""
+
+  def setUp(self):
+    self.app = object.__new__(uweb3.uWeb)
+
+  def ETag(self, page, method='GET', **env):
+    """Returns the response after adding an ETag for the given request."""
+    req = type('Request', (object,), {})()
+    req.env = dict(env, REQUEST_METHOD=method)
+    return self.app._ETag(req, page)
+
+  def testContentHash(self):
+    """Safe strings compute their content hash when it is first used"""
+    page = HTMLsafestring('<p>Hello</p>')
+    self.assertNotIn('content_hash', vars(page))
+    self.assertEqual(page.content_hash,
+                     hashlib.md5(b'<p>Hello</p>').hexdigest())
+    self.assertIn('content_hash', vars(page))
+
+  def testETag(self):
+    """Complete successful responses to GET requests get an ETag"""
+    page = self.ETag(response.Response(HTMLsafestring('<p>Hello</p>')))
+    self.assertEqual(page.headers['ETag'],
+                     '"%s"' % hashlib.md5(b'<p>Hello</p>').hexdigest())
+    self.assertEqual(self.ETag(response.Response(b'data')).headers['ETag'],
+                     '"%s"' % hashlib.md5(b'data').hexdigest())
+    for page in (self.ETag(response.Response('x'), method='POST'),
+                 self.ETag(response.Response('x', httpcode=404)),
+                 self.ETag(response.Response(iter(['x'])))):
+      self.assertNotIn('ETag', page.headers)
+
+  def testNotModified(self):
+    """A matching If-None-Match gets a 304, also for compressed variants"""
+    etag = self.ETag(response.Response('Hello')).headers['ETag']
+    for if_none_match in (etag, 'W/' + etag, '"other", %s' % etag,
+                          '%s-gzip"' % etag[:-1]):
+      page = self.ETag(response.Response('Hello'),
+                       HTTP_IF_NONE_MATCH=if_none_match)
+      self.assertEqual(page.httpcode, 304)
+      self.assertEqual(page.text, '')
+    page = self.ETag(response.Response('Hello'), HTTP_IF_NONE_MATCH='"other"')
+    self.assertEqual(page.httpcode, 200)
+
+
+if __name__ == '__main__':
+  unittest.main(testRunner=unittest.TextTestRunner(verbosity=2))
@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+"""Tests for the routing module."""
+
+# Too many public methods
+# pylint: disable-msg=R0904
+
+# Standard modules
+import unittest
+
+# Unittest target
+from uweb3 import routing
+
+
+def Table(*routes):
+  """Returns a DispatchTable for the given (pattern, handler, ...) tuples."""
+  def MakeRoute(pattern, handler, method='ALL', host='*'):
+    return routing.Route(pattern, handler, method, host, None)
+  return routing.DispatchTable(MakeRoute(*route) for route in routes)
+
+
+class LiteralPrefixTest(unittest.TestCase):
+  """Tests the extraction of literal prefixes from route patterns."""
+
+  def testPlainPattern(self):
+    """A pattern without regex constructs is its own prefix"""
+    self.assertEqual(routing.LiteralPrefix('/about'), '/about')
+
+  def testGroupEndsPrefix(self):
+    """The prefix ends at the first group"""
+    self.assertEqual(routing.LiteralPrefix('/user/(\\d+)'), '/user/')
+
+  def testQuantifiedCharacter(self):
+    """A quantified final character is not part of the prefix"""
+    self.assertEqual(routing.LiteralPrefix('/users?/list'), '/user')
+
+  def testEscapedCharacter(self):
+    """Escaped punctuation is literal, escaped classes end the prefix"""
+    self.assertEqual(routing.LiteralPrefix('/robots\\.txt'), '/robots.txt')
+    self.assertEqual(routing.LiteralPrefix('/page\\d'), '/page')
+
+  def testTopLevelAlternation(self):
+    """Patterns with a top-level alternation have no prefix"""
+    self.assertEqual(routing.LiteralPrefix('/a|/b'), '')
+    self.assertEqual(routing.LiteralPrefix('/(a|b)'), '/')
+
+
+class DispatchTableTest(unittest.TestCase):
+  """Tests the first-match-wins semantics of the DispatchTable."""
+
+  def testFirstMatchWins(self):
+    """The first route that matches is used, regardless of specificity"""
+    table = Table(('/(.*)', 'Catchall'), ('/about', 'About'))
+    self.assertEqual(table.Resolve('/about', 'GET', '')[0], 'Catchall')
+    table = Table(('/about', 'About'), ('/(.*)', 'Catchall'))
+    self.assertEqual(table.Resolve('/about', 'GET', '')[0], 'About')
+    self.assertEqual(table.Resolve('/other', 'GET', '')[0], 'Catchall')
+
+  def testGroups(self):
+    """Match groups of the matching route are returned, empty ones dropped"""
+    table = Table(('/a/(\\d+)/?(\\w*)', 'A'), ('/b/(\\d+)-(\\d+)', 'B'))
+    self.assertEqual(table.Resolve('/b/1-2', 'GET', '')[1], ('1', '2'))
+    self.assertEqual(table.Resolve('/a/3/', 'GET', '')[1], ('3',))
+    self.assertEqual(table.Resolve('/a/3/x', 'GET', '')[1], ('3', 'x'))
+
+  def testFullMatch(self):
+    """Routes must match the whole url"""
+    table = Table(('/about', 'About'))
+    self.assertIsNone(table.Resolve('/about/more', 'GET', ''))
+
+  def testMethods(self):
+    """Routes for other methods are skipped"""
+    table = Table(('/form', 'Post', 'POST', '*'), ('/form', 'Form'))
+    self.assertEqual(table.Resolve('/form', 'POST', '')[0], 'Post')
+    self.assertEqual(table.Resolve('/form', 'GET', '')[0], 'Form')
+
+  def testUncombinablePatterns(self):
+    """Routes with named groups or backreferences still match in order"""
+    table = Table(('/(?P<a>x)(?P=a)', 'Double'), ('/(?P<a>.*)', 'Named'))
+    self.assertEqual(table.Resolve('/xx', 'GET', '')[0], 'Double')
+    self.assertEqual(table.Resolve('/xy', 'GET', '')[:2], ('Named', ('xy',)))
+
+  def testLinearEquivalence(self):
+    """Results equal those of scanning all routes one by one"""
+    patterns = ['/', '/static/(.*)', '/user/(\\d+)', '/user/(\\w+)/edit',
+                '/us(.*)', '/[a-z]+', '/api/v(\\d)/(\\w+)', '/(.*)']
+    table = Table(*((pattern, index) for index, pattern in enumerate(patterns)))
+    routes = table.routes
+    for url in ('/', '/static/x.css', '/user/12', '/user/bob/edit', '/user/',
+                '/usb', '/abc', '/api/v2/list', '/ABC', '/api/vx/list'):
+      expected = next(route.handler for route in routes if route.regex.match(url))
+      self.assertEqual(table.Resolve(url, 'GET', '')[0], expected, url)
+
+  def testHostPatterns(self):
+    """Host patterns are matched against the request host, groups returned"""
+    table = Table(('/', 'Sub', 'ALL', '(\\w+)\\.example\\.com'),
+                  ('/', 'Index'))
+    self.assertEqual(table.Resolve('/', 'GET', 'shop.example.com'),
+                     ('Sub', (), ('shop',), None))
+    self.assertEqual(table.Resolve('/', 'GET', 'example.org'),
+                     ('Index', (), None, None))
+
+
+class RouteCacheTest(unittest.TestCase):
+  """Tests the LRU cache of resolved routes."""
+
+  def testHitsAndMisses(self):
+    """Repeated requests are served from the cache"""
+    table = Table(('/(\\d+)', 'Number'))
+    self.assertEqual(table.Resolve('/1', 'GET', ''), table.Resolve('/1', 'GET', ''))
+    self.assertEqual(table.cache.Stats()['hits'], 1)
+    self.assertEqual(table.cache.Stats()['misses'], 1)
+    table.Resolve('/1', 'POST', '')
+    self.assertEqual(table.cache.Stats()['misses'], 2)
+
+  def testUnmatchedNotCached(self):
+    """Urls without a route are not stored in the cache"""
+    table = Table(('/(\\d+)', 'Number'))
+    self.assertIsNone(table.Resolve('/x', 'GET', ''))
+    self.assertEqual(len(table.cache), 0)
+
+  def testEviction(self):
+    """The cache is bounded, least recently used entries are evicted"""
+    table = routing.DispatchTable(
+        [routing.Route('/(\\d+)', 'Number', 'ALL', '*', None)], cache_size=2)
+    for url in ('/1', '/2', '/1', '/3'):
+      table.Resolve(url, 'GET', '')
+    self.assertIn(('GET', '', '/1'), table.cache)
+    self.assertNotIn(('GET', '', '/2'), table.cache)
+    self.assertEqual(table.cache.Stats()['evictions'], 1)
+
+
+if __name__ == '__main__':
+  unittest.main(testRunner=unittest.TextTestRunner(verbosity=2))
@@ -11,6 +11,7 @@ import time
 import unittest
 
 # Unittest target
+from uweb3 import response
 from uweb3 import templateparser
 
 class Parser(unittest.TestCase):
@@ -285,8 +286,9 @@ class TemplateTagFunctions(unittest.TestCase):
   def testNonexistantFuntion(self):
     """[TagFunctions] An error is raised for functions that don't exist"""
     template = 'This tag function is missing [num|zoink].'
-    self.assertEqual(self.parse(template), template)
-    # Error is only thrown if we actually pass an argument for the tag:
+    # The error is raised when the template is loaded, tag values or not:
+    self.assertRaises(templateparser.TemplateNameError,
+                      templateparser.Template, template)
     self.assertRaises(templateparser.TemplateNameError,
                       self.parse, template, num=1)
 
@@ -487,6 +489,27 @@ class TemplateTagFunctionClosures(unittest.TestCase):
     self.assertRaises(templateparser.TemplateSyntaxError,
                       self.parse, template, tag=self.tag)
 
+  def testErrorsOnLoad(self):
+    """[TagClosures] Bad arguments and functions raise when loading a template"""
+    for template in ('[tag|limit(test)]', '[tag|limit(length=20)]',
+                     '[tag|limit("".join)]', '[tag|limit(20,)]'):
+      self.assertRaises(templateparser.TemplateSyntaxError,
+                        templateparser.Template, template)
+    self.assertRaises(templateparser.TemplateNameError,
+                      templateparser.Template, '[tag|unlimited(20)]')
+
+  def testArgumentsParsedOnce(self):
+    """[TagClosures] Arguments are parsed on load, not for every render"""
+    template = templateparser.Template(
+        '{{ for item in [items] }}[item|strlimit(2, "!")]{{ endfor }}')
+    self.assertEqual(template[0][0].calls, (('strlimit', (2, '!')),))
+    original = templateparser.TemplateTag.ParseFunction
+    templateparser.TemplateTag.ParseFunction = None
+    try:
+      self.assertEqual(template.Parse(items=['abc', 'de']), 'ab!de')
+    finally:
+      templateparser.TemplateTag.ParseFunction = original
+
 
 class TemplateUnicodeSupport(unittest.TestCase):
   """TemplateParser handles Unicode gracefully."""
@@ -684,6 +707,22 @@ class TemplateConditionals(unittest.TestCase):
     template = '{{ if [var:present] or [var:absent] }}~{{ endif }}'
     self.assertEqual(self.parse(template, var={'present': 1}), '~')
 
+  def testCompiledOnLoad(self):
+    """{{ if }} Expressions are checked and compiled once, when loaded"""
+    template = templateparser.Template(
+        '{{ for num in [nums] }}{{ if [num] > 1 }}[num]{{ endif }}{{ endfor }}')
+    compile_calls = []
+    original = templateparser.LimitedCompile
+    templateparser.LimitedCompile = lambda *args: compile_calls.append(args)
+    try:
+      self.assertEqual(template.Parse(nums=[1, 2, 3]), '23')
+    finally:
+      templateparser.LimitedCompile = original
+    self.assertEqual(compile_calls, [])
+    self.assertRaises(templateparser.TemplateEvaluationError,
+                      templateparser.Template,
+                      '{{ if [a] }}{{ elif open([a]) }}{{ endif }}')
+
 
 class TemplateLoops(unittest.TestCase):
   """TemplateParser properly handles for-loops."""
@@ -855,6 +894,7 @@ class TemplateStringRepresentations(unittest.TestCase):
     self.strip = lambda string: re.sub('\s', '', string)
     self.tmpl = templateparser.Template
     self.parser = templateparser.Parser()
+    self.parser.RegisterFunction('casing', str.title)
 
   def testTemplateTag(self):
     """[Representation] TemplateTags str() echoes its literal"""
@@ -916,6 +956,125 @@ class TemplateNestedScopes(unittest.TestCase):
     self.assertEqual(result_once, 'value: foo')
 
 
+class TemplateStreaming(unittest.TestCase):
+  """Test cases for rendering templates as a stream of chunks."""
+  def setUp(self):
+    """Sets up a testbed."""
+    self.parser = templateparser.Parser()
+    self.tmpl = templateparser.Template
+    self.parser['item'] = self.tmpl('<li>[name]</li>')
+    self.parser['list'] = self.tmpl(
+        '{{ if [names] }}<ul>{{ for name in [names] }}{{ inline item }}'
+        '{{ endfor }}</ul>{{ else }}[empty]{{ endif }}', parser=self.parser)
+
+  def testStreamEqualsParse(self):
+    """[Streaming] The joined chunks are identical to the parsed template"""
+    for kwds in ({'names': ('John', '<Eric>')}, {'names': (), 'empty': '<->'}):
+      chunks = list(self.parser.Stream('list', **kwds))
+      self.assertEqual(''.join(chunks), self.parser.Parse('list', **kwds))
+      for chunk in chunks:
+        self.assertIsInstance(chunk, templateparser.HTMLsafestring)
+
+  def testStreamIsLazy(self):
+    """[Streaming] Chunks are rendered as they are consumed"""
+    rendered = []
+
+    def Names():
+      for name in ('John', 'Eric'):
+        rendered.append(name)
+        yield name
+
+    self.parser['list'].CHUNK_SIZE = 1
+    stream = self.parser.Stream('list', names=Names())
+    self.assertEqual(rendered, [])
+    self.assertEqual(next(stream), '<ul>')
+    self.assertEqual(next(stream), '<li>John</li>')
+    self.assertEqual(rendered, ['John'])
+    self.assertEqual(''.join(stream), '<li>Eric</li></ul>')
+
+  def testStreamResponse(self):
+    """[Streaming] A template stream is the body of a streaming Response"""
+    page = response.Response(self.parser.Stream('list', names=('<b>',)))
+    self.assertTrue(page.streaming)
+    body = response.StreamingBody(
+        page.text, 'utf8',
+        escape=lambda x: templateparser.HTMLsafestring(x, unsafe=True))
+    self.assertEqual(b''.join(body), b'<ul><li>&lt;b&gt;</li></ul>')
+
+
+class TemplateFragmentCache(unittest.TestCase):
+  """Test cases for caching rendered fragments of templates."""
+  def setUp(self):
+    """Sets up a testbed."""
+    self.parser = templateparser.Parser()
+    self.parse = self.parser.ParseString
+    self.rendered = []
+    self.parser.RegisterFunction('count', self.Count)
+
+  def tearDown(self):
+    del templateparser.TAG_FUNCTIONS['count']
+    if os.path.exists('tmp_template'):
+      os.unlink('tmp_template')
+
+  def Count(self, value):
+    """Tag function that records the values that were rendered."""
+    self.rendered.append(value)
+    return value
+
+  def testCachedBlock(self):
+    """{{ cache }} The block is rendered once for every key"""
+    template = '<p>{{ cache key=[id] }}[name|count]{{ endcache }}</p>'
+    self.assertEqual(self.parse(template, id=1, name='<a>'), '<p>&lt;a&gt;</p>')
+    self.assertEqual(self.parse(template, id=1, name='b'), '<p>&lt;a&gt;</p>')
+    self.assertEqual(self.parse(template, id=2, name='c'), '<p>c</p>')
+    self.assertEqual(self.rendered, ['<a>', 'c'])
+    stats = self.parser.FragmentStats()
+    self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+
+  def testSeparateBlocks(self):
+    """{{ cache }} Blocks with different content do not share their output"""
+    template = ('{{ cache key=[id] }}[a]{{ endcache }}'
+                '{{ cache key=[id] ttl=5 }}[b]{{ endcache }}')
+    self.assertEqual(self.parse(template, id=1, a='A', b='B'), 'AB')
+    self.assertEqual(self.parse(template, id=1, a='x', b='y'), 'AB')
+
+  def testCacheInLoop(self):
+    """{{ cache }} Blocks inside loops are cached per item"""
+    template = ('{{ for item in [items] }}{{ cache key=item-[item:id] }}'
+                '[item:name|count]{{ endcache }}{{ endfor }}')
+    items = [{'id': 1, 'name': 'a'}, {'id': 2, 'name': 'b'},
+             {'id': 1, 'name': 'c'}]
+    self.assertEqual(self.parse(template, items=items), 'aba')
+    stream = templateparser.Template(template, parser=self.parser).Iterate(
+        items=items)
+    self.assertEqual(''.join(stream), 'aba')
+    self.assertEqual(self.rendered, ['a', 'b'])
+
+  def testBadSyntax(self):
+    """{{ cache }} A key is required and options must be known"""
+    for template in ('{{ cache }}x{{ endcache }}',
+                     '{{ cache key=[a] size=3 }}x{{ endcache }}',
+                     '{{ cache key=[a] ttl=long }}x{{ endcache }}',
+                     '{{ cache key=[a] }}x{{ endif }}'):
+      self.assertRaises(templateparser.TemplateSyntaxError,
+                        templateparser.Template, template)
+
+  def testParseCached(self):
+    """[Fragments] ParseCached caches by key, until the template changes"""
+    with open('tmp_template', 'w') as template:
+      template.write('Hello [name|count]')
+    self.assertEqual(self.parser.ParseCached('tmp_template', 1, name='A'),
+                     'Hello A')
+    self.assertEqual(self.parser.ParseCached('tmp_template', 1, name='B'),
+                     'Hello A')
+    time.sleep(.01)  # short pause so that mtime will actually be different
+    with open('tmp_template', 'w') as template:
+      template.write('Bye [name|count]')
+    self.assertEqual(self.parser.ParseCached('tmp_template', 1, name='B'),
+                     'Bye B')
+    self.assertEqual(self.rendered, ['A', 'B'])
+
+
 class TemplateReloading(unittest.TestCase):
   """Tests for FileTemplate automatic reloading upon modification."""
   def setUp(self):